@@ -0,0 +1,182 @@
+"""
+Shared helpers for the benchmarks: a scratch database, a seeded dataset and timing utilities.
+
+The benchmarks never touch the configured database.  They create (and drop) a scratch database
+named after it, with the same backend: on the same MySQL server, using the same credentials, or as
+an SQLite file next to the configured one, which needs no server at all.
+"""
+import os
+import random
+import time
+import uuid
+
+import pymysql
+
+import travelapp.config as cfg
+from travelapp import backends, dbutil
+
+BENCH_SUFFIX = "_bench"
+PASSWORD = "benchmark-password"
+SALT = "benchmark-salt"
+
+
+def scratch_database_name():
+    """:return: name of the scratch MySQL database, or path of the scratch SQLite file"""
+    if dbutil.backend.name == "sqlite":
+        root, extension = os.path.splitext(cfg.DB_SQLITE_PATH)
+        return root + BENCH_SUFFIX + extension
+
+    return cfg.DB_DATABASE + BENCH_SUFFIX
+
+
+def scratch_backend():
+    """:return: backend of the configured kind for the scratch database"""
+    if dbutil.backend.name == "sqlite":
+        return backends.SQLiteBackend(scratch_database_name())
+
+    return backends.MySQLBackend(cfg.DB_HOST, cfg.DB_USERNAME, cfg.DB_PASSWORD, scratch_database_name())
+
+
+def scratch_connection(recreate=True):
+    """
+    Connect to the scratch benchmark database, dropping and recreating it first if requested.
+
+    :param recreate: Start from an empty database
+    :return: connection
+    """
+    name = scratch_database_name()
+
+    if dbutil.backend.name == "sqlite":
+        if recreate:
+            for path in (name, name + "-wal", name + "-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+        return scratch_backend().connect()
+
+    server = pymysql.connect(host=cfg.DB_HOST, user=cfg.DB_USERNAME, passwd=cfg.DB_PASSWORD)
+    cursor = server.cursor()
+    if recreate:
+        cursor.execute("DROP DATABASE IF EXISTS `{0}`".format(name))
+    cursor.execute("CREATE DATABASE IF NOT EXISTS `{0}`".format(name))
+    cursor.close()
+    server.close()
+
+    return scratch_backend().connect()
+
+
+def new_guid():
+    return uuid.uuid4().hex
+
+
+def seed(cursor, users=2000, groups=500, members_per_group=8, trips_per_group=10, locations_per_trip=40,
+         seed_value=1234):
+    """
+    Fill an empty, migrated database with a synthetic dataset.  Rows are inserted with explicit ids
+    using multi-row inserts, so seeding a few hundred thousand locations takes seconds.
+
+    :return: dict of sample keys for the benchmarks to query with
+    """
+    rng = random.Random(seed_value)
+    hashed_password = dbutil.hash_password(SALT, PASSWORD)
+
+    user_rows = []
+    for user_id in range(1, users + 1):
+        username = "user{0}".format(user_id)
+        user_rows.append((user_id, new_guid(), username, "First", "Last", username + "@example.com", 1,
+                          hashed_password, SALT))
+    cursor.executemany("""
+        INSERT INTO users (user_id, guid, username, firstname, lastname, email, verified, hashed_password, salt)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """, user_rows)
+
+    group_rows = [(group_id, new_guid(), "Group {0}".format(group_id)) for group_id in range(1, groups + 1)]
+    cursor.executemany("INSERT INTO groups (group_id, guid, name) VALUES (%s, %s, %s)", group_rows)
+
+    cursor.execute("SELECT permission_id, name FROM permissions")
+    permission_ids = dict((name, permission_id) for permission_id, name in cursor.fetchall())
+
+    member_rows = []
+    memberships = []
+    owners = {}
+    for group_id, group_guid, _ in group_rows:
+        members = rng.sample(range(1, users + 1), members_per_group)
+        for idx, user_id in enumerate(members):
+            permission = "OWNER" if idx == 0 else rng.choice(["MODERATOR", "MEMBER", "READER"])
+            member_rows.append((group_id, user_id, permission_ids[permission]))
+            if permission == "OWNER":
+                owners[group_guid] = "user{0}".format(user_id)
+            memberships.append(("user{0}".format(user_id), group_guid))
+    cursor.executemany("INSERT INTO group_members (group_id, user_id, permission_id) VALUES (%s, %s, %s)",
+                       member_rows)
+
+    trip_rows = []
+    trip_id = 0
+    for group_id, _, _ in group_rows:
+        for idx in range(trips_per_group):
+            trip_id += 1
+            trip_rows.append((trip_id, group_id, new_guid(), "Trip {0}".format(trip_id)))
+    cursor.executemany("INSERT INTO trips (trip_id, group_id, guid, title) VALUES (%s, %s, %s, %s)", trip_rows)
+
+    location_pairs = []
+    location_rows = []
+    for trip_id, _, trip_guid, _ in trip_rows:
+        for idx in range(locations_per_trip):
+            location_guid = new_guid()
+            location_rows.append((trip_id, location_guid, "Stop {0}".format(idx),
+                                  rng.uniform(-60, 60), rng.uniform(-180, 180)))
+            location_pairs.append((trip_guid, location_guid))
+
+        if len(location_rows) >= 10000:
+            insert_locations(cursor, location_rows)
+            location_rows = []
+    insert_locations(cursor, location_rows)
+
+    cursor.connection.commit()
+
+    return {
+        "usernames": [row[2] for row in user_rows],
+        "group_guids": [row[1] for row in group_rows],
+        "trip_guids": [row[2] for row in trip_rows],
+        "memberships": memberships,
+        "owners": owners,
+        "locations": location_pairs,
+        "password": PASSWORD,
+    }
+
+
+def insert_locations(cursor, rows):
+    if not rows:
+        return
+
+    cursor.executemany("""
+        INSERT INTO locations (trip_id, guid, title, latitude, longitude)
+        VALUES (%s, %s, %s, %s, %s)
+    """, rows)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+
+    idx = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def time_calls(func, argument_list):
+    """
+    Call func once per argument tuple and return latency statistics in milliseconds.
+    """
+    samples = []
+    for args in argument_list:
+        start = time.perf_counter()
+        func(*args)
+        samples.append((time.perf_counter() - start) * 1000.0)
+
+    return {
+        "calls": len(samples),
+        "p50_ms": percentile(samples, 0.50),
+        "p95_ms": percentile(samples, 0.95),
+        "max_ms": max(samples) if samples else 0.0,
+    }
@@ -0,0 +1,88 @@
+"""
+Lookup latency before and after the index migration.
+
+Seeds a scratch database at schema version 1 (the original createdb.py schema), times the hot
+dbutil lookups, applies the remaining migrations and times them again.  Locations are read in the
+version 1 order on the first pass, since their position column only exists from version 3.
+
+    python -m benchmarks.indexes [--calls N]
+"""
+import argparse
+import random
+
+from travelapp import dbutil
+from travelapp import migrations
+
+from . import common
+
+
+# get_locations as it was at schema version 1
+V1_GET_LOCATIONS = """
+    SELECT locations.location_id, locations.trip_id, locations.guid, locations.title,
+           locations.latitude, locations.longitude, locations.arrivalDate,
+           locations.departureDate, locations.url
+    FROM locations
+    JOIN trips USING (trip_id)
+    WHERE trips.guid = %s
+    ORDER BY locations.location_id
+"""
+
+
+def v1_get_locations(cursor, trip_guid):
+    cursor.execute(V1_GET_LOCATIONS, trip_guid)
+    return dbutil.fetch_records(cursor, dbutil.Location)
+
+
+def run_lookups(cursor, data, calls, rng, get_locations=dbutil.get_locations):
+    # Both passes look up the same keys; time the queries, not permission_cache hits
+    dbutil.permission_cache.clear()
+
+    trips = [(cursor, rng.choice(data["trip_guids"])) for _ in range(calls)]
+    users = [(cursor, rng.choice(data["usernames"])) for _ in range(calls)]
+    members = [(cursor, username, group_guid, ["OWNER", "MODERATOR"])
+               for username, group_guid in rng.sample(data["memberships"], calls)]
+    groups = [(cursor, rng.choice(data["group_guids"])) for _ in range(calls)]
+
+    return [
+        ("get_trip", common.time_calls(dbutil.get_trip, trips)),
+        ("get_locations", common.time_calls(get_locations, trips)),
+        ("get_trips", common.time_calls(dbutil.get_trips, users)),
+        ("get_groups", common.time_calls(dbutil.get_groups, users)),
+        ("has_permissions", common.time_calls(dbutil.has_permissions, members)),
+        ("get_members", common.time_calls(dbutil.get_members, groups)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200, help="lookups per function")
+    parser.add_argument("--trips-per-group", type=int, default=10)
+    parser.add_argument("--locations-per-trip", type=int, default=40)
+    args = parser.parse_args()
+
+    conn = common.scratch_connection()
+    cursor = conn.cursor()
+
+    migrations.migrate(cursor, target=1)
+    data = common.seed(cursor, trips_per_group=args.trips_per_group, locations_per_trip=args.locations_per_trip)
+    print("Seeded {0} trips and {1} locations into {2}".format(
+        len(data["trip_guids"]), len(data["locations"]), common.scratch_database_name()))
+
+    before = run_lookups(cursor, data, args.calls, random.Random(1), v1_get_locations)
+
+    migrations.migrate(cursor)
+
+    after = run_lookups(cursor, data, args.calls, random.Random(1))
+
+    print("{0:<18}{1:>14}{2:>14}{3:>14}{4:>14}".format("function", "p50 before", "p50 after", "p95 before",
+                                                       "p95 after"))
+    for (name, old), (_, new) in zip(before, after):
+        print("{0:<18}{1:>12.3f}ms{2:>12.3f}ms{3:>12.3f}ms{4:>12.3f}ms".format(
+            name, old["p50_ms"], new["p50_ms"], old["p95_ms"], new["p95_ms"]))
+
+    cursor.close()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
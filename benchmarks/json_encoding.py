@@ -0,0 +1,93 @@
+"""
+Cost of encoding a trip's locations: the old as_dicts + json.dumps(default=jsonDefault) path against
+travelapp.jsonutil, with the standard library and with orjson (when installed), the script_dumps used by
+the trip page and the chunked encoder used by /tripLocations.  Without orjson, jsonutil is expected to
+cost about the same as the old path; orjson is the speed up.
+
+    python -m benchmarks.json_encoding [--locations 5000] [--repeat 20]
+"""
+import argparse
+import datetime
+import decimal
+import json
+import time
+import tracemalloc
+
+from travelapp import dbutil, jsonutil
+
+
+def make_locations(count):
+    today = datetime.date.today()
+    return [dbutil.Location(idx, 1, "%032x" % idx, "Stop {0}".format(idx), decimal.Decimal("42.2780"),
+                            decimal.Decimal("-83.7382"), today, today, "https://example.com/{0}".format(idx))
+            for idx in range(count)]
+
+
+def json_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError(repr(obj))
+
+
+def old_dumps(locations):
+    return json.dumps(dbutil.as_dicts(locations), default=json_default)
+
+
+def stdlib_dumps(locations):
+    orjson, jsonutil.orjson = jsonutil.orjson, None
+    try:
+        return jsonutil.dumps(locations)
+    finally:
+        jsonutil.orjson = orjson
+
+
+def script(locations):
+    jsonutil.script_dumps(locations)
+
+
+def chunked(locations):
+    for _ in jsonutil.iterencode(locations):
+        pass
+
+
+def measure(encode, locations, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        encode(locations)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    encode(locations)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best * 1000, peak / 1024.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--locations", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    locations = make_locations(args.locations)
+
+    encoders = [("json.dumps + as_dicts", old_dumps), ("jsonutil (json)", stdlib_dumps)]
+    if jsonutil.orjson is not None:
+        encoders.append(("jsonutil (orjson)", jsonutil.dumps))
+    encoders.append(("jsonutil.script_dumps", script))
+    encoders.append(("jsonutil.iterencode", chunked))
+
+    print("{0} locations".format(args.locations))
+    print("{0:<24}{1:>10}{2:>16}".format("encoder", "ms", "peak KiB"))
+    for name, encode in encoders:
+        ms, peak = measure(encode, locations, args.repeat)
+        print("{0:<24}{1:>10.2f}{2:>16.1f}".format(name, ms, peak))
+
+
+if __name__ == "__main__":
+    main()
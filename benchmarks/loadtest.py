@@ -0,0 +1,359 @@
+"""
+End-to-end load test of the Flask routes.
+
+Seeds a scratch database at the latest schema version, serves the real application from a threaded
+server on localhost, logs in synthetic users and drives these routes from concurrent clients:
+
+    index         GET  /
+    trip          GET  /trip/<guid>
+    reorder       POST /reorderLocations/<guid>    (one location moved)
+    new_location  POST /newShortLocation/<guid>
+    add_to_group  POST /addToGroup
+
+Each user only writes to the trips and groups it owns, and only adds users who were not members of
+the group when it was seeded, so no owner is ever demoted.  Reports p50/p95/p99 latency and throughput
+per route, requests which got no response and those answered with a status other than 2xx or 3xx,
+the queries each request ran and how long it waited for a pooled connection, and saves the results
+as JSON so runs on different commits can be compared.  Everything runs on this machine.
+
+    python -m benchmarks.loadtest [--users 16] [--duration 30] [--output FILE] [--compare OLD_FILE]
+"""
+import argparse
+import collections
+import datetime
+import http.client
+import json
+import random
+import subprocess
+import threading
+import time
+from urllib.parse import urlencode
+
+import sqlalchemy.pool
+import werkzeug.serving
+
+from travelapp import dbutil, migrations
+
+from . import common
+
+ROUTE_WEIGHTS = [("index", 30), ("trip", 40), ("reorder", 10), ("new_location", 10), ("add_to_group", 10)]
+
+Sample = collections.namedtuple("Sample", ["route", "status", "seconds", "queries", "pool_wait"])
+
+
+class Client(object):
+    """An HTTP client with its own session cookie, i.e. one logged in user"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.cookie = None
+
+    def request(self, route, method, path, fields=None):
+        """:return: (Sample, response body)"""
+        headers = {}
+        form = None
+        if fields is not None:
+            form = urlencode(fields, doseq=True)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.cookie:
+            headers["Cookie"] = self.cookie
+
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, form, headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError):
+            return Sample(route, 0, time.perf_counter() - start, 0, 0.0), None
+        finally:
+            conn.close()
+        elapsed = time.perf_counter() - start
+
+        cookie = response.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+
+        sample = Sample(route, response.status, elapsed, int(response.getheader("X-DB-Queries", 0)),
+                        float(response.getheader("X-DB-Pool-Wait", 0.0)) / 1000)
+        return sample, body
+
+
+class User(object):
+    """The requests one synthetic user makes"""
+
+    def __init__(self, username, read_trips, owned_groups, orders, reader_permission, non_members, rng):
+        self.username = username
+        self.read_trips = read_trips
+        self.owned_groups = owned_groups
+        # Current location order of each trip this user writes to
+        self.orders = orders
+        self.reader_permission = reader_permission
+        # Usernames which were not members of each owned group when it was seeded.  Adding one of them
+        # again only sets the READER permission it already has.
+        self.non_members = non_members
+        self.rng = rng
+
+    def next_request(self, route):
+        """:return: (method, path, form fields or None, trip guid of a new location or None)"""
+        rng = self.rng
+
+        if route == "index":
+            return "GET", "/", None, None
+
+        if route == "trip":
+            return "GET", "/trip/{0}".format(rng.choice(self.read_trips)), None, None
+
+        if route == "add_to_group":
+            group_guid = rng.choice(self.owned_groups)
+            return "POST", "/addToGroup", {
+                "group": group_guid,
+                "names": rng.choice(self.non_members[group_guid]),
+                "permission": self.reader_permission,
+            }, None
+
+        trip_guid = rng.choice(sorted(self.orders))
+        order = self.orders[trip_guid]
+
+        if route == "reorder" and len(order) > 1:
+            order.insert(rng.randrange(len(order)), order.pop(rng.randrange(len(order))))
+            return "POST", "/reorderLocations/{0}".format(trip_guid), {"locations[]": order}, None
+
+        location = ["Load test stop", rng.uniform(-60, 60), rng.uniform(-180, 180)]
+        return "POST", "/newShortLocation/{0}".format(trip_guid), {"location[]": location}, trip_guid
+
+
+def prepare_database(args):
+    """
+    Seed the scratch database and point the application at it.
+
+    :return: list of User
+    """
+    conn = common.scratch_connection()
+    cursor = conn.cursor()
+
+    migrations.migrate(cursor)
+    data = common.seed(cursor, users=args.seed_users, groups=args.groups, trips_per_group=args.trips_per_group,
+                       locations_per_trip=args.locations_per_trip)
+
+    # The seed leaves positions and geohashes unset; keep the insert order
+    cursor.execute("UPDATE locations SET position = location_id * %s", dbutil.POSITION_GAP)
+    migrations.backfill_geohashes(cursor)
+
+    cursor.execute("SELECT permission_id FROM permissions WHERE name = %s", "READER")
+    reader_permission = cursor.fetchone()[0]
+
+    cursor.execute("""
+        SELECT users.username, groups.guid, trips.guid
+        FROM users
+        JOIN group_members USING (user_id)
+        JOIN groups USING (group_id)
+        JOIN trips USING (group_id)
+    """)
+    read_trips = collections.defaultdict(list)
+    group_trips = collections.defaultdict(set)
+    for username, group_guid, trip_guid in cursor.fetchall():
+        read_trips[username].append(trip_guid)
+        group_trips[group_guid].add(trip_guid)
+
+    conn.commit()
+    cursor.close()
+    conn.close()
+
+    trip_locations = collections.defaultdict(list)
+    for trip_guid, location_guid in data["locations"]:
+        trip_locations[trip_guid].append(location_guid)
+
+    owned = collections.defaultdict(list)
+    for group_guid, username in data["owners"].items():
+        owned[username].append(group_guid)
+
+    members = collections.defaultdict(set)
+    for username, group_guid in data["memberships"]:
+        members[group_guid].add(username)
+
+    rng = random.Random(args.seed)
+    usernames = sorted(owned)
+    rng.shuffle(usernames)
+
+    users = []
+    for username in usernames[:args.users]:
+        orders = dict((trip_guid, list(trip_locations[trip_guid]))
+                      for group_guid in owned[username] for trip_guid in group_trips[group_guid])
+        non_members = dict((group_guid, [name for name in data["usernames"] if name not in members[group_guid]])
+                           for group_guid in owned[username])
+        users.append(User(username, read_trips[username], owned[username], orders, reader_permission,
+                          non_members, random.Random(rng.random())))
+
+    dbutil.backend = common.scratch_backend()
+    dbutil.conn_pool = sqlalchemy.pool.QueuePool(dbutil.new_connection, pool_size=args.pool_size,
+                                                 max_overflow=args.max_overflow)
+
+    return users
+
+
+def start_server():
+    from travelapp.first import app
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['DB_STATS_HEADERS'] = True
+
+    server = werkzeug.serving.make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name="loadtest-server")
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+def run_user(user, client, measure_from, deadline, samples):
+    routes = [route for route, _ in ROUTE_WEIGHTS]
+    weights = [weight for _, weight in ROUTE_WEIGHTS]
+
+    while time.perf_counter() < deadline:
+        route = user.rng.choices(routes, weights)[0]
+        method, path, fields, new_location_trip = user.next_request(route)
+        sample, body = client.request(route, method, path, fields)
+
+        # Keep the user's copy of the order complete, so its reorders stay single moves
+        if new_location_trip and sample.status == 200:
+            user.orders[new_location_trip].append(json.loads(body.decode('utf-8'))["guid"])
+
+        if time.perf_counter() >= measure_from:
+            samples.append(sample)
+
+
+def summarize(samples, elapsed):
+    latencies = [sample.seconds * 1000 for sample in samples]
+    waits = [sample.pool_wait * 1000 for sample in samples]
+    count = len(samples)
+
+    # Status 0 is a request which got no response at all
+    bad_statuses = collections.Counter(str(sample.status) for sample in samples
+                                       if sample.status and not 200 <= sample.status < 400)
+
+    return {
+        "requests": count,
+        "errors": sum(1 for sample in samples if not sample.status),
+        "bad_status": sum(bad_statuses.values()),
+        "statuses": dict(bad_statuses),
+        "throughput_rps": count / elapsed if elapsed else 0.0,
+        "p50_ms": common.percentile(latencies, 0.50),
+        "p95_ms": common.percentile(latencies, 0.95),
+        "p99_ms": common.percentile(latencies, 0.99),
+        "queries_per_request": float(sum(sample.queries for sample in samples)) / count if count else 0.0,
+        "pool_wait_mean_ms": sum(waits) / count if count else 0.0,
+        "pool_wait_p95_ms": common.percentile(waits, 0.95),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"]).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print("{0:<14}{1:>9}{2:>8}{3:>8}{4:>9}{5:>10}{6:>10}{7:>10}{8:>9}{9:>11}".format(
+        "route", "requests", "errors", "4xx/5xx", "req/s", "p50 ms", "p95 ms", "p99 ms", "queries", "wait ms"))
+
+    rows = sorted(results["routes"].items()) + [("all", results["overall"])]
+    for name, stats in rows:
+        print("{0:<14}{1:>9}{2:>8}{3:>8}{4:>9.1f}{5:>10.2f}{6:>10.2f}{7:>10.2f}{8:>9.2f}{9:>11.3f}".format(
+            name, stats["requests"], stats["errors"], stats["bad_status"], stats["throughput_rps"], stats["p50_ms"],
+            stats["p95_ms"], stats["p99_ms"], stats["queries_per_request"], stats["pool_wait_mean_ms"]))
+
+    for name, stats in sorted(results["routes"].items()):
+        if stats["statuses"]:
+            counts = sorted(stats["statuses"].items())
+            print("{0} answered {1}".format(name, ", ".join("{0} x{1}".format(*count) for count in counts)))
+
+
+def print_comparison(old, new):
+    print("\nAgainst {0} ({1}):".format(old.get("commit"), old.get("started")))
+    print("{0:<14}{1:>12}{2:>12}{3:>9}{4:>12}{5:>12}{6:>9}".format(
+        "route", "p50 before", "p50 after", "change", "p95 before", "p95 after", "change"))
+
+    rows = sorted(new["routes"].items()) + [("all", new["overall"])]
+    for name, stats in rows:
+        before = old["overall"] if name == "all" else old["routes"].get(name)
+        if not before:
+            continue
+
+        changes = []
+        for key in ("p50_ms", "p95_ms"):
+            changes.append((stats[key] - before[key]) / before[key] * 100 if before[key] else 0.0)
+        print("{0:<14}{1:>12.2f}{2:>12.2f}{3:>8.1f}%{4:>12.2f}{5:>12.2f}{6:>8.1f}%".format(
+            name, before["p50_ms"], stats["p50_ms"], changes[0], before["p95_ms"], stats["p95_ms"], changes[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=16, help="concurrent logged in users")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=5.0, help="seconds run before measuring")
+    parser.add_argument("--pool-size", type=int, default=30)
+    parser.add_argument("--max-overflow", type=int, default=10)
+    parser.add_argument("--seed-users", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=100)
+    parser.add_argument("--trips-per-group", type=int, default=5)
+    parser.add_argument("--locations-per-trip", type=int, default=40)
+    parser.add_argument("--seed", type=int, default=1, help="random seed of the request mix")
+    parser.add_argument("--output", help="JSON results file, by default loadtest-<commit>.json")
+    parser.add_argument("--compare", help="earlier JSON results file to compare against")
+    args = parser.parse_args()
+
+    users = prepare_database(args)
+    server = start_server()
+    print("Serving {0} on port {1}, {2} users".format(common.scratch_database_name(), server.server_port, len(users)))
+
+    clients = []
+    for user in users:
+        client = Client("127.0.0.1", server.server_port)
+        sample, _ = client.request("login", "POST", "/login", {"username": user.username, "password": common.PASSWORD})
+        if sample.status != 302:
+            raise SystemExit("Login of {0} failed with status {1}".format(user.username, sample.status))
+        clients.append(client)
+
+    samples = []
+    started = datetime.datetime.now()
+    measure_from = time.perf_counter() + args.warmup
+    deadline = measure_from + args.duration
+
+    threads = [threading.Thread(target=run_user, args=(user, client, measure_from, deadline, samples))
+               for user, client in zip(users, clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    server.shutdown()
+
+    by_route = collections.defaultdict(list)
+    for sample in samples:
+        by_route[sample.route].append(sample)
+
+    results = {
+        "commit": git_commit(),
+        "started": started.isoformat(),
+        "settings": vars(args),
+        "routes": dict((route, summarize(route_samples, args.duration)) for route, route_samples in by_route.items()),
+        "overall": summarize(samples, args.duration),
+    }
+
+    print_results(results)
+
+    output = args.output or "loadtest-{0}.json".format(results["commit"] or started.strftime("%Y%m%d%H%M%S"))
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2, sort_keys=True)
+    print("Saved {0}".format(output))
+
+    if args.compare:
+        with open(args.compare) as compare_file:
+            print_comparison(json.load(compare_file), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Time of a nearby-locations search over millions of stored points.
+
+Points are scattered around the places in the repository's coordinates file.  A stand-in cursor
+answers the geohash range conditions from a sorted list the way the index does, so the timing
+covers the cell covering, candidate scan and vectorized ranking, without the MySQL round trip.
+
+    python -m benchmarks.nearby [--points 2000000] [--radius 500 2000 10000]
+"""
+import argparse
+import bisect
+import os
+import random
+import re
+import time
+
+from travelapp import dbutil, geo
+
+COORDINATES_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "coordinates")
+
+
+def load_places():
+    places = []
+    with open(COORDINATES_FILE) as coordinates:
+        for line in coordinates:
+            match = re.search(r"(-?\d+\.\d+),\s*(-?\d+\.\d+)", line)
+            if match:
+                places.append((float(match.group(1)), float(match.group(2))))
+    return places
+
+
+class GeohashIndexCursor(object):
+    """Answers find_nearby_locations' queries from rows sorted by geohash"""
+
+    def __init__(self, rows):
+        self.rows = sorted(rows)
+        self.keys = [row[0] for row in self.rows]
+        self.by_id = dict((row[1][0], row[1]) for row in self.rows)
+        self.result = []
+        self.candidates = 0
+
+    def execute(self, sql, params):
+        if "IN (" in sql:
+            wanted = set(params)
+            self.result = [self.by_id[location_id] for location_id in wanted]
+            return
+
+        ranges, (south, north) = params[1:-2], params[-2:]
+        self.result = []
+        for low, high in zip(ranges[::2], ranges[1::2]):
+            start = bisect.bisect_left(self.keys, low)
+            end = bisect.bisect_right(self.keys, high)
+            self.result.extend(row[1][:1] + row[1][4:6] for row in self.rows[start:end]
+                               if south <= row[1][4] <= north)
+        self.candidates += len(self.result)
+
+    def fetchall(self):
+        return self.result
+
+
+def make_rows(places, count):
+    rows = []
+    for idx in range(count):
+        latitude, longitude = random.choice(places)
+        latitude += random.gauss(0, 0.05)
+        longitude += random.gauss(0, 0.05)
+        row = (idx, 1, "%032x" % idx, "Stop {0}".format(idx), latitude, longitude, None, None, None, "trip", "Trip")
+        rows.append((geo.geohash(latitude, longitude), row))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, default=2000000)
+    parser.add_argument("--radius", type=float, nargs="+", default=[500, 2000, 10000])
+    parser.add_argument("--searches", type=int, default=50)
+    args = parser.parse_args()
+
+    places = load_places()
+    print("Generating {0} points around {1} places".format(args.points, len(places)))
+    cursor = GeohashIndexCursor(make_rows(places, args.points))
+
+    print("{0:>10}{1:>14}{2:>12}{3:>10}{4:>10}".format("radius m", "candidates", "results", "p50 ms", "max ms"))
+    for radius in args.radius:
+        timings = []
+        candidates = results = 0
+        for _ in range(args.searches):
+            latitude, longitude = random.choice(places)
+            cursor.candidates = 0
+            start = time.perf_counter()
+            found = dbutil.find_nearby_locations(cursor, "benchmark", latitude, longitude, radius, limit=100)
+            timings.append((time.perf_counter() - start) * 1000)
+            candidates += cursor.candidates
+            results += len(found)
+
+        timings.sort()
+        print("{0:>10.0f}{1:>14.0f}{2:>12.0f}{3:>10.2f}{4:>10.2f}".format(
+            radius, float(candidates) / args.searches, float(results) / args.searches,
+            timings[len(timings) // 2], timings[-1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Login throughput per password hashing cost.
+
+Simulates concurrent request threads verifying passwords through the hashing process pool and
+reports logins per second for each hasher setting.
+
+    python -m benchmarks.password_hashing [--logins 200] [--threads 16] [--workers N]
+"""
+import argparse
+import concurrent.futures
+import os
+import time
+
+from travelapp import passwords
+
+SETTINGS = [
+    passwords.Sha256Hasher(),
+    passwords.Pbkdf2Hasher(100000),
+    passwords.Pbkdf2Hasher(260000),
+    passwords.Pbkdf2Hasher(600000),
+    passwords.ScryptHasher(2 ** 14, 8, 1),
+    passwords.ScryptHasher(2 ** 15, 8, 1),
+]
+
+
+def logins_per_second(hasher, logins, threads, workers):
+    salt = "benchmark-salt"
+    password = "benchmark-password"
+    encoded = hasher.encode(salt, password)
+
+    pool = passwords.HashingPool(max_workers=workers, hasher=hasher)
+    # Start the worker processes before timing
+    pool.verify(salt, password, encoded)
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as requests:
+        results = list(requests.map(lambda _: pool.verify(salt, password, encoded), range(logins)))
+    elapsed = time.perf_counter() - start
+
+    pool.shutdown()
+    assert all(valid for valid, _ in results)
+
+    return logins / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=16, help="concurrent request threads")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="hashing processes, 0 for inline")
+    args = parser.parse_args()
+
+    print("{0:<32}{1:>14}".format("hasher", "logins/sec"))
+    for hasher in SETTINGS:
+        rate = logins_per_second(hasher, args.logins, args.threads, args.workers)
+        print("{0:<32}{1:>14.1f}".format(repr(hasher), rate))
+
+
+if __name__ == "__main__":
+    main()
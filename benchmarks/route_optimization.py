@@ -0,0 +1,36 @@
+"""
+Time and path length of routing.optimize_order for trips of random stops.
+
+    python -m benchmarks.route_optimization [--stops 100 500 1000 2000]
+"""
+import argparse
+import random
+import time
+
+from travelapp import dbutil, routing
+
+
+def make_locations(count):
+    return [dbutil.Location(idx, 1, "%032x" % idx, "Stop {0}".format(idx), 42.0 + random.uniform(-1, 1),
+                            -83.0 + random.uniform(-1, 1), None, None, None) for idx in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stops", type=int, nargs="+", default=[100, 500, 1000, 2000])
+    parser.add_argument("--budget", type=float, default=routing.TIME_BUDGET, help="2-opt time budget, seconds")
+    args = parser.parse_args()
+
+    print("{0:>8}{1:>12}{2:>16}{3:>16}".format("stops", "seconds", "current km", "suggested km"))
+    for count in args.stops:
+        locations = make_locations(count)
+
+        start = time.perf_counter()
+        _, _, length, suggested_length = routing.optimize_order(locations, args.budget)
+        elapsed = time.perf_counter() - start
+
+        print("{0:>8}{1:>12.3f}{2:>16.1f}{3:>16.1f}".format(count, elapsed, length / 1000, suggested_length / 1000))
+
+
+if __name__ == "__main__":
+    main()
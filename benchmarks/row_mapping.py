@@ -0,0 +1,100 @@
+"""
+Per-row cost of mapping location rows: the old fetchone()-and-dict loop against batched records.
+
+Runs against an in-memory stand-in cursor, so it measures only the Python side of a query.
+
+    python -m benchmarks.row_mapping [--rows 1000 5000 20000]
+"""
+import argparse
+import datetime
+import time
+import tracemalloc
+
+from travelapp import dbutil
+
+
+class ListCursor(object):
+    """Minimal cursor serving pre-built rows, the way a buffered PyMySQL cursor does"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.position = 0
+
+    def fetchone(self):
+        if self.position >= len(self.rows):
+            return None
+        row = self.rows[self.position]
+        self.position += 1
+        return row
+
+    def fetchmany(self, size):
+        rows = self.rows[self.position:self.position + size]
+        self.position += len(rows)
+        return rows
+
+
+def make_rows(count):
+    today = datetime.date.today()
+    return [(idx, 1, "%032x" % idx, "Stop {0}".format(idx), 42.278067, -83.738278, today, today,
+             "https://example.com/{0}".format(idx)) for idx in range(count)]
+
+
+def dict_rows(cursor):
+    location_list = []
+    location = cursor.fetchone()
+
+    while location is not None:
+        location_list.append({
+            "location_id": location[0],
+            "trip_id": location[1],
+            "guid": location[2],
+            "title": location[3],
+            "latitude": location[4],
+            "longitude": location[5],
+            "arrivalDate": location[6],
+            "departureDate": location[7],
+            "url": location[8]
+        })
+        location = cursor.fetchone()
+
+    return location_list
+
+
+def record_rows(cursor):
+    return dbutil.fetch_records(cursor, dbutil.Location)
+
+
+def measure(mapper, rows, repeat):
+    best = None
+    for _ in range(repeat):
+        cursor = ListCursor(rows)
+        start = time.perf_counter()
+        mapper(cursor)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    result = mapper(ListCursor(rows))
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return best * 1e9 / len(rows), float(allocated) / len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print("{0:>8}  {1:<8}{2:>12}{3:>14}".format("rows", "mapping", "ns/row", "bytes/row"))
+    for count in args.rows:
+        rows = make_rows(count)
+        for name, mapper in (("dict", dict_rows), ("record", record_rows)):
+            ns_per_row, bytes_per_row = measure(mapper, rows, args.repeat)
+            print("{0:>8}  {1:<8}{2:>12.1f}{3:>14.1f}".format(count, name, ns_per_row, bytes_per_row))
+
+
+if __name__ == "__main__":
+    main()
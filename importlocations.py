@@ -0,0 +1,28 @@
+import argparse
+import sys
+
+from travelapp import dbutil, importer
+
+parser = argparse.ArgumentParser(description="Append the locations in a CSV, GPX or coordinates file to a trip")
+parser.add_argument("trip_guid")
+parser.add_argument("path")
+parser.add_argument("--format", choices=sorted(importer.PARSERS), help="file format, by default from the extension")
+parser.add_argument("--batch-size", type=int, default=dbutil.INSERT_BATCH_SIZE, help="rows per INSERT")
+args = parser.parse_args()
+
+conn = dbutil.new_connection()
+
+cur = conn.cursor()
+
+try:
+    file_format = args.format or importer.detect_format(args.path)
+    with open(args.path, "rb") as stream:
+        count, seconds = importer.import_locations(cur, args.trip_guid, stream, file_format, args.batch_size)
+except ValueError as e:
+    print("Import failed, nothing was imported: {0}".format(e))
+    sys.exit(1)
+finally:
+    cur.close()
+    conn.close()
+
+print("Imported {0} locations in {1:.2f}s ({2:.0f} rows/sec)".format(count, seconds, count / max(seconds, 1e-6)))
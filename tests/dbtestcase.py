@@ -0,0 +1,86 @@
+"""
+Base class for tests of dbutil functions, run against a fresh SQLite database at the latest schema version.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from travelapp import backends, dbutil, migrations
+
+
+class DatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = backends.SQLiteBackend(os.path.join(self.directory, "test.sqlite3"))
+        self.saved_backend, dbutil.backend = dbutil.backend, self.backend
+        self.conn = self.backend.connect()
+        self.cursor = self.conn.cursor()
+        migrations.migrate(self.cursor)
+        dbutil.permission_cache.clear()
+
+    def tearDown(self):
+        self.cursor.close()
+        self.conn.close()
+        dbutil.backend = self.saved_backend
+        shutil.rmtree(self.directory)
+
+    def add_user(self, username):
+        self.cursor.execute("""
+            INSERT INTO users (guid, username, firstname, lastname, email, verified, hashed_password, salt)
+            VALUES (%s, %s, 'First', 'Last', %s, 1, 'x', 'x')
+        """, (dbutil.get_guid(), username, username + "@example.com"))
+        return self.cursor.lastrowid
+
+    def add_group(self, name, members=()):
+        """
+        :param members: (user_id, permission name) pairs
+        :return: group guid
+        """
+        guid = dbutil.get_guid()
+        self.cursor.execute("INSERT INTO groups (guid, name) VALUES (%s, %s)", (guid, name))
+        group_id = self.cursor.lastrowid
+
+        for user_id, permission in members:
+            self.cursor.execute("""
+                INSERT INTO group_members (group_id, user_id, permission_id)
+                SELECT %s, %s, permission_id FROM permissions WHERE name = %s
+            """, (group_id, user_id, permission))
+
+        return guid
+
+    def add_trip(self, group_guid, title, positions=()):
+        """
+        :param positions: position of each location to add, in insert order
+        :return: (trip guid, list of location guids)
+        """
+        guid = dbutil.get_guid()
+        self.cursor.execute("""
+            INSERT INTO trips (group_id, guid, title)
+            SELECT group_id, %s, %s FROM groups WHERE guid = %s
+        """, (guid, title, group_guid))
+        trip_id = self.cursor.lastrowid
+
+        location_guids = []
+        for idx, position in enumerate(positions):
+            location_guid = dbutil.get_guid()
+            self.cursor.execute("""
+                INSERT INTO locations (trip_id, guid, title, latitude, longitude, position)
+                VALUES (%s, %s, %s, 42.0, -83.0, %s)
+            """, (trip_id, location_guid, "Stop {0}".format(idx), position))
+            location_guids.append(location_guid)
+
+        self.conn.commit()
+        return guid, location_guids
+
+    def positions(self, trip_guid):
+        """:return: list of (location guid, position), in order"""
+        self.cursor.execute("""
+            SELECT locations.guid, locations.position
+            FROM locations
+            JOIN trips USING (trip_id)
+            WHERE trips.guid = %s
+            ORDER BY locations.position
+        """, trip_guid)
+        return [tuple(row) for row in self.cursor.fetchall()]
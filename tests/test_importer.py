@@ -0,0 +1,58 @@
+"""
+Parsing of location import files.
+"""
+import io
+import unittest
+
+from travelapp import importer
+
+
+def parse(text, file_format):
+    return list(importer.parse(io.BytesIO(text.encode('utf-8')), file_format))
+
+
+class ImporterTest(unittest.TestCase):
+
+    def test_csv(self):
+        locations = parse("name,lat,lng,url\nHome,42.28,-83.74,https://example.com\n", "csv")
+
+        self.assertEqual(len(locations), 1)
+        self.assertEqual((locations[0].title, locations[0].latitude, locations[0].url),
+                         ("Home", 42.28, "https://example.com"))
+
+    def test_coordinates(self):
+        locations = parse("Ann Arbor 42.28, -83.74\n\nDetroit 42.33, -83.05\n", "coordinates")
+
+        self.assertEqual([location.title for location in locations], ["Ann Arbor", "Detroit"])
+
+    def test_long_title_is_truncated(self):
+        locations = parse("name,lat,lng\n{0},1,2\n".format("x" * 200), "csv")
+
+        self.assertEqual(len(locations[0].title), importer.MAX_TITLE_LENGTH)
+
+    def test_url_at_limit_is_kept(self):
+        url = "https://example.com/" + "x" * (importer.MAX_URL_LENGTH - 20)
+        locations = parse("name,lat,lng,url\nHome,1,2,{0}\n".format(url), "csv")
+
+        self.assertEqual(locations[0].url, url)
+
+    def test_long_url_is_rejected_with_its_line(self):
+        url = "https://example.com/" + "x" * importer.MAX_URL_LENGTH
+
+        with self.assertRaisesRegex(ValueError, "Line 3: url longer than 256 characters"):
+            parse("name,lat,lng,url\nHome,1,2,\nAway,3,4,{0}\n".format(url), "csv")
+
+    def test_long_gpx_link_is_rejected(self):
+        url = "https://example.com/" + "x" * importer.MAX_URL_LENGTH
+        gpx = '<gpx><wpt lat="1" lon="2"><name>Home</name><link href="{0}"/></wpt></gpx>'.format(url)
+
+        with self.assertRaisesRegex(ValueError, "url longer"):
+            parse(gpx, "gpx")
+
+    def test_invalid_coordinates(self):
+        with self.assertRaisesRegex(ValueError, "Line 2: coordinates out of range"):
+            parse("name,lat,lng\nHome,91,0\n", "csv")
+
+
+if __name__ == "__main__":
+    unittest.main()
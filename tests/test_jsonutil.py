@@ -0,0 +1,73 @@
+"""
+jsonutil output with the standard library json module and, when it is installed, with orjson.
+"""
+import datetime
+import decimal
+import json
+import unittest
+from collections import namedtuple
+
+from travelapp import jsonutil
+
+Point = namedtuple("Point", ["name", "latitude", "when", "raw"])
+Stop = namedtuple("Stop", ["title", "points"])
+
+POINT = Point("Ann Arbor", decimal.Decimal("42.2780"), datetime.date(2017, 6, 1), b"x")
+EXPECTED_POINT = {"name": "Ann Arbor", "latitude": 42.278, "when": "2017-06-01", "raw": "x"}
+
+
+class JsonUtilTest(unittest.TestCase):
+    """Runs every check on the standard library backend; OrjsonTest runs them again on orjson"""
+
+    backend = None
+
+    def setUp(self):
+        self.saved, jsonutil.orjson = jsonutil.orjson, self.backend
+
+    def tearDown(self):
+        jsonutil.orjson = self.saved
+
+    def assertEncodes(self, value, expected):
+        self.assertEqual(json.loads(jsonutil.dumps(value)), expected)
+
+    def test_record(self):
+        self.assertEncodes(POINT, EXPECTED_POINT)
+
+    def test_list_of_records(self):
+        self.assertEncodes([POINT, POINT], [EXPECTED_POINT, EXPECTED_POINT])
+
+    def test_nested_records(self):
+        self.assertEncodes({"x": [POINT], "y": {"z": POINT}}, {"x": [EXPECTED_POINT], "y": {"z": EXPECTED_POINT}})
+        self.assertEncodes([1, POINT], [1, EXPECTED_POINT])
+        self.assertEncodes(Stop("first", [POINT]), {"title": "first", "points": [EXPECTED_POINT]})
+
+    def test_plain_tuple_is_an_array(self):
+        self.assertEncodes({"x": (1, 2)}, {"x": [1, 2]})
+
+    def test_iterencode(self):
+        records = [POINT] * 7
+        self.assertEqual(json.loads("".join(jsonutil.iterencode(records, chunk_size=3))), [EXPECTED_POINT] * 7)
+        self.assertEqual("".join(jsonutil.iterencode([])), "[]")
+
+    def test_script_dumps(self):
+        text = jsonutil.script_dumps({"title": u"</script><!-- \u2028"})
+
+        self.assertNotIn("<", text)
+        self.assertNotIn(u"\u2028", text)
+        self.assertEqual(json.loads(text), {"title": u"</script><!-- \u2028"})
+
+
+@unittest.skipIf(jsonutil.orjson is None, "orjson is not installed")
+class OrjsonTest(JsonUtilTest):
+    backend = jsonutil.orjson
+
+    def test_same_output_as_json(self):
+        value = {"stops": [Stop("first", [POINT])], "count": 1}
+        encoded = jsonutil.dumps(value)
+
+        jsonutil.orjson = None
+        self.assertEqual(encoded, jsonutil.dumps(value))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+"""
+Moving a trip's locations: find_moved_location and the position arithmetic of move_location.
+"""
+import unittest
+
+from travelapp import dbutil
+from travelapp.migrations import POSITION_GAP
+
+from dbtestcase import DatabaseTestCase
+
+
+class FindMovedLocationTest(unittest.TestCase):
+
+    def test_moved_to_front(self):
+        self.assertEqual(dbutil.find_moved_location(list("abcd"), list("dabc")), ("d", "a"))
+
+    def test_moved_towards_start(self):
+        self.assertEqual(dbutil.find_moved_location(list("abcd"), list("adbc")), ("d", "b"))
+
+    def test_swap_of_neighbours_moves_the_first(self):
+        self.assertEqual(dbutil.find_moved_location(list("abcd"), list("acbd")), ("b", "d"))
+
+    def test_moved_towards_end(self):
+        self.assertEqual(dbutil.find_moved_location(list("abcd"), list("bcad")), ("a", "d"))
+
+    def test_moved_to_end(self):
+        self.assertEqual(dbutil.find_moved_location(list("abcd"), list("bcda")), ("a", None))
+
+    def test_not_a_single_move(self):
+        self.assertIsNone(dbutil.find_moved_location(list("abcd"), list("abcd")))
+        self.assertIsNone(dbutil.find_moved_location(list("abcd"), list("badc")))
+        self.assertIsNone(dbutil.find_moved_location(list("abcd"), list("abc")))
+
+
+class MoveLocationTest(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.group = self.add_group("Group")
+
+    def trip(self, positions):
+        self.trip_guid, guids = self.add_trip(self.group, "Trip", positions)
+        return guids
+
+    def test_move_to_front(self):
+        a, b, c, d = self.trip([POSITION_GAP * n for n in range(1, 5)])
+
+        dbutil.move_location(self.cursor, self.trip_guid, d, a)
+
+        self.assertEqual(self.positions(self.trip_guid),
+                         [(d, POSITION_GAP // 2), (a, POSITION_GAP), (b, 2 * POSITION_GAP), (c, 3 * POSITION_GAP)])
+
+    def test_move_to_middle(self):
+        a, b, c, d = self.trip([POSITION_GAP * n for n in range(1, 5)])
+
+        dbutil.move_location(self.cursor, self.trip_guid, a, c)
+
+        self.assertEqual(self.positions(self.trip_guid),
+                         [(b, 2 * POSITION_GAP), (a, 5 * POSITION_GAP // 2), (c, 3 * POSITION_GAP),
+                          (d, 4 * POSITION_GAP)])
+
+    def test_move_to_end(self):
+        a, b, c, d = self.trip([POSITION_GAP * n for n in range(1, 5)])
+
+        dbutil.move_location(self.cursor, self.trip_guid, a)
+
+        self.assertEqual(self.positions(self.trip_guid),
+                         [(b, 2 * POSITION_GAP), (c, 3 * POSITION_GAP), (d, 4 * POSITION_GAP), (a, 5 * POSITION_GAP)])
+
+    def test_used_up_gap_renumbers(self):
+        a, b, c = self.trip([1, 2, 3])
+
+        dbutil.move_location(self.cursor, self.trip_guid, c, b)
+
+        self.assertEqual(self.positions(self.trip_guid),
+                         [(a, POSITION_GAP), (c, 2 * POSITION_GAP), (b, 3 * POSITION_GAP)])
+
+    def test_used_up_gap_at_front_renumbers(self):
+        a, b, c = self.trip([1, 2, 3])
+
+        dbutil.move_location(self.cursor, self.trip_guid, c, a)
+
+        self.assertEqual(self.positions(self.trip_guid),
+                         [(c, POSITION_GAP), (a, 2 * POSITION_GAP), (b, 3 * POSITION_GAP)])
+
+    def test_repeated_moves_keep_order(self):
+        guids = self.trip([POSITION_GAP * n for n in range(1, 5)])
+        order = list(guids)
+
+        # Each move halves the gap in front of the first location, until it has to be renumbered
+        for _ in range(12):
+            order.insert(0, order.pop())
+            dbutil.insert_order(self.cursor, self.trip_guid, order)
+            self.assertEqual(dbutil.get_order(self.cursor, self.trip_guid), order)
+
+    def test_insert_order_moves_one_location(self):
+        a, b, c, d = self.trip([POSITION_GAP * n for n in range(1, 5)])
+
+        dbutil.insert_order(self.cursor, self.trip_guid, [a, d, b, c])
+
+        self.assertEqual(self.positions(self.trip_guid),
+                         [(a, POSITION_GAP), (d, 3 * POSITION_GAP // 2), (b, 2 * POSITION_GAP),
+                          (c, 3 * POSITION_GAP)])
+
+
+if __name__ == "__main__":
+    unittest.main()
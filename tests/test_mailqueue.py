@@ -0,0 +1,217 @@
+"""
+SmtpSession and MailDispatcher against a stand-in SMTP server on localhost.
+"""
+import socketserver
+import threading
+import time
+import unittest
+
+import smtplib
+
+from travelapp import mailqueue
+
+
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough SMTP for smtplib, with the replies scripted by the server's settings"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        self.reply("220 stub ready")
+
+        while True:
+            line = self.rfile.readline().decode("ascii").strip()
+            if not line:
+                return
+
+            command = line.split(" ", 1)[0].upper()
+            if command in ("EHLO", "HELO"):
+                self.reply("250 stub")
+            elif command == "MAIL":
+                self.reply("250 OK")
+            elif command == "RCPT":
+                server.rcpt_attempts += 1
+                code = server.rcpt_replies.pop(0) if server.rcpt_replies else 250
+                self.reply("{0} recipient {1}".format(code, "OK" if code == 250 else "rejected"))
+            elif command == "DATA":
+                self.reply("354 go ahead")
+                lines = []
+                while True:
+                    data = self.rfile.readline()
+                    if data in (b".\r\n", b""):
+                        break
+                    lines.append(data)
+                server.messages.append(b"".join(lines))
+                self.reply("250 queued")
+                if server.drop_after_message:
+                    return
+            elif command == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), StubSMTPHandler)
+        self.connections = 0
+        self.rcpt_attempts = 0
+        self.messages = []
+        # Reply codes for the next RCPT commands, 250 once exhausted
+        self.rcpt_replies = []
+        self.drop_after_message = False
+
+
+class FakeSession(object):
+    """SmtpSession stand-in which raises the error scripted for a message, and can be held up"""
+
+    def __init__(self, errors=None, release=None):
+        self.errors = errors or {}
+        self.release = release
+        self.started = threading.Event()
+        self.messages = []
+
+    def send(self, from_addr, to_addrs, message):
+        self.started.set()
+        if self.release is not None:
+            self.release.wait(5)
+        if message in self.errors:
+            raise self.errors[message]
+        self.messages.append(message)
+
+    def close(self):
+        pass
+
+
+class MailQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubSMTPServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def session(self):
+        return mailqueue.SmtpSession("127.0.0.1", self.server.server_address[1], starttls=False, timeout=5)
+
+    def test_connection_is_reused(self):
+        session = self.session()
+        session.send("app@example.com", ["a@example.com"], "Subject: one\r\n\r\nfirst")
+        session.send("app@example.com", ["b@example.com"], "Subject: two\r\n\r\nsecond")
+        session.close()
+
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(session.connects, 1)
+
+    def test_dropped_connection_is_replaced(self):
+        self.server.drop_after_message = True
+
+        session = self.session()
+        session.send("app@example.com", ["a@example.com"], "Subject: one\r\n\r\nfirst")
+        session.send("app@example.com", ["a@example.com"], "Subject: two\r\n\r\nsecond")
+        session.close()
+
+        self.assertEqual(len(self.server.messages), 2)
+        self.assertEqual(session.connects, 2)
+
+    def test_rejection_does_not_reconnect(self):
+        self.server.rcpt_replies = [550]
+
+        session = self.session()
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            session.send("app@example.com", ["nobody@example.com"], "Subject: one\r\n\r\nfirst")
+        session.close()
+
+        self.assertEqual(session.connects, 1)
+        self.assertEqual(self.server.rcpt_attempts, 1)
+
+    def test_permanent_failure_is_not_retried(self):
+        self.server.rcpt_replies = [550]
+        dispatcher = mailqueue.MailDispatcher(self.session, max_attempts=3, retry_delay=30.0)
+
+        start = time.time()
+        dispatcher.send("app@example.com", ["nobody@example.com"], "Subject: one\r\n\r\nfirst")
+        dispatcher.close()
+
+        self.assertLess(time.time() - start, 5.0)
+        self.assertEqual((dispatcher.sent, dispatcher.failed), (0, 1))
+        self.assertEqual(self.server.rcpt_attempts, 1)
+
+    def test_temporary_failure_is_retried(self):
+        self.server.rcpt_replies = [451]
+        dispatcher = mailqueue.MailDispatcher(self.session, max_attempts=3, retry_delay=0.01)
+
+        dispatcher.send("app@example.com", ["a@example.com"], "Subject: one\r\n\r\nfirst")
+        dispatcher.close()
+
+        self.assertEqual((dispatcher.sent, dispatcher.failed), (1, 0))
+        self.assertEqual(self.server.rcpt_attempts, 2)
+        self.assertEqual(len(self.server.messages), 1)
+
+    def test_retry_does_not_hold_up_queue(self):
+        self.server.rcpt_replies = [451]
+        dispatcher = mailqueue.MailDispatcher(self.session, max_attempts=2, retry_delay=1.0)
+
+        dispatcher.send("app@example.com", ["a@example.com"], "Subject: one\r\n\r\nfirst")
+        dispatcher.send("app@example.com", ["b@example.com"], "Subject: two\r\n\r\nsecond")
+
+        deadline = time.time() + 0.8
+        while not self.server.messages and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertIn(b"second", self.server.messages[0])
+
+        dispatcher.close()
+        self.assertEqual((dispatcher.sent, dispatcher.failed), (2, 0))
+
+    def test_unexpected_error_does_not_stop_worker(self):
+        session = FakeSession(errors={"broken": ValueError("bug")})
+        dispatcher = mailqueue.MailDispatcher(lambda: session, max_attempts=1)
+
+        dispatcher.send("app@example.com", ["a@example.com"], "broken")
+        dispatcher.send("app@example.com", ["a@example.com"], "fine")
+        dispatcher.close()
+
+        self.assertEqual(session.messages, ["fine"])
+        self.assertEqual((dispatcher.sent, dispatcher.failed), (1, 1))
+
+    def test_full_queue_drops_without_blocking(self):
+        release = threading.Event()
+        session = FakeSession(release=release)
+        dispatcher = mailqueue.MailDispatcher(lambda: session, max_queued=1)
+
+        self.assertTrue(dispatcher.send("app@example.com", ["a@example.com"], "first"))
+        self.assertTrue(session.started.wait(5))
+        self.assertTrue(dispatcher.send("app@example.com", ["a@example.com"], "second"))
+
+        start = time.time()
+        self.assertFalse(dispatcher.send("app@example.com", ["a@example.com"], "third"))
+        self.assertLess(time.time() - start, 1.0)
+
+        release.set()
+        dispatcher.close()
+        self.assertEqual(session.messages, ["first", "second"])
+        self.assertEqual(dispatcher.dropped, 1)
+
+    def test_error_classification(self):
+        self.assertTrue(mailqueue.is_connection_error(ConnectionResetError()))
+        self.assertTrue(mailqueue.is_connection_error(smtplib.SMTPServerDisconnected()))
+        self.assertFalse(mailqueue.is_connection_error(smtplib.SMTPDataError(554, b"rejected")))
+        self.assertTrue(mailqueue.is_permanent(smtplib.SMTPDataError(554, b"rejected")))
+        self.assertFalse(mailqueue.is_permanent(smtplib.SMTPDataError(451, b"try later")))
+        self.assertFalse(mailqueue.is_permanent(smtplib.SMTPRecipientsRefused({"a@x": (450, b"busy")})))
+
+
+if __name__ == "__main__":
+    unittest.main()
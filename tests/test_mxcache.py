@@ -0,0 +1,150 @@
+"""
+MXCache against a scripted resolver and a fake clock.
+"""
+import unittest
+
+import dns.exception
+import dns.resolver
+
+from travelapp import mxcache
+
+
+class FakeAnswer(object):
+
+    def __init__(self, ttl, records=1):
+        self.rrset = self
+        self.ttl = ttl
+        self.records = records
+
+    def __len__(self):
+        return self.records
+
+
+class FakeResolver(object):
+    """query() returns, or raises, the result scripted for the domain"""
+
+    def __init__(self, results):
+        self.results = results
+        self.queries = []
+
+    def query(self, name, rdtype):
+        self.queries.append((name, rdtype))
+        result = self.results[name]
+        if isinstance(result, Exception):
+            raise result
+
+        return result
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class MXCacheTest(unittest.TestCase):
+
+    def mx_cache(self, results, **kwargs):
+        self.resolver = FakeResolver(results)
+        self.clock = FakeClock()
+        cache = mxcache.MXCache(resolver=self.resolver, negative_ttl=300, error_ttl=30, **kwargs)
+        cache.cache.clock = self.clock
+        return cache
+
+    def test_positive_answer_expires_with_record_ttl(self):
+        cache = self.mx_cache({"example.com": FakeAnswer(ttl=600)})
+
+        self.assertTrue(cache.has_mx("Example.com."))
+        self.clock.now += 599
+        self.assertTrue(cache.has_mx("example.com"))
+        self.assertEqual(len(self.resolver.queries), 1)
+
+        self.clock.now += 2
+        self.assertTrue(cache.has_mx("example.com"))
+        self.assertEqual(self.resolver.queries, [("example.com", "MX")] * 2)
+
+    def test_nxdomain_is_cached_for_negative_ttl(self):
+        cache = self.mx_cache({"missing.example": dns.resolver.NXDOMAIN()})
+
+        self.assertFalse(cache.has_mx("missing.example"))
+        self.clock.now += 299
+        self.assertFalse(cache.has_mx("missing.example"))
+        self.assertEqual(len(self.resolver.queries), 1)
+
+        self.clock.now += 2
+        self.assertFalse(cache.has_mx("missing.example"))
+        self.assertEqual(len(self.resolver.queries), 2)
+        self.assertEqual(cache.errors, 0)
+
+    def test_no_answer_is_cached_for_negative_ttl(self):
+        cache = self.mx_cache({"nomx.example": dns.resolver.NoAnswer()})
+
+        self.assertFalse(cache.has_mx("nomx.example"))
+        self.clock.now += 299
+        self.assertFalse(cache.has_mx("nomx.example"))
+        self.assertEqual(len(self.resolver.queries), 1)
+
+    def test_timeout_is_accepted_and_cached_for_error_ttl(self):
+        cache = self.mx_cache({"slow.example": dns.exception.Timeout()})
+
+        self.assertTrue(cache.has_mx("slow.example"))
+        self.clock.now += 29
+        self.assertTrue(cache.has_mx("slow.example"))
+        self.assertEqual(len(self.resolver.queries), 1)
+
+        self.clock.now += 2
+        self.assertTrue(cache.has_mx("slow.example"))
+        self.assertEqual(len(self.resolver.queries), 2)
+        self.assertEqual(cache.errors, 2)
+
+    def test_no_nameservers_is_treated_as_error(self):
+        cache = self.mx_cache({"broken.example": dns.resolver.NoNameservers()})
+
+        self.assertTrue(cache.has_mx("broken.example"))
+        self.assertEqual(cache.errors, 1)
+
+    def test_ttl_is_clamped_to_min_ttl(self):
+        cache = self.mx_cache({"short.example": FakeAnswer(ttl=5)}, min_ttl=60, max_ttl=3600)
+
+        cache.has_mx("short.example")
+        self.clock.now += 59
+        cache.has_mx("short.example")
+        self.assertEqual(len(self.resolver.queries), 1)
+
+        self.clock.now += 2
+        cache.has_mx("short.example")
+        self.assertEqual(len(self.resolver.queries), 2)
+
+    def test_ttl_is_clamped_to_max_ttl(self):
+        cache = self.mx_cache({"long.example": FakeAnswer(ttl=604800)}, min_ttl=60, max_ttl=3600)
+
+        cache.has_mx("long.example")
+        self.clock.now += 3599
+        cache.has_mx("long.example")
+        self.assertEqual(len(self.resolver.queries), 1)
+
+        self.clock.now += 2
+        cache.has_mx("long.example")
+        self.assertEqual(len(self.resolver.queries), 2)
+
+    def test_empty_answer_is_negative(self):
+        cache = self.mx_cache({"empty.example": FakeAnswer(ttl=600, records=0)})
+
+        self.assertFalse(cache.has_mx("empty.example"))
+
+    def test_stats(self):
+        cache = self.mx_cache({"example.com": FakeAnswer(ttl=600), "slow.example": dns.exception.Timeout()})
+
+        cache.has_mx("example.com")
+        cache.has_mx("example.com")
+        cache.has_mx("slow.example")
+
+        stats = cache.stats()
+        self.assertEqual((stats["lookups"], stats["errors"], stats["hits"], stats["misses"]), (2, 1, 1, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
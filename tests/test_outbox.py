@@ -0,0 +1,142 @@
+"""
+Outbox spooling, delivery, retries and recovery, in a temporary directory with a fake transport.
+"""
+import os
+import shutil
+import smtplib
+import tempfile
+import time
+import unittest
+
+from travelapp import outbox
+
+
+class FakeTransport(object):
+    """Records what it sends, raising the error scripted for a message instead"""
+
+    def __init__(self, errors=None, open_error=None):
+        self.errors = errors or {}
+        self.open_error = open_error
+        self.sent = []
+        self.sessions = 0
+
+    def open(self):
+        if self.open_error is not None:
+            raise self.open_error
+        self.sessions += 1
+
+    def send(self, from_addr, to_addrs, message):
+        if message in self.errors:
+            raise self.errors[message]
+        self.sent.append((from_addr, to_addrs, message))
+
+    def close(self):
+        pass
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outbox = outbox.Outbox(self.directory, max_attempts=3, retry_delay=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def files(self, subdirectory):
+        return sorted(os.listdir(os.path.join(self.directory, subdirectory)))
+
+    def test_put_and_drain(self):
+        name = self.outbox.put("app@example.com", ["a@example.com"], "first")
+        self.outbox.put("app@example.com", ["b@example.com"], "second")
+
+        self.assertIn(name, self.files("new"))
+        self.assertEqual(self.files("tmp"), [])
+        self.assertEqual(len(self.outbox.ready()), 2)
+
+        transport = FakeTransport()
+        self.assertEqual(self.outbox.drain(transport, batch_size=1), (2, 0))
+        self.assertEqual([message for _, _, message in transport.sent], ["first", "second"])
+        self.assertEqual(transport.sessions, 2)
+        for subdirectory in outbox.SUBDIRECTORIES:
+            self.assertEqual(self.files(subdirectory), [])
+
+    def test_temporary_failure_is_retried_later(self):
+        name = self.outbox.put("app@example.com", ["a@example.com"], "first")
+        transport = FakeTransport(errors={"first": smtplib.SMTPDataError(451, b"try later")})
+
+        self.assertEqual(self.outbox.drain(transport), (0, 1))
+        retries = self.files("retry")
+        self.assertEqual(len(retries), 1)
+        attempts, retry_at, original = outbox.parse_retry_name(retries[0])
+        self.assertEqual((attempts, original), (1, name))
+
+        self.assertEqual(self.outbox.ready(), [])
+        self.assertEqual(self.outbox.ready(now=retry_at), [("retry", retries[0])])
+
+    def test_failed_after_max_attempts(self):
+        name = self.outbox.put("app@example.com", ["a@example.com"], "first")
+        transport = FakeTransport(errors={"first": smtplib.SMTPDataError(451, b"try later")})
+
+        for _ in range(3):
+            for subdirectory, due in self.outbox.ready(now=time.time() + 10 ** 6):
+                self.outbox._deliver(transport, subdirectory, due)
+
+        self.assertEqual(self.files("retry"), [])
+        self.assertEqual(self.files("failed"), [name])
+
+    def test_permanent_rejection_fails_at_once(self):
+        name = self.outbox.put("app@example.com", ["nobody@example.com"], "first")
+        refused = smtplib.SMTPRecipientsRefused({"nobody@example.com": (550, b"no such user")})
+
+        self.assertEqual(self.outbox.drain(FakeTransport(errors={"first": refused})), (0, 1))
+        self.assertEqual(self.files("retry"), [])
+        self.assertEqual(self.files("failed"), [name])
+
+    def test_unreadable_message_does_not_stop_drain(self):
+        with open(os.path.join(self.directory, "new", "0.corrupt"), "wb") as spool_file:
+            spool_file.write(b"{not json")
+        self.outbox.put("app@example.com", ["a@example.com"], "first")
+
+        transport = FakeTransport()
+        self.assertEqual(self.outbox.drain(transport), (1, 1))
+        self.assertEqual(len(transport.sent), 1)
+        self.assertEqual(self.files("failed"), ["0.corrupt"])
+
+    def test_transport_failure_leaves_messages_queued(self):
+        name = self.outbox.put("app@example.com", ["a@example.com"], "first")
+
+        self.assertEqual(self.outbox.drain(FakeTransport(open_error=OSError("refused"))), (0, 0))
+        self.assertEqual(self.files("new"), [name])
+
+    def test_recover_reschedules_stale_claims(self):
+        stale = self.outbox.put("app@example.com", ["a@example.com"], "first")
+        fresh = self.outbox.put("app@example.com", ["a@example.com"], "second")
+        for name in (stale, fresh):
+            os.rename(os.path.join(self.directory, "new", name), os.path.join(self.directory, "cur", name))
+        hour_ago = time.time() - 3600
+        os.utime(os.path.join(self.directory, "cur", stale), (hour_ago, hour_ago))
+
+        self.outbox.recover(stale_after=600)
+
+        self.assertEqual(self.files("cur"), [fresh])
+        retries = self.files("retry")
+        self.assertEqual(len(retries), 1)
+        self.assertEqual(outbox.parse_retry_name(retries[0])[::2], (1, stale))
+
+    def test_recover_counts_towards_max_attempts(self):
+        name = self.outbox.put("app@example.com", ["a@example.com"], "first")
+        hour_ago = time.time() - 3600
+
+        for _ in range(3):
+            subdirectory, due = self.outbox.ready(now=time.time() + 10 ** 6)[0]
+            # A drain which dies after claiming the message
+            os.rename(os.path.join(self.directory, subdirectory, due), os.path.join(self.directory, "cur", due))
+            os.utime(os.path.join(self.directory, "cur", due), (hour_ago, hour_ago))
+            self.outbox.recover(stale_after=600)
+
+        self.assertEqual(self.files("failed"), [name])
+
+
+if __name__ == "__main__":
+    unittest.main()
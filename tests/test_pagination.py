@@ -0,0 +1,80 @@
+"""
+Keyset pagination: fetch_page through the trip and member listings, and page cursor validation.
+"""
+import base64
+import json
+
+from travelapp import dbutil
+
+from dbtestcase import DatabaseTestCase
+
+
+def token(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii')
+
+
+class PaginationTest(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.user_id = self.add_user("traveller")
+        group = self.add_group("Group", [(self.user_id, "OWNER")])
+        # Repeated titles, so pages have to tell them apart by trip_id
+        self.titles = ["Alps", "Coast", "Alps", "Desert", "Bay", "Coast", "Alps"]
+        for title in self.titles:
+            self.add_trip(group, title)
+
+    def all_pages(self, fetch, limit):
+        pages = []
+        after = None
+        while True:
+            records, after = fetch(self.cursor, "traveller", after=after, limit=limit)
+            pages.append(records)
+            if after is None:
+                return pages
+
+    def test_pages_cover_every_row_once_in_order(self):
+        pages = self.all_pages(dbutil.get_trips_page, 3)
+
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        trips = [trip for page in pages for trip in page]
+        self.assertEqual([trip.title for trip in trips], sorted(self.titles))
+        self.assertEqual(len(set(trip.trip_id for trip in trips)), len(self.titles))
+        self.assertEqual(trips, sorted(trips, key=lambda trip: (trip.title, trip.trip_id)))
+
+    def test_exact_last_page_has_no_cursor(self):
+        pages = self.all_pages(dbutil.get_trips_page, 7)
+
+        self.assertEqual([len(page) for page in pages], [7])
+
+    def test_members_page(self):
+        other_id = self.add_user("another")
+        group = self.add_group("Pair", [(self.user_id, "OWNER"), (other_id, "READER")])
+
+        first, after = dbutil.get_members_page(self.cursor, group, limit=1)
+        second, last = dbutil.get_members_page(self.cursor, group, after=after, limit=1)
+
+        self.assertEqual([member.name for member in first + second], ["another", "traveller"])
+        self.assertIsNone(last)
+
+    def test_cursor_round_trip(self):
+        self.assertEqual(dbutil.decode_page_cursor(dbutil.encode_page_cursor(["Alps", 3])), ["Alps", 3])
+
+    def test_invalid_cursors(self):
+        invalid = [
+            "not a cursor!",
+            token({"title": "Alps"}),
+            token(["Alps", {"id": 1}]),
+            token(["Alps", [1]]),
+            token(["Alps", None]),
+            token(["Alps", 1.5]),
+            token([True, 1]),
+        ]
+        for after in invalid:
+            with self.assertRaises(ValueError):
+                dbutil.decode_page_cursor(after)
+
+    def test_invalid_cursor_is_rejected_before_the_query(self):
+        for after in (token(["Alps"]), token(["Alps", {"id": 1}])):
+            with self.assertRaises(ValueError):
+                dbutil.get_trips_page(self.cursor, "traveller", after=after)
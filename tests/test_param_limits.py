@@ -0,0 +1,79 @@
+"""
+Statements with a parameter per row or per name are split to stay within backend.max_params.
+"""
+from travelapp import dbutil
+
+from dbtestcase import DatabaseTestCase
+
+
+class ParamLimitTest(DatabaseTestCase):
+
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        # Small enough that every list below needs several statements
+        self.backend.max_params = 25
+        self.executed = []
+
+        execute = self.cursor.execute
+
+        def counting_execute(query, args=None):
+            if isinstance(args, (list, tuple)):
+                self.assertLessEqual(len(args), self.backend.max_params)
+                self.executed.append(query)
+            return execute(query, args)
+
+        self.cursor.execute = counting_execute
+
+        self.user_ids = [self.add_user("user{0}".format(idx)) for idx in range(40)]
+        self.group = self.add_group("Group", [(self.user_ids[0], "OWNER")])
+        self.trip_guid, _ = self.add_trip(self.group, "Trip")
+        del self.executed[:]
+
+    def test_param_chunks(self):
+        self.assertEqual([len(chunk) for chunk in dbutil.param_chunks(list(range(60)))], [25, 25, 10])
+        self.assertEqual([len(chunk) for chunk in dbutil.param_chunks(list(range(20)), reserved=5)], [20])
+        self.assertEqual([len(chunk) for chunk in dbutil.param_chunks(list(range(20)), per_value=3)], [8, 8, 4])
+        self.assertEqual(dbutil.param_chunks([]), [])
+
+    def test_insert_locations(self):
+        locations = [dbutil.NewLocation("Stop {0}".format(idx), 42.0 + idx / 100.0, -83.0, None, None, None)
+                     for idx in range(7)]
+
+        self.assertEqual(dbutil.insert_locations(self.cursor, self.trip_guid, locations), 7)
+        self.assertEqual(len(dbutil.get_order(self.cursor, self.trip_guid)), 7)
+        self.assertEqual(len([query for query in self.executed if "INSERT INTO locations" in query]), 4)
+
+    def test_find_users(self):
+        usernames = ["user{0}".format(idx) for idx in range(30)] + ["nobody"]
+        emails = ["user{0}@example.com".format(idx) for idx in range(30, 40)]
+
+        by_email, by_username = dbutil.find_users(self.cursor, emails, usernames)
+
+        self.assertEqual(len(by_email), 40)
+        self.assertEqual(sorted(set(by_username) & set(usernames)), sorted(usernames[:30]))
+        self.assertEqual(len(self.executed), 2)
+
+    def test_insert_members(self):
+        permission_id = dict((permission.name, permission.permission_id)
+                             for permission in dbutil.get_permissions(self.cursor))["READER"]
+
+        dbutil.insert_members(self.cursor, self.group, self.user_ids[1:], permission_id)
+
+        self.assertEqual(len(dbutil.get_members(self.cursor, self.group)), 40)
+
+    def test_record_logins(self):
+        dbutil.record_logins(self.cursor, dict(("user{0}".format(idx), idx) for idx in range(20)))
+
+        self.cursor.execute("SELECT SUM(login_count) FROM users")
+        self.assertEqual(self.cursor.fetchone()[0], sum(range(20)))
+        self.assertEqual(len(self.executed), 3)
+
+    def test_find_locations(self):
+        self.cursor.execute("UPDATE group_members SET user_id = %s", self.user_ids[0])
+        locations = [dbutil.NewLocation("Stop {0}".format(idx), 42.0 + idx / 1000.0, -83.0, None, None, None)
+                     for idx in range(60)]
+        dbutil.insert_locations(self.cursor, self.trip_guid, locations)
+
+        found = dbutil.find_locations_in_box(self.cursor, "user0", 41.0, -84.0, 43.0, -82.0, 42.0, -83.0, limit=None)
+
+        self.assertEqual([location.title for location in found], ["Stop {0}".format(idx) for idx in range(60)])
@@ -0,0 +1,228 @@
+"""
+Database backends.
+
+dbutil writes its SQL for MySQL and pymysql: %s placeholders, a single parameter passed on its own,
+cursor.connection.  Each backend hands out connections which accept that SQL:
+
+- mysql: a MySQL server, through pymysql
+- sqlite: an embedded SQLite database file in WAL mode, for single node installs.  Statements are
+  translated as they are executed, including the CREATE TABLE statements of migrations.py, so the
+  schema is built by createdb.py exactly as on MySQL.
+
+The backend is chosen by the db_backend setting, see config.py.
+"""
+import datetime
+import functools
+import re
+import sqlite3
+
+import pymysql
+import pymysql.cursors
+
+from . import config as cfg
+
+
+class MySQLBackend(object):
+    name = "mysql"
+    # Most parameters dbutil passes to one statement.  pymysql formats them into the SQL text, so
+    # only max_allowed_packet limits them; this keeps statements to a size any server accepts.
+    max_params = 65535
+
+    def __init__(self, host, username, password, database):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.database = database
+
+    def connect(self, host=None, connect_timeout=10):
+        """
+        :param host: Server to connect to instead of the configured one, e.g. a read replica
+        :param connect_timeout: Seconds to wait for the server to accept the connection
+        """
+        host = host or self.host
+        print("Created a new MySQL connection to {0}".format(host))
+        return pymysql.connect(host=host, user=self.username, passwd=self.password, db=self.database,
+                               connect_timeout=connect_timeout)
+
+    def streaming_cursor(self, conn):
+        return conn.cursor(pymysql.cursors.SSCursor)
+
+
+# Run on every new SQLite connection.  In WAL mode readers never wait for a writer, and with
+# synchronous=NORMAL a commit only waits for the WAL write, not for a sync, while a crash can still
+# not corrupt the database.  busy_timeout makes a second writer wait for the first instead of failing.
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -32768",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",
+]
+
+PLACEHOLDER = re.compile(r"%([s%])")
+AUTO_INCREMENT = re.compile(r"(\w+) INT NOT NULL AUTO_INCREMENT", re.IGNORECASE)
+
+# MySQL DATE and TIMESTAMP columns are stored as ISO 8601 text and read back as date and datetime
+sqlite3.register_adapter(datetime.date, lambda value: value.isoformat())
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("DATE", lambda value: datetime.date.fromisoformat(value.decode()))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.datetime.fromisoformat(value.decode()))
+
+
+def create_table(sql):
+    """
+    SQLite form of a MySQL CREATE TABLE.  An AUTO_INCREMENT key becomes an INTEGER PRIMARY KEY
+    AUTOINCREMENT column, which SQLite numbers the same way; other column types are accepted as they are.
+    """
+    for column in AUTO_INCREMENT.findall(sql):
+        sql = re.sub(r",\s*PRIMARY KEY\s*\(\s*{0}\s*\)".format(column), "", sql)
+
+    return AUTO_INCREMENT.sub(r"\1 INTEGER PRIMARY KEY AUTOINCREMENT", sql)
+
+
+@functools.lru_cache(maxsize=1024)
+def translate(query, has_args):
+    """
+    :return: SQLite form of a MySQL statement, None for a statement with nothing to do in SQLite
+    """
+    statement = query.strip()
+    words = statement.upper().split(None, 4)
+
+    if words[:2] == ["CREATE", "TABLE"]:
+        statement = create_table(statement)
+    elif words[:2] == ["ALTER", "TABLE"] and words[3:4] == ["MODIFY"]:
+        # SQLite does not enforce column lengths, so widening a column changes nothing
+        return None
+
+    # pymysql only formats the statement when there are parameters
+    if has_args:
+        statement = PLACEHOLDER.sub(lambda match: "?" if match.group(1) == "s" else "%", statement)
+
+    return statement
+
+
+def _value(value):
+    # dbutil passes utf_encode()d strings, which SQLite would store as blobs
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+
+    return value
+
+
+def parameters(args):
+    if args is None:
+        return ()
+    if isinstance(args, dict):
+        return dict((key, _value(value)) for key, value in args.items())
+    if isinstance(args, (tuple, list)):
+        return tuple(_value(value) for value in args)
+
+    return (_value(args),)
+
+
+class SQLiteCursor(object):
+    """sqlite3 cursor taking the MySQL statements and parameters dbutil passes to pymysql"""
+
+    def __init__(self, connection, cursor):
+        self.connection = connection
+        self._cursor = cursor
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    def execute(self, query, args=None):
+        statement = translate(query, args is not None)
+        if statement is None:
+            return 0
+
+        self._cursor.execute(statement, parameters(args))
+        return self._cursor.rowcount
+
+    def executemany(self, query, args):
+        statement = translate(query, True)
+        if statement is None:
+            return 0
+
+        self._cursor.executemany(statement, [parameters(row) for row in args])
+        return self._cursor.rowcount
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=None):
+        return self._cursor.fetchmany(size or self._cursor.arraysize)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection(object):
+    """sqlite3 connection with the parts of pymysql's interface dbutil uses"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, cursor_class=None):
+        return SQLiteCursor(self, self._conn.cursor())
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+
+class SQLiteBackend(object):
+    name = "sqlite"
+    # SQLITE_MAX_VARIABLE_NUMBER, the most parameters one statement takes: 999 before SQLite 3.32
+    max_params = 999 if sqlite3.sqlite_version_info < (3, 32, 0) else 32766
+
+    def __init__(self, path):
+        self.path = path
+
+    def connect(self, host=None, connect_timeout=None):
+        print("Opened a new SQLite connection to {0}".format(self.path))
+
+        # Pooled connections are used by one thread at a time, but not always the same one
+        conn = sqlite3.connect(self.path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+
+        return SQLiteConnection(conn)
+
+    def streaming_cursor(self, conn):
+        # SQLite cursors already step through a result as it is fetched
+        return conn.cursor()
+
+
+def from_config():
+    """
+    :return: backend for the configured database
+    :raises ValueError: for an unknown db_backend setting
+    """
+    if cfg.DB_BACKEND == "mysql":
+        return MySQLBackend(cfg.DB_HOST, cfg.DB_USERNAME, cfg.DB_PASSWORD, cfg.DB_DATABASE)
+    if cfg.DB_BACKEND == "sqlite":
+        return SQLiteBackend(cfg.DB_SQLITE_PATH)
+
+    raise ValueError("Unknown db_backend {0!r}, expected mysql or sqlite".format(cfg.DB_BACKEND))
@@ -22,6 +22,23 @@ DREAMHOST_HOST = cfg.dreamhost_host
 
 APPLICATION_EMAIL = cfg.application_email
 
+# "mysql", or "sqlite" for an embedded database file at DB_SQLITE_PATH, see backends.py
+DB_BACKEND = getattr(cfg, "db_backend", "mysql")
+DB_SQLITE_PATH = getattr(cfg, "db_sqlite_path", os.path.join(home, CONFIG_DIR, "travelapp.sqlite3"))
+
+# Hosts of read replicas of DB_HOST, sharing its credentials; reads are routed to them, see dbutil.reads.
+# The database user needs the REPLICATION CLIENT privilege for dbutil.replica_lag to check them.
+DB_REPLICA_HOSTS = getattr(cfg, "db_replica_hosts", [])
+
+# Serve Prometheus metrics of the database calls on /metrics, see metrics.py
+METRICS_ENABLED = getattr(cfg, "metrics_enabled", False)
+
+# Spool directory for outgoing mail on hosts delivering through sendmail, see outbox.py
+OUTBOX_DIR = getattr(cfg, "outbox_dir", os.path.join(home, CONFIG_DIR, "outbox"))
+
+# Mail domains whose MX records are looked up at startup, see mxcache.py
+MX_PREWARM_DOMAINS = getattr(cfg, "mx_prewarm_domains", [])
+
 del home 
 del CONFIG_DIR
 del os 
@@ -1,29 +1,636 @@
+import base64
+import contextlib
+import functools
+import itertools
+import json
+import numpy
 import pymysql
+import pymysql.cursors
 import uuid
-import hashlib
 import string
 import random
-import json
+import threading
+import time
 import sqlalchemy.pool as pool
+from collections import namedtuple
 
+from . import backends
+from . import cache
+from . import geo
+from . import metrics
+from .migrations import POSITION_GAP
 from . import config as cfg
+from . import passwords
 
 CHAR_SET = string.ascii_letters + string.digits
 
+# Rows are fetched from the driver in batches of this size
+FETCH_BATCH_SIZE = 500
+
+# Permission names by (username, group guid).  Entries are dropped when a group's membership changes
+# in this process; the TTL bounds how long changes made by other processes can go unnoticed.
+PERMISSION_CACHE_SIZE = 10000
+PERMISSION_CACHE_TTL = 60
+permission_cache = cache.TTLCache(max_size=PERMISSION_CACHE_SIZE, ttl=PERMISSION_CACHE_TTL)
+
+# Rows per page of the paginated listings
+PAGE_SIZE = 50
+
+# Rows per multi-row INSERT written by insert_locations
+INSERT_BATCH_SIZE = 500
+
+# Radius in meters of the first, smallest search made by find_nearby_locations
+NEARBY_START_RADIUS = 250
+
+# Seconds a session keeps reading from the primary after it writes, so it sees its own changes
+READ_YOUR_WRITES_WINDOW = 5.0
+
+# Replicas further behind the primary than this many seconds are taken out of rotation
+MAX_REPLICA_LAG = 5
+
+# Seconds between checks of the replicas' lag
+REPLICA_CHECK_INTERVAL = 10.0
+
+# Seconds to wait for a replica to accept a connection, before giving up on it and reading from the primary
+REPLICA_CONNECT_TIMEOUT = 2
+
+# Row records.  Each one is a tuple-backed type whose fields match, in order, the columns selected
+# by the queries returning it.  Templates use attribute access; as_dict()/as_dicts() convert them
+# only where a plain dict is needed, e.g. JSON payloads.
+User = namedtuple("User", [
+    "user_id", "guid", "username", "firstname", "lastname", "email", "verified", "registered",
+    "hashed_password", "salt", "verification_token", "verified_date", "password_reset_open",
+    "password_change_count", "last_password_change"])
+Credentials = namedtuple("Credentials", ["guid", "hashed_password", "salt", "verified", "verification_token"])
+Location = namedtuple("Location", [
+    "location_id", "trip_id", "guid", "title", "latitude", "longitude", "arrivalDate", "departureDate", "url"])
+Trip = namedtuple("Trip", ["trip_id", "group_id", "guid", "title"])
+# A location to be added by insert_locations
+NewLocation = namedtuple("NewLocation", ["title", "latitude", "longitude", "arrivalDate", "departureDate", "url"])
+# A location with the trip it belongs to, as exported
+ExportLocation = namedtuple("ExportLocation", Location._fields + ("trip_guid", "trip_title"))
+# A location found by a nearby search, with its trip and its distance in meters from the search point
+NearbyLocation = namedtuple("NearbyLocation", Location._fields + ("trip_guid", "trip_title", "distance"))
+Group = namedtuple("Group", ["group_id", "guid", "name"])
+Member = namedtuple("Member", ["name", "permission"])
+Permission = namedtuple("Permission", ["permission_id", "name"])
+PermissionFlags = namedtuple("PermissionFlags", [
+    "permission_id", "name", "can_read", "can_write", "can_delete", "can_modify_group"])
+
+# Capability columns of the permissions table
+PERMISSION_CAPABILITIES = ("can_read", "can_write", "can_delete", "can_modify_group")
+
+
+# MySQL or SQLite, see backends.py
+backend = backends.from_config()
+
 
-def new_connection():
-    print("Created a new MySQL connection")
-    return pymysql.connect(host=cfg.DB_HOST, user=cfg.DB_USERNAME,
-                           passwd=cfg.DB_PASSWORD, db=cfg.DB_DATABASE)
+def new_connection(host=None, connect_timeout=10):
+    if metrics.enabled:
+        metrics.connections_created.inc((backend.name,))
+
+    return backend.connect(host, connect_timeout)
 
 
 conn_pool = pool.QueuePool(new_connection, max_overflow=10, pool_size=30)
 
 
+def replica_lag(connection_pool):
+    """
+    Read the replica's lag with SHOW SLAVE STATUS, which needs the REPLICATION CLIENT privilege: GRANT
+    REPLICATION CLIENT ON *.* TO the application's database user.  Without it the replica is reported
+    as not replicating and stays out of rotation.
+
+    :return: seconds the replica is behind its primary, None when it is not replicating or cannot be
+        reached
+    """
+    try:
+        conn = connection_pool.connect()
+    except pymysql.MySQLError as e:
+        print("Replica check failed: {0}".format(e))
+        return None
+
+    try:
+        cursor = conn.cursor(pymysql.cursors.DictCursor)
+        try:
+            cursor.execute("SHOW SLAVE STATUS")
+            status = cursor.fetchone()
+        finally:
+            cursor.close()
+    except pymysql.MySQLError as e:
+        print("Replica check failed: {0}".format(e))
+        return None
+    finally:
+        conn.close()
+
+    return status.get("Seconds_Behind_Master") if status else None
+
+
+class Replica(object):
+    def __init__(self, host):
+        self.host = host
+        self.pool = pool.QueuePool(functools.partial(new_connection, host, REPLICA_CONNECT_TIMEOUT), max_overflow=10,
+                                   pool_size=30)
+        self.lag = None
+        self.healthy = False
+
+
+class ReplicaSet(object):
+    """
+    Read replicas of the primary, handed out in turn.  Their lag is checked at most once every
+    check_interval seconds, on a background thread started by whichever request asks for a replica
+    next, so no request waits for a slow or unreachable replica.  A replica joins the rotation once a
+    check finds it caught up, and one which is lagging, not replicating or unreachable is out of
+    rotation until a later check finds it caught up again.  With no replica in rotation, reads go to
+    the primary.
+    """
+
+    def __init__(self, hosts, max_lag=MAX_REPLICA_LAG, check_interval=REPLICA_CHECK_INTERVAL, lag=replica_lag,
+                 clock=time.monotonic):
+        self.replicas = [Replica(host) for host in hosts]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lag = lag
+        self._clock = clock
+        self._checked = None
+        self._checking = False
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.replicas)
+
+    def check(self):
+        for replica in self.replicas:
+            replica.lag = self._lag(replica.pool)
+            healthy = replica.lag is not None and replica.lag <= self.max_lag
+
+            if healthy != replica.healthy:
+                print("Replica {0} {1} rotation, lag {2}".format(replica.host, "back in" if healthy else "out of",
+                                                                 replica.lag))
+            replica.healthy = healthy
+
+    def failed(self, replica, error):
+        """Take a replica which could not be connected to out of rotation until the next check"""
+        if replica.healthy:
+            print("Replica {0} out of rotation: {1}".format(replica.host, error))
+        replica.healthy = False
+
+    def _check_in_background(self):
+        try:
+            self.check()
+        finally:
+            with self._lock:
+                self._checking = False
+
+    def choose(self):
+        """
+        :return: a replica in rotation, None if there is none
+        """
+        if not self.replicas:
+            return None
+
+        now = self._clock()
+        with self._lock:
+            due = not self._checking and (self._checked is None or now - self._checked >= self.check_interval)
+            if due:
+                self._checked = now
+                self._checking = True
+
+        if due:
+            thread = threading.Thread(target=self._check_in_background, name="replica-check")
+            thread.daemon = True
+            thread.start()
+
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+
+        return healthy[next(self._turn) % len(healthy)]
+
+
+replicas = ReplicaSet(cfg.DB_REPLICA_HOSTS)
+
+
 def connect():
     return conn_pool.connect()
 
 
+def connection_pools():
+    """:return: dict of name to pool, for every pool: "primary" and each replica's host"""
+    pools = {"primary": conn_pool}
+    for replica in replicas.replicas:
+        pools[replica.host] = replica.pool
+
+    return pools
+
+
+def checkout(connection_pool, pool_name):
+    """
+    Check a connection out of a pool, recording the wait in the metrics.
+
+    :return: (connection, seconds waited)
+    """
+    start = time.perf_counter()
+    conn = connection_pool.connect()
+    wait = time.perf_counter() - start
+
+    if metrics.enabled:
+        metrics.pool_wait_seconds.observe((pool_name,), wait)
+
+    return conn, wait
+
+
+@contextlib.contextmanager
+def streaming_cursor():
+    """
+    Unbuffered cursor on a connection of its own, for reading results too large to hold in memory.
+    Rows arrive from the server as they are fetched, and the connection can run nothing else until
+    the result is read, so it is not shared with the request's connection.
+    """
+    conn, _ = checkout(conn_pool, "primary")
+    try:
+        cursor = backend.streaming_cursor(conn)
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+    finally:
+        conn.close()
+
+
+class RequestConnection(object):
+    """
+    Database connections shared by everything that runs during one request.  A connection is only
+    checked out of its pool when the first query needs it, and goes back to the pool on release().
+
+    Queries made by functions tagged @reads go to a replica, when one is in rotation, and everything
+    else, including functions tagged @primary and the functions they call, to the primary.  A replica
+    which cannot be connected to is taken out of rotation and the request reads from the primary.
+    Once the request has called a function tagged @writes, or while a transaction() block is open,
+    all of its queries go to the primary.  pinned sends every query to the primary from the start,
+    for a session which wrote within READ_YOUR_WRITES_WINDOW.
+
+    queries counts the statements run through LazyCursor, rows the rows they fetched or changed and
+    pool_wait the seconds spent waiting for the pools to hand out connections.
+    """
+
+    def __init__(self, connection_pool=None, replica_set=None, pinned=False):
+        self.pool = connection_pool or conn_pool
+        self.replicas = replicas if replica_set is None else replica_set
+        self.pinned = pinned
+        self.wrote = False
+        self.checkouts = 0
+        self.queries = 0
+        self.rows = 0
+        self.pool_wait = 0.0
+        self._conn = None
+        self._cursor = None
+        self._replica_conn = None
+        self._replica_cursor = None
+        self._routes = []
+
+    @property
+    def active(self):
+        return self._conn is not None or self._replica_conn is not None
+
+    @property
+    def use_replica(self):
+        if self.pinned or self.wrote or not self.replicas:
+            return False
+
+        return not (self._cursor is not None and getattr(self._cursor.connection, 'transaction_depth', 0))
+
+    @contextlib.contextmanager
+    def route(self, kind):
+        """
+        Route the queries made inside the block.
+
+        :param kind: READ or WRITE
+        """
+        if kind == WRITE:
+            self.wrote = True
+
+        self._routes.append(kind)
+        try:
+            yield
+        finally:
+            self._routes.pop()
+
+    def _checkout(self, connection_pool, pool_name):
+        conn, wait = checkout(connection_pool, pool_name)
+        self.pool_wait += wait
+        self.checkouts += 1
+        return conn
+
+    def cursor(self):
+        # Reads made from inside a @primary function stay on the primary
+        if self._routes and self._routes[-1] == READ and PRIMARY not in self._routes and self.use_replica:
+            if self._replica_cursor is None:
+                replica = self.replicas.choose()
+                if replica is not None:
+                    try:
+                        self._replica_conn = self._checkout(replica.pool, replica.host)
+                        self._replica_cursor = self._replica_conn.cursor()
+                    except pymysql.MySQLError as e:
+                        # Read from the primary instead
+                        self.replicas.failed(replica, e)
+                        if self._replica_conn is not None:
+                            self._replica_conn.close()
+                        self._replica_conn = None
+
+            if self._replica_cursor is not None:
+                return self._replica_cursor
+
+        if self._cursor is None:
+            if self._conn is None:
+                self._conn = self._checkout(self.pool, "primary")
+            self._cursor = self._conn.cursor()
+
+        return self._cursor
+
+    def release(self):
+        for cursor, conn in ((self._cursor, self._conn), (self._replica_cursor, self._replica_conn)):
+            try:
+                if cursor:
+                    cursor.close()
+            finally:
+                if conn:
+                    conn.close()
+
+        self._cursor = self._conn = self._replica_cursor = self._replica_conn = None
+
+
+class LazyCursor(object):
+    """
+    Stand-in for a cursor which only acquires the underlying connection on first use, so views which
+    return before querying never touch the pool.
+    """
+
+    def __init__(self, request_connection):
+        self._request_connection = request_connection
+
+    def __getattr__(self, name):
+        return getattr(self._request_connection.cursor(), name)
+
+    def route(self, kind):
+        return self._request_connection.route(kind)
+
+    def _count_changed(self, cursor):
+        # Statements without a result, i.e. writes, count the rows they changed
+        if cursor.description is None:
+            self._request_connection.rows += max(cursor.rowcount, 0)
+
+    def execute(self, query, args=None):
+        self._request_connection.queries += 1
+        cursor = self._request_connection.cursor()
+        result = cursor.execute(query, args)
+        self._count_changed(cursor)
+        return result
+
+    def executemany(self, query, args):
+        self._request_connection.queries += 1
+        cursor = self._request_connection.cursor()
+        result = cursor.executemany(query, args)
+        self._count_changed(cursor)
+        return result
+
+    def fetchone(self):
+        row = self._request_connection.cursor().fetchone()
+        if row is not None:
+            self._request_connection.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._request_connection.cursor().fetchmany(size)
+        self._request_connection.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._request_connection.cursor().fetchall()
+        self._request_connection.rows += len(rows)
+        return rows
+
+
+READ = "read"
+WRITE = "write"
+PRIMARY = "primary"
+
+
+def _call(kind, func, cursor, args, kwargs):
+    # Only a request's LazyCursor can be routed; other cursors run everything where they are
+    route = getattr(cursor, 'route', None)
+    if route is None:
+        return func(cursor, *args, **kwargs)
+
+    with route(kind):
+        return func(cursor, *args, **kwargs)
+
+
+def _measured_call(kind, func, cursor, args, kwargs):
+    # Rows are only counted by a LazyCursor; for other cursors only time and errors are known
+    request_connection = cursor._request_connection if isinstance(cursor, LazyCursor) else None
+    rows = request_connection.rows if request_connection else 0
+
+    start = time.perf_counter()
+    try:
+        result = _call(kind, func, cursor, args, kwargs)
+    except Exception as e:
+        metrics.observe_query(func.__name__, time.perf_counter() - start, None, e)
+        raise
+
+    rows = request_connection.rows - rows if request_connection else None
+    metrics.observe_query(func.__name__, time.perf_counter() - start, rows)
+    return result
+
+
+def _routed(kind):
+    def decorator(func):
+        @functools.wraps(func)
+        def decoration(cursor, *args, **kwargs):
+            if metrics.enabled:
+                return _measured_call(kind, func, cursor, args, kwargs)
+
+            return _call(kind, func, cursor, args, kwargs)
+
+        return decoration
+
+    return decorator
+
+
+# Tag a function taking a cursor as only reading, so its queries may be answered by a replica.  Calls
+# to tagged functions are measured when metrics are enabled.
+reads = _routed(READ)
+
+# Tag a function taking a cursor as writing; the request, and the session for a while after, then
+# reads from the primary
+writes = _routed(WRITE)
+
+# Tag a function taking a cursor as reading, but only from the primary, e.g. because its answers are
+# cached and a replica's could be stale; the functions it calls read from the primary too.  Unlike @writes
+# the request may still use a replica afterwards.
+primary = _routed(PRIMARY)
+
+
+def commit(cursor):
+    """
+    Commit the cursor's connection, unless a transaction() block is open on it, in which case the
+    block commits everything once it completes.
+    """
+    if not getattr(cursor.connection, 'transaction_depth', 0):
+        cursor.connection.commit()
+
+
+@contextlib.contextmanager
+def transaction(cursor):
+    """
+    Group several dbutil calls into a single commit.  The work is rolled back if the block raises.
+    Nested blocks join the outermost one.
+
+    :param cursor: Database cursor
+    """
+    conn = cursor.connection
+    depth = getattr(conn, 'transaction_depth', 0)
+    conn.transaction_depth = depth + 1
+
+    try:
+        yield cursor
+    except Exception:
+        conn.transaction_depth = depth
+        if depth == 0:
+            conn.rollback()
+        raise
+
+    conn.transaction_depth = depth
+    if depth == 0:
+        conn.commit()
+
+
+def fetch_records(cursor, record_type, batch_size=FETCH_BATCH_SIZE):
+    """
+    Fetch every remaining row of the current result as records, pulling rows in batches.
+
+    :param cursor: Database cursor with an executed query
+    :param record_type: Record type whose fields match the selected columns
+    :return: list of records
+    """
+    make = record_type._make
+    records = []
+
+    rows = cursor.fetchmany(batch_size)
+    while rows:
+        records.extend(map(make, rows))
+        rows = cursor.fetchmany(batch_size)
+
+    return records
+
+
+def iter_records(cursor, record_type, batch_size=FETCH_BATCH_SIZE):
+    """Generator counterpart of fetch_records, for streaming_cursor() results"""
+    make = record_type._make
+
+    rows = cursor.fetchmany(batch_size)
+    while rows:
+        for row in rows:
+            yield make(row)
+        rows = cursor.fetchmany(batch_size)
+
+
+def fetch_record(cursor, record_type):
+    """Fetch the next row of the current result as a record, or None when there are no more rows"""
+    row = cursor.fetchone()
+    if row is None:
+        return None
+
+    return record_type._make(row)
+
+
+def encode_page_cursor(values):
+    """Opaque token for the sort key of the last row of a page"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip("=")
+
+
+def decode_page_cursor(token):
+    """
+    :return: sort key values, as passed to encode_page_cursor
+    :raises ValueError: for a token which was not made by encode_page_cursor
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode('utf-8'))
+    except (TypeError, UnicodeError, ValueError) as e:
+        raise ValueError("Invalid page cursor: {0}".format(e))
+
+    if not isinstance(values, list):
+        raise ValueError("Invalid page cursor")
+
+    # Sort keys are names and ids; anything else would reach the query's parameters
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (str, int)):
+            raise ValueError("Invalid page cursor")
+
+    return values
+
+
+def seek_condition(columns, values):
+    """
+    Condition selecting the rows after values in (columns) order.  It is written out column by
+    column, rather than as a row comparison, so MySQL can use an index range for it.
+
+    :return: (SQL condition, parameters)
+    """
+    clauses = []
+    params = []
+    for idx, column in enumerate(columns):
+        terms = ["{0} = %s".format(previous) for previous in columns[:idx]] + ["{0} > %s".format(column)]
+        clauses.append("(" + " AND ".join(terms) + ")")
+        params.extend(values[:idx + 1])
+
+    return "(" + " OR ".join(clauses) + ")", params
+
+
+def fetch_page(cursor, sql, params, record_type, sort_columns, after=None, limit=PAGE_SIZE):
+    """
+    Fetch one page of a keyset paginated query.  Each page seeks past the sort key of the previous
+    one instead of skipping rows with OFFSET, so a later page costs no more than the first.
+
+    :param sql: Query with a {seek} placeholder in its WHERE clause, ordered by sort_columns and
+        ending in LIMIT %s
+    :param params: Parameters of the query, without the seek and limit values
+    :param sort_columns: (column, record field) pairs making up a unique sort key
+    :param after: Page cursor returned with the previous page, None for the first page
+    :return: (list of records, cursor for the next page or None on the last page)
+    :raises ValueError: for an invalid cursor
+    """
+    seek = ""
+    params = list(params)
+    if after is not None:
+        values = decode_page_cursor(after)
+        if len(values) != len(sort_columns):
+            raise ValueError("Invalid page cursor")
+        condition, seek_params = seek_condition([column for column, _ in sort_columns], values)
+        seek = "AND " + condition
+        params.extend(seek_params)
+
+    # One extra row tells whether there is a next page
+    cursor.execute(sql.format(seek=seek), params + [limit + 1])
+    records = fetch_records(cursor, record_type)
+
+    if len(records) <= limit:
+        return records, None
+
+    records = records[:limit]
+    last = records[-1]
+    return records, encode_page_cursor([getattr(last, field) for _, field in sort_columns])
+
+
+def as_dict(record):
+    return dict(zip(record._fields, record))
+
+
+def as_dicts(records):
+    return [as_dict(record) for record in records]
+
+
 def get_guid():
     return uuid.uuid1().hex
 
@@ -33,7 +640,20 @@ def generate_salt():
 
 
 def hash_password(salt, password):
-    return hashlib.sha256((salt + password).encode('utf-8')).hexdigest()
+    """Hash a password with the default hasher, on the calling thread"""
+    return passwords.hash_password(salt, password)
+
+
+def param_chunks(values, reserved=0, per_value=1):
+    """
+    Split a list into parts short enough to pass to one statement on the configured backend.
+
+    :param reserved: Parameters the statement takes besides the list
+    :param per_value: Parameters each value of the list takes
+    :return: list of lists
+    """
+    size = max((backend.max_params - reserved) // per_value, 1)
+    return [values[start:start + size] for start in range(0, len(values), size)]
 
 
 def utf_encode(value):
@@ -43,45 +663,221 @@ def utf_encode(value):
     return value
 
 
+def utf_decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+
+    return value
+
+
+def forget_permissions(group_guid, username=None):
+    """
+    Drop cached permission checks for one member of a group, or for the whole group when username
+    is None.
+    """
+    group_guid = utf_decode(group_guid)
+
+    if username is None:
+        permission_cache.discard_where(lambda key: key[1] == group_guid)
+    else:
+        permission_cache.discard((utf_decode(username), group_guid))
+
+
+@writes
+def bump_trip_version(cursor, trip_guid):
+    """Record a change to what the trip page shows"""
+    sql = """
+        UPDATE trips SET version = version + 1
+        WHERE guid=%s
+    """
+
+    cursor.execute(sql, utf_encode(trip_guid))
+
+
+@writes
+def bump_group_version(cursor, group_guid):
+    """Record a change to the group's members or trips, and so to its members' listings"""
+    sql = """
+        UPDATE groups SET version = version + 1
+        WHERE guid=%s
+    """
+
+    cursor.execute(sql, utf_encode(group_guid))
+
+
+@writes
+def bump_trip_group_version(cursor, trip_guid):
+    sql = """
+        UPDATE groups SET version = version + 1
+        WHERE group_id = (SELECT group_id FROM trips WHERE trips.guid=%s)
+    """
+
+    cursor.execute(sql, utf_encode(trip_guid))
+
+
+@reads
+def get_trip_version(cursor, trip_guid):
+    """Version stamp of a trip's page, None if there is no such trip"""
+    sql = """
+        SELECT version
+        FROM trips
+        WHERE guid=%s
+    """
+
+    cursor.execute(sql, utf_encode(trip_guid))
+
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+@reads
+def get_group_version(cursor, group_guid):
+    """Version stamp of a group's page, None if there is no such group"""
+    sql = """
+        SELECT version
+        FROM groups
+        WHERE guid=%s
+    """
+
+    cursor.execute(sql, utf_encode(group_guid))
+
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+@reads
+def get_listing_version(cursor, username):
+    """
+    Version stamp of a user's trip and group listings.  It changes when the user joins or leaves a
+    group, and when any of the user's groups is bumped.
+    """
+    sql = """
+        SELECT COUNT(*), SUM(groups.group_id), SUM(groups.group_id * groups.group_id), SUM(groups.version)
+        FROM users
+        JOIN group_members USING (user_id)
+        JOIN groups USING (group_id)
+        WHERE users.username = %s
+    """
+
+    cursor.execute(sql, utf_encode(username))
+
+    return "-".join(str(value or 0) for value in cursor.fetchone())
+
+
+@writes
 def insert_location(cursor, trip_guid, title, latitude, longitude, arrival_date, departure_date, website):
     sql = """
-        INSERT INTO locations (trip_id, guid, title, latitude, longitude, arrivalDate, departureDate, url)
-        VALUES ((SELECT trip_id FROM trips where trips.guid=%s), %s, %s, %s, %s, %s, %s, %s)
+        INSERT INTO locations (trip_id, guid, title, latitude, longitude, arrivalDate, departureDate, url, geohash,
+                               position)
+        SELECT trips.trip_id, %s, %s, %s, %s, %s, %s, %s, %s, COALESCE(MAX(locations.position), 0) + %s
+        FROM trips
+        LEFT JOIN locations ON locations.trip_id = trips.trip_id
+        WHERE trips.guid = %s
+        GROUP BY trips.trip_id
     """
 
     location_guid = get_guid()
-    cursor.execute(sql, (trip_guid, location_guid, title, latitude, longitude, arrival_date, departure_date, website))
-    cursor.connection.commit()
+    cursor.execute(sql, (location_guid, title, latitude, longitude, arrival_date, departure_date, website,
+                         geo.geohash(float(latitude), float(longitude)), POSITION_GAP, trip_guid))
+    bump_trip_version(cursor, trip_guid)
+    commit(cursor)
 
     return location_guid
 
 
+@writes
 def insert_short_location(cursor, trip_guid, title, latitude, longitude):
     sql = """
-        INSERT INTO locations (trip_id, guid, title, latitude, longitude)
-        VALUES ((SELECT trip_id FROM trips where trips.guid=%s), %s, %s, %s, %s)
+        INSERT INTO locations (trip_id, guid, title, latitude, longitude, geohash, position)
+        SELECT trips.trip_id, %s, %s, %s, %s, %s, COALESCE(MAX(locations.position), 0) + %s
+        FROM trips
+        LEFT JOIN locations ON locations.trip_id = trips.trip_id
+        WHERE trips.guid = %s
+        GROUP BY trips.trip_id
     """
 
     location_guid = get_guid()
+    location_hash = geo.geohash(float(latitude), float(longitude))
 
-    cursor.execute(sql, (trip_guid, location_guid, title, latitude, longitude))
-    cursor.connection.commit()
+    cursor.execute(sql, (location_guid, title, latitude, longitude, location_hash, POSITION_GAP, trip_guid))
+    bump_trip_version(cursor, trip_guid)
+    commit(cursor)
 
     return location_guid
 
 
+@writes
+def insert_locations(cursor, trip_guid, locations, batch_size=INSERT_BATCH_SIZE):
+    """
+    Append many locations to the end of a trip.  The trip is looked up once, then the locations are
+    written with one multi-row INSERT per batch, all in a single transaction.
+
+    :param cursor: Database cursor
+    :param trip_guid: Trip to add the locations to
+    :param locations: Iterable of NewLocation, read one batch at a time, so it can be a parser
+        streaming a file
+    :return: number of locations inserted
+    :raises ValueError: if there is no such trip; nothing is inserted if the locations raise
+    """
+    columns = "(trip_id, guid, title, latitude, longitude, arrivalDate, departureDate, url, geohash, position)"
+    placeholders = "(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+    # Each row takes 10 parameters
+    batch_size = max(min(batch_size, backend.max_params // 10), 1)
+
+    sql = """
+        SELECT trips.trip_id, COALESCE(MAX(locations.position), 0)
+        FROM trips
+        LEFT JOIN locations ON locations.trip_id = trips.trip_id
+        WHERE trips.guid = %s
+        GROUP BY trips.trip_id
+    """
+
+    count = 0
+    with transaction(cursor):
+        cursor.execute(sql, utf_encode(trip_guid))
+        row = cursor.fetchone()
+        if row is None:
+            raise ValueError("No such trip: {0}".format(trip_guid))
+        trip_id, position = row
+
+        locations = iter(locations)
+        while True:
+            batch = list(itertools.islice(locations, batch_size))
+            if not batch:
+                break
+
+            params = []
+            for location in batch:
+                position += POSITION_GAP
+                params.extend((trip_id, get_guid(), location.title, location.latitude, location.longitude,
+                               location.arrivalDate, location.departureDate, location.url,
+                               geo.geohash(float(location.latitude), float(location.longitude)), position))
+
+            sql = "INSERT INTO locations {0} VALUES {1}".format(columns, ", ".join([placeholders] * len(batch)))
+            cursor.execute(sql, params)
+            count += len(batch)
+
+        bump_trip_version(cursor, trip_guid)
+
+    return count
+
+
+@writes
 def delete_location(cursor, trip_guid, location_guid):
     sql = """
-        DELETE locations.* FROM locations
-        JOIN trips USING (trip_id)
-        WHERE trips.guid = %s AND locations.guid = %s
+        DELETE FROM locations
+        WHERE trip_id = (SELECT trip_id FROM trips WHERE trips.guid = %s)
+            AND guid = %s
     """
 
     cursor.execute(sql, (trip_guid, location_guid))
 
-    cursor.connection.commit()
+    bump_trip_version(cursor, trip_guid)
+    commit(cursor)
 
 
+@writes
 def delete_group(cursor, group_guid):
     sql = """
         DELETE FROM groups
@@ -90,9 +886,12 @@ def delete_group(cursor, group_guid):
 
     cursor.execute(sql, group_guid)
 
-    cursor.connection.commit()
+    commit(cursor)
+
+    forget_permissions(group_guid)
 
 
+@writes
 def insert_trip(cursor, group_guid, title):
     sql = """
         INSERT INTO trips (group_id, guid, title)
@@ -101,22 +900,28 @@ def insert_trip(cursor, group_guid, title):
 
     trip_guid = get_guid()
     cursor.execute(sql, (group_guid, trip_guid, utf_encode(title)))
-    cursor.connection.commit()
+    bump_group_version(cursor, group_guid)
+    commit(cursor)
 
     return trip_guid
 
 
+@writes
 def delete_trip(cursor, trip_guid):
     sql = """
         DELETE FROM trips
         WHERE guid=%s
     """
 
+    # The trip listings of the group's members change
+    bump_trip_group_version(cursor, trip_guid)
+
     cursor.execute(sql, trip_guid)
 
-    cursor.connection.commit()
+    commit(cursor)
 
 
+@primary
 def validate_user(cursor, username, password, token=None):
     """
     Overloaded function which helps to validate new users, makes sure they have already
@@ -129,32 +934,32 @@ def validate_user(cursor, username, password, token=None):
     :return: None - not yet validated, and no validation token provided,
             True if username and password match
     """
-    user = get_user(cursor, username)
+    user = get_credentials(cursor, username)
     if not user:
         return False, None
 
-    salt = user['salt']
-    expected_hash = user['hashed_password']
-
-    hashed_pw = hash_password(salt, password)
-
-    valid_pw = expected_hash == hashed_pw
+    valid_pw, new_hash = passwords.pool.verify(user.salt, password, user.hashed_password)
     if not valid_pw:
         # User didn't authenticate, so don't allow any further actions
         return False, None
 
-    user_verified = user['verified'] == 1
+    if new_hash:
+        # Stored hash uses an outdated algorithm or cost
+        set_password_hash(cursor, username, new_hash)
+
+    user_verified = user.verified == 1
     if user_verified:
         return True, None
 
-    valid_token = (token is not None) and (token == user['verification_token'])
+    valid_token = (token is not None) and (token == user.verification_token)
     if valid_token:
         return True, None
 
     # User still needs to verify
-    return None, user.get('guid', None)
+    return None, user.guid
 
 
+@writes
 def insert_user(cursor, username, firstname, lastname, email, password):
     sql = """
         INSERT INTO users (guid, username, firstname, lastname, email, hashed_password, salt)
@@ -162,36 +967,43 @@ def insert_user(cursor, username, firstname, lastname, email, password):
     """
     salt = generate_salt()
 
-    hashed_password = hash_password(salt, password)
+    hashed_password = passwords.pool.hash(salt, password)
 
     guid = get_guid()
 
     cursor.execute(sql, (guid, username, firstname, lastname, email, hashed_password, salt))
-    cursor.connection.commit()
+    commit(cursor)
 
     return guid
 
 
-def make_user_dict(columns):
-    return {
-        "user_id": columns[0],
-        "guid": columns[1],
-        "username": columns[2],
-        "firstname": columns[3],
-        "lastname": columns[4],
-        "email": columns[5],
-        "verified": columns[6],
-        "registered": columns[7],
-        "hashed_password": columns[8],
-        "salt": columns[9],
-        "verification_token": columns[10],
-        "verified_date": columns[11],
-        "password_reset_open": columns[12],
-        "password_change_count": columns[13],
-        "last_password_change": columns[14]
-    }
+@writes
+def set_password_hash(cursor, username, hashed_password):
+    """Replace a user's stored hash, without counting it as a password change"""
+    sql = """
+        UPDATE users SET hashed_password=%s
+        WHERE username=%s
+    """
+
+    cursor.execute(sql, (hashed_password, utf_encode(username)))
+    commit(cursor)
+
+
+@reads
+def get_credentials(cursor, username):
+    """Fetch only the columns needed to check a user's password"""
+    sql = """
+        SELECT guid, hashed_password, salt, verified, verification_token
+        FROM users
+        WHERE username=%s
+    """
 
+    cursor.execute(sql, utf_encode(username))
 
+    return fetch_record(cursor, Credentials)
+
+
+@reads
 def get_user(cursor, username):
     sql = """
         SELECT user_id, guid, username, firstname, lastname, email, verified, registered,
@@ -201,18 +1013,12 @@ def get_user(cursor, username):
         WHERE username=%s
     """
 
-    count = cursor.execute(sql, username)
-    if count != 1:
-        return None
-
-    user = cursor.fetchone()
-
-    if not user:
-        return None
+    cursor.execute(sql, username)
 
-    return make_user_dict(user)
+    return fetch_record(cursor, User)
 
 
+@reads
 def get_user_by_guid(cursor, user_guid):
     sql = """
         SELECT user_id, guid, username, firstname, lastname, email, verified, registered,
@@ -222,18 +1028,12 @@ def get_user_by_guid(cursor, user_guid):
         WHERE guid=%s
     """
 
-    count = cursor.execute(sql, user_guid)
-    if count != 1:
-        return None
+    cursor.execute(sql, user_guid)
 
-    user = cursor.fetchone()
-
-    if not user:
-        return None
-
-    return make_user_dict(user)
+    return fetch_record(cursor, User)
 
 
+@reads
 def get_locations(cursor, trip_guid):
     sql = """
         SELECT locations.location_id, locations.trip_id, locations.guid, locations.title,
@@ -242,30 +1042,15 @@ def get_locations(cursor, trip_guid):
         FROM locations
         JOIN trips USING (trip_id)
         where trips.guid = %s
+        ORDER BY locations.position, locations.location_id
     """
 
     cursor.execute(sql, utf_encode(trip_guid))
 
-    location_list = []
-    location = cursor.fetchone()
-
-    while location is not None:
-        location_list.append({
-            "location_id": location[0],
-            "trip_id": location[1],
-            "guid": location[2],
-            "title": location[3],
-            "latitude": location[4],
-            "longitude": location[5],
-            "arrivalDate": location[6],
-            "departureDate": location[7],
-            "url": location[8]
-        })
-        location = cursor.fetchone()
-
-    return location_list
+    return fetch_records(cursor, Location)
 
 
+@reads
 def get_trips(cursor, username):
     sql = """
         SELECT trips.trip_id, trips.group_id, trips.guid, trips.title
@@ -279,50 +1064,239 @@ def get_trips(cursor, username):
     username = utf_encode(username)
     cursor.execute(sql, username)
 
-    trips = []
+    return fetch_records(cursor, Trip)
+
 
-    trip = cursor.fetchone()
-    while trip is not None:
-        trips.append({
-            "trip_id": trip[0],
-            "group_id": trip[1],
-            "guid": trip[2],
-            "title": trip[3]
-        })
-        trip = cursor.fetchone()
+@reads
+def get_trips_page(cursor, username, after=None, limit=PAGE_SIZE):
+    """
+    One page of the user's trips, ordered by title.
 
-    return trips
+    :return: (list of Trip, cursor for the next page or None), see fetch_page
+    """
+    sql = """
+        SELECT trips.trip_id, trips.group_id, trips.guid, trips.title
+        FROM users
+        JOIN group_members USING (user_id)
+        JOIN trips USING (group_id)
+        WHERE users.username = %s {seek}
+        ORDER BY trips.title, trips.trip_id
+        LIMIT %s
+    """
 
+    return fetch_page(cursor, sql, [utf_encode(username)], Trip,
+                      [("trips.title", "title"), ("trips.trip_id", "trip_id")], after, limit)
 
+
+def _find_locations(cursor, username, box, latitude, longitude, radius, limit):
+    """
+    Fetch the coordinates of the candidate locations from the geohash cells covering box, keep
+    those inside the box (and radius) and rank them by distance in one vectorized pass, then load
+    the full rows of the ones returned.
+    """
+    south, west, north, east = box
+    cells = geo.covering_cells(south, west, north, east)
+
+    sql = """
+        SELECT locations.location_id, locations.latitude, locations.longitude
+        FROM users
+        JOIN group_members USING (user_id)
+        JOIN permissions USING (permission_id)
+        JOIN trips USING (group_id)
+        JOIN locations USING (trip_id)
+        WHERE users.username = %s AND permissions.can_read = 1 AND ({cells})
+            AND locations.latitude BETWEEN %s AND %s
+    """.format(cells=" OR ".join(["locations.geohash BETWEEN %s AND %s"] * len(cells)))
+
+    params = [utf_encode(username)]
+    for cell in cells:
+        params.extend(geo.prefix_range(cell))
+    params.extend([south, north])
+
+    cursor.execute(sql, params)
+    candidates = cursor.fetchall()
+    if not candidates:
+        return []
+
+    candidates = numpy.array(candidates, dtype=numpy.float64)
+    distances = geo.distances(latitude, longitude, candidates[:, 1], candidates[:, 2])
+    inside = geo.in_box(candidates[:, 1], candidates[:, 2], south, west, north, east)
+    if radius is not None:
+        inside &= distances <= radius
+
+    # Nearest first, equal distances by location_id, so the order is the same on every call
+    matches = inside.nonzero()[0]
+    ranked = matches[numpy.lexsort((candidates[matches, 0], distances[matches]))][:limit]
+    if not len(ranked):
+        return []
+
+    sql = """
+        SELECT locations.location_id, locations.trip_id, locations.guid, locations.title,
+               locations.latitude, locations.longitude, locations.arrivalDate,
+               locations.departureDate, locations.url, trips.guid, trips.title
+        FROM locations
+        JOIN trips USING (trip_id)
+        WHERE locations.location_id IN ({0})
+    """
+
+    rows = {}
+    for location_ids in param_chunks([int(location_id) for location_id in candidates[ranked, 0]]):
+        cursor.execute(sql.format(", ".join(["%s"] * len(location_ids))), location_ids)
+        rows.update((row[0], row) for row in cursor.fetchall())
+
+    return [NearbyLocation._make(tuple(rows[int(candidates[idx, 0])]) + (float(distances[idx]),))
+            for idx in ranked if int(candidates[idx, 0]) in rows]
+
+
+@reads
+def find_locations_in_box(cursor, username, south, west, north, east, latitude=None, longitude=None, limit=100):
+    """
+    Locations inside a bounding box, from every trip the user can read, nearest first.
+
+    :param south, west, north, east: Box in degrees; west > east for a box crossing the antimeridian
+    :param latitude, longitude: Point distances are measured from, defaults to the middle of the box
+    :param limit: Most locations returned, None for all
+    :return: list of NearbyLocation
+    """
+    if latitude is None or longitude is None:
+        latitude = (south + north) / 2
+        longitude = (west + east) / 2 if west <= east else (west + east + 360.0) / 2 % 360.0 - 180.0
+
+    return _find_locations(cursor, username, (south, west, north, east), latitude, longitude, None, limit)
+
+
+@reads
+def find_nearby_locations(cursor, username, latitude, longitude, radius, limit=100):
+    """
+    Locations within radius meters of a point, from every trip the user can read, nearest first.
+
+    :return: list of NearbyLocation
+    """
+    # Widen the search until it holds limit locations: those are then the nearest ones, and in dense
+    # areas far fewer candidates are ranked than in the full radius
+    search = radius if limit is None else min(radius, NEARBY_START_RADIUS)
+    while True:
+        box = geo.bounding_box(latitude, longitude, search)
+        found = _find_locations(cursor, username, box, latitude, longitude, search, limit)
+        if search >= radius or len(found) >= limit:
+            return found
+        search = min(search * 4, radius)
+
+
+@reads
 def get_trip(cursor, trip_guid):
     sql = """
-        SELECT trips.trip_id, trips.group_id, trips.guid, trips.title, trip_locations.location_order
+        SELECT trips.trip_id, trips.group_id, trips.guid, trips.title
         FROM trips
-        LEFT JOIN trip_locations using (trip_id)
         WHERE trips.guid = %s
     """
 
     cursor.execute(sql, utf_encode(trip_guid))
 
-    trip = cursor.fetchone()
+    return fetch_record(cursor, Trip)
 
-    if not trip:
-        return None
 
-    if trip[4]:
-        order = json.loads(trip[4])
-    else:
-        order = None
+@reads
+def stream_trip_locations(cursor, trip_guid):
+    """
+    A trip's locations in order, read as they are consumed.
 
-    return {
-        "trip_id": trip[0],
-        "group_id": trip[1],
-        "guid": trip[2],
-        "title": trip[3],
-        "order": order
-    }
+    :param cursor: Cursor from streaming_cursor()
+    :return: generator of ExportLocation
+    """
+    sql = """
+        SELECT locations.location_id, locations.trip_id, locations.guid, locations.title,
+               locations.latitude, locations.longitude, locations.arrivalDate,
+               locations.departureDate, locations.url, trips.guid, trips.title
+        FROM trips
+        JOIN locations USING (trip_id)
+        WHERE trips.guid = %s
+        ORDER BY locations.position, locations.location_id
+    """
+
+    cursor.execute(sql, utf_encode(trip_guid))
+
+    return iter_records(cursor, ExportLocation)
+
+
+@reads
+def stream_group_locations(cursor, group_guid):
+    """
+    The locations of every trip of a group, trip by trip, read as they are consumed.
+
+    :param cursor: Cursor from streaming_cursor()
+    :return: generator of ExportLocation
+    """
+    sql = """
+        SELECT locations.location_id, locations.trip_id, locations.guid, locations.title,
+               locations.latitude, locations.longitude, locations.arrivalDate,
+               locations.departureDate, locations.url, trips.guid, trips.title
+        FROM groups
+        JOIN trips USING (group_id)
+        JOIN locations USING (trip_id)
+        WHERE groups.guid = %s
+        ORDER BY trips.trip_id, locations.position, locations.location_id
+    """
+
+    cursor.execute(sql, utf_encode(group_guid))
+
+    return iter_records(cursor, ExportLocation)
+
+
+@reads
+def get_trip_group_guid(cursor, trip_guid):
+    """Guid of the group a trip belongs to, None if there is no such trip"""
+    sql = """
+        SELECT groups.guid
+        FROM trips
+        JOIN groups USING (group_id)
+        WHERE trips.guid = %s
+    """
+
+    cursor.execute(sql, utf_encode(trip_guid))
+    row = cursor.fetchone()
+
+    return row[0] if row else None
+
+
+@reads
+def load_trip(cursor, trip_guid):
+    """
+    Load a trip and its locations, already in the user's order, with a single query.
 
+    :param cursor: Database cursor
+    :param trip_guid: Trip to load
+    :return: (Trip, list of Location), or (None, []) if there is no such trip
+    """
+    sql = """
+        SELECT trips.trip_id, trips.group_id, trips.guid, trips.title,
+               locations.location_id, locations.trip_id, locations.guid, locations.title,
+               locations.latitude, locations.longitude, locations.arrivalDate,
+               locations.departureDate, locations.url
+        FROM trips
+        LEFT JOIN locations ON locations.trip_id = trips.trip_id
+        WHERE trips.guid = %s
+        ORDER BY locations.position, locations.location_id
+    """
+
+    cursor.execute(sql, utf_encode(trip_guid))
 
+    trip = None
+    locations = []
+    make_location = Location._make
+
+    rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+    while rows:
+        if trip is None:
+            trip = Trip._make(rows[0][:4])
+
+        locations.extend(make_location(row[4:]) for row in rows if row[4] is not None)
+        rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+
+    return trip, locations
+
+
+@writes
 def insert_group(cursor, name):
     sql = """
         INSERT INTO groups ( guid, name )
@@ -334,11 +1308,12 @@ def insert_group(cursor, name):
 
     cursor.execute(sql, (guid, name))
 
-    cursor.connection.commit()
+    commit(cursor)
 
     return guid
 
 
+@reads
 def is_valid_username(cursor, username):
     sql = """
         SELECT username
@@ -355,6 +1330,7 @@ def is_valid_username(cursor, username):
     return True
 
 
+@reads
 def is_valid_email(cursor, email):
     sql = """
         SELECT email
@@ -371,6 +1347,7 @@ def is_valid_email(cursor, email):
     return True
 
 
+@writes
 def insert_member_by_email(cursor, group_guid, email, permission_id):
     sql = """
         REPLACE INTO group_members(group_id, user_id, permission_id)
@@ -386,9 +1363,13 @@ def insert_member_by_email(cursor, group_guid, email, permission_id):
 
     cursor.execute(sql, (permission_id, group_guid, email))
 
-    cursor.connection.commit()
+    bump_group_version(cursor, group_guid)
+    commit(cursor)
+
+    forget_permissions(group_guid)
 
 
+@writes
 def insert_member_by_username(cursor, group_guid, username, permission_id):
     sql = """
         REPLACE INTO group_members(group_id, user_id, permission_id)
@@ -404,9 +1385,13 @@ def insert_member_by_username(cursor, group_guid, username, permission_id):
 
     cursor.execute(sql, (permission_id, group_guid, username))
 
-    cursor.connection.commit()
+    bump_group_version(cursor, group_guid)
+    commit(cursor)
+
+    forget_permissions(group_guid, username)
 
 
+@writes
 def insert_group_member(cursor, group_guid, username, permission_name):
     sql = """
         INSERT INTO group_members ( group_id, user_id, permission_id )
@@ -423,18 +1408,107 @@ def insert_group_member(cursor, group_guid, username, permission_name):
 
     cursor.execute(sql, (group_guid, username, permission_name))
 
-    cursor.connection.commit()
+    bump_group_version(cursor, group_guid)
+    commit(cursor)
+
+    forget_permissions(group_guid, username)
+
+
+@reads
+def find_users(cursor, emails, usernames):
+    """
+    Resolve emails and usernames to user ids with a single query, or one per backend.max_params
+    names for longer lists.
+
+    :return: (dict of user_id by email, dict of user_id by username)
+    """
+    names = [("email", utf_encode(email)) for email in emails]
+    names.extend(("username", utf_encode(username)) for username in usernames)
+
+    by_email = {}
+    by_username = {}
+    for chunk in param_chunks(names):
+        conditions = []
+        params = []
+        for column in ("email", "username"):
+            values = [value for name_column, value in chunk if name_column == column]
+            if values:
+                conditions.append("{0} IN ({1})".format(column, ", ".join(["%s"] * len(values))))
+                params.extend(values)
 
+        sql = """
+            SELECT user_id, email, username
+            FROM users
+            WHERE {0}
+        """.format(" OR ".join(conditions))
 
+        cursor.execute(sql, params)
+
+        for user_id, email, username in cursor.fetchall():
+            by_email[email] = user_id
+            by_username[username] = user_id
+
+    return by_email, by_username
+
+
+@writes
+def insert_members(cursor, group_guid, user_ids, permission_id):
+    """
+    Add (or update the permission of) several users in one multi-row statement, or one per
+    backend.max_params users for longer lists.
+    """
+    if not user_ids:
+        return
+
+    sql = """
+        REPLACE INTO group_members(group_id, user_id, permission_id)
+        SELECT groups.group_id, users.user_id, %s
+        FROM groups JOIN users
+        WHERE groups.guid = %s
+            AND users.user_id IN ({0})
+    """
+
+    group_guid = utf_encode(group_guid)
+
+    for chunk in param_chunks(list(user_ids), reserved=2):
+        cursor.execute(sql.format(", ".join(["%s"] * len(chunk))), [permission_id, group_guid] + chunk)
+
+    bump_group_version(cursor, group_guid)
+    commit(cursor)
+
+    forget_permissions(group_guid)
+
+
+@writes
 def add_to_group(cursor, group_guid, emails, usernames, permission_id):
-    for email in emails:
-        if is_valid_email(cursor, email):
-            insert_member_by_email(cursor, group_guid, email, permission_id)
-    for username in usernames:
-        if is_valid_username(cursor, username):
-            insert_member_by_username(cursor, group_guid, username, permission_id)
+    """
+    Add the users named by email address or username to a group, using one lookup query and one
+    insert for the whole list.
+
+    :return: the emails and usernames which did not match any user
+    """
+    by_email, by_username = find_users(cursor, emails, usernames)
+
+    # MySQL compares case-insensitively, so match the returned values the same way
+    by_email = dict((email.lower(), user_id) for email, user_id in by_email.items())
+    by_username = dict((username.lower(), user_id) for username, user_id in by_username.items())
+
+    user_ids = set()
+    not_found = []
+    for names, found in ((emails, by_email), (usernames, by_username)):
+        for name in names:
+            user_id = found.get(name.lower())
+            if user_id is None:
+                not_found.append(name)
+            else:
+                user_ids.add(user_id)
+
+    insert_members(cursor, group_guid, sorted(user_ids), permission_id)
 
+    return not_found
 
+
+@reads
 def get_groups(cursor, username):
     sql = """
         SELECT groups.group_id, groups.guid, groups.name
@@ -448,34 +1522,163 @@ def get_groups(cursor, username):
 
     cursor.execute(sql, username)
 
-    groups = []
+    return fetch_records(cursor, Group)
+
+
+@reads
+def get_groups_page(cursor, username, after=None, limit=PAGE_SIZE):
+    """
+    One page of the user's groups, ordered by name.
 
-    group = cursor.fetchone()
-    while group is not None:
-        groups.append({
-            "group_id": group[0],
-            "guid": group[1],
-            "name": group[2]
-        })
-        group = cursor.fetchone()
+    :return: (list of Group, cursor for the next page or None), see fetch_page
+    """
+    sql = """
+        SELECT groups.group_id, groups.guid, groups.name
+        FROM users
+        JOIN group_members USING (user_id)
+        JOIN groups USING (group_id)
+        WHERE users.username = %s {seek}
+        ORDER BY groups.name, groups.group_id
+        LIMIT %s
+    """
+
+    return fetch_page(cursor, sql, [utf_encode(username)], Group,
+                      [("groups.name", "name"), ("groups.group_id", "group_id")], after, limit)
+
+
+def find_moved_location(old_order, new_order):
+    """
+    Work out whether new_order is old_order with a single location moved, as produced by one drag
+    in the UI.
+
+    :return: (location guid, guid it now precedes or None for the end), or None if the orders differ
+        in any other way
+    """
+    if len(old_order) != len(new_order) or old_order == new_order:
+        return None
 
-    return groups
+    first = 0
+    while old_order[first] == new_order[first]:
+        first += 1
 
+    last = len(old_order) - 1
+    while old_order[last] == new_order[last]:
+        last -= 1
 
+    after = new_order[last + 1] if last + 1 < len(new_order) else None
+
+    # Moved towards the end of the trip
+    if old_order[first] == new_order[last] and old_order[first + 1:last + 1] == new_order[first:last]:
+        return new_order[last], after
+
+    # Moved towards the start of the trip
+    if new_order[first] == old_order[last] and new_order[first + 1:last + 1] == old_order[first:last]:
+        return new_order[first], new_order[first + 1]
+
+    return None
+
+
+@writes
 def insert_order(cursor, trip_guid, location_order):
+    """
+    Save a complete location order for a trip.  A reorder which only moves one location is applied
+    with move_location, so just that location's row changes.
+    """
+    current_order = get_order(cursor, trip_guid)
+
+    moved = find_moved_location(current_order, location_order)
+    if moved:
+        move_location(cursor, trip_guid, moved[0], moved[1])
+    elif current_order != location_order:
+        renumber_locations(cursor, trip_guid, location_order)
+
+
+@writes
+def move_location(cursor, trip_guid, location_guid, before_guid=None):
+    """
+    Move a location in front of another location of the same trip, or to the end of the trip.  The
+    moved location takes a position between its new neighbours, so normally it is the only row
+    updated.  The trip is renumbered only when the neighbours have no gap left between them.
+
+    :param cursor: Database cursor
+    :param trip_guid: Trip the locations belong to
+    :param location_guid: Location to move
+    :param before_guid: Location it should precede, None to move it to the end
+    """
+    if before_guid is None:
+        sql = """
+            SELECT MAX(locations.position)
+            FROM locations
+            JOIN trips USING (trip_id)
+            WHERE trips.guid = %s AND locations.guid != %s
+        """
+
+        cursor.execute(sql, (trip_guid, location_guid))
+        lower = cursor.fetchone()[0] or 0
+        upper = lower + 2 * POSITION_GAP
+    else:
+        sql = """
+            SELECT target.position,
+                   (SELECT MAX(previous.position)
+                    FROM locations previous
+                    WHERE previous.trip_id = target.trip_id
+                        AND previous.position < target.position
+                        AND previous.guid != %s)
+            FROM locations target
+            JOIN trips USING (trip_id)
+            WHERE trips.guid = %s AND target.guid = %s
+        """
+
+        cursor.execute(sql, (location_guid, trip_guid, before_guid))
+        neighbours = cursor.fetchone()
+        if not neighbours:
+            return
+
+        upper, lower = neighbours[0], neighbours[1] or 0
+
+    if upper - lower < 2:
+        order = [guid for guid in get_order(cursor, trip_guid) if guid != location_guid]
+        order.insert(order.index(before_guid), location_guid)
+        renumber_locations(cursor, trip_guid, order)
+        return
+
     sql = """
-       REPLACE INTO trip_locations (trip_id, location_order)
-       SELECT trips.trip_id, %s
-       FROM trips WHERE trips.guid=%s
+        UPDATE locations
+        SET position = %s
+        WHERE trip_id = (SELECT trip_id FROM trips WHERE trips.guid = %s)
+            AND guid = %s
     """
 
-    location_order = json.dumps(location_order)
+    cursor.execute(sql, ((lower + upper) // 2, trip_guid, location_guid))
+
+    bump_trip_version(cursor, trip_guid)
+    commit(cursor)
+
 
-    cursor.execute(sql, (location_order, trip_guid))
+@writes
+def renumber_locations(cursor, trip_guid, location_order):
+    """
+    Give every location of a trip a fresh, evenly spaced position following location_order.
+    Locations missing from location_order keep their relative order after the listed ones.
+    """
+    ranks = dict((guid, idx) for idx, guid in enumerate(location_order))
+    current_order = get_order(cursor, trip_guid)
+    ordered = sorted(current_order, key=lambda guid: ranks.get(guid, len(ranks)))
 
-    cursor.connection.commit()
+    sql = """
+        UPDATE locations
+        SET position = %s
+        WHERE trip_id = (SELECT trip_id FROM trips WHERE trips.guid = %s)
+            AND guid = %s
+    """
 
+    cursor.executemany(sql, [((idx + 1) * POSITION_GAP, trip_guid, guid) for idx, guid in enumerate(ordered)])
 
+    bump_trip_version(cursor, trip_guid)
+    commit(cursor)
+
+
+@writes
 def change_trip_title(cursor, trip_guid, title):
     sql = """
         UPDATE trips
@@ -488,28 +1691,28 @@ def change_trip_title(cursor, trip_guid, title):
     print(title)
     cursor.execute(sql, (title, trip_guid))
 
-    cursor.connection.commit()
+    bump_trip_version(cursor, trip_guid)
+    bump_trip_group_version(cursor, trip_guid)
+    commit(cursor)
 
 
+@reads
 def get_order(cursor, trip_guid):
+    """Guids of a trip's locations, in order"""
     sql = """
-        SELECT location_order
-        FROM trip_locations
+        SELECT locations.guid
+        FROM locations
         JOIN trips using (trip_id)
         WHERE trips.guid=%s
+        ORDER BY locations.position, locations.location_id
     """
 
     cursor.execute(sql, trip_guid)
 
-    locations = cursor.fetchone()
-    if not locations:
-        return None
-
-    locations = json.loads(locations[0])
-
-    return locations
+    return [row[0] for row in cursor.fetchall()]
 
 
+@reads
 def get_permissions(cursor):
     sql = """
         SELECT permission_id, name
@@ -518,20 +1721,22 @@ def get_permissions(cursor):
 
     cursor.execute(sql)
 
-    permissions = []
+    return fetch_records(cursor, Permission)
 
-    permission = cursor.fetchone()
-    while permission is not None:
-        permissions.append({
-            "permission_id": permission[0],
-            "name": permission[1]
-        })
-        permission = cursor.fetchone()
 
-    return permissions
+@primary
+def get_permission_name(cursor, username, group_guid):
+    """
+    Name of the permission a user holds in a group, None if the user is not a member.  Answers are
+    served from permission_cache when possible, and otherwise read from the primary, so a lagging
+    replica's answer is never cached.
+    """
+    key = (utf_decode(username), utf_decode(group_guid))
 
+    permission = permission_cache.get(key)
+    if permission is not cache.MISSING:
+        return permission
 
-def has_permissions(cursor, username, group_guid, permissions):
     sql = """
         SELECT permissions.name
         FROM users
@@ -542,17 +1747,39 @@ def has_permissions(cursor, username, group_guid, permissions):
             AND groups.guid = %s
     """
 
-    username = utf_encode(username)
-    group_guid = utf_encode(group_guid)
+    cursor.execute(sql, (utf_encode(username), utf_encode(group_guid)))
+
+    row = cursor.fetchone()
+    permission = row[0] if row else None
+
+    permission_cache.set(key, permission)
+
+    return permission
 
-    cursor.execute(sql, (username, group_guid))
 
-    permission = cursor.fetchone()[0]
+@primary
+def has_permissions(cursor, username, group_guid, permissions):
+    return get_permission_name(cursor, username, group_guid) in permissions
+
+
+@reads
+def get_permission_flags(cursor):
+    sql = """
+        SELECT permission_id, name, can_read, can_write, can_delete, can_modify_group
+        FROM permissions
+        ORDER BY permission_id
+    """
+
+    cursor.execute(sql)
 
-    return permission in permissions
+    return fetch_records(cursor, PermissionFlags)
 
 
+@reads
 def get_permissions_list(cursor, column_name):
+    if column_name not in PERMISSION_CAPABILITIES:
+        raise ValueError("Unknown permission capability: {0}".format(column_name))
+
     sql = """
         SELECT name
         FROM permissions
@@ -570,6 +1797,7 @@ def get_permissions_list(cursor, column_name):
     return permission_names
 
 
+@reads
 def get_members(cursor, guid):
     sql = """
         SELECT users.username, permissions.name
@@ -582,17 +1810,31 @@ def get_members(cursor, guid):
 
     cursor.execute(sql, guid)
 
-    members = cursor.fetchall()
+    return fetch_records(cursor, Member)
 
-    member_list = []
-    for member in members:
-        member_list.append({
-            "name": member[0],
-            "permission": member[1]
-        })
-    return member_list
 
+@reads
+def get_members_page(cursor, guid, after=None, limit=PAGE_SIZE):
+    """
+    One page of a group's members, ordered by username (which is unique).
 
+    :return: (list of Member, cursor for the next page or None), see fetch_page
+    """
+    sql = """
+        SELECT users.username, permissions.name
+        FROM groups
+        JOIN group_members USING (group_id)
+        JOIN permissions USING (permission_id)
+        JOIN users USING (user_id)
+        WHERE groups.guid = %s {seek}
+        ORDER BY users.username
+        LIMIT %s
+    """
+
+    return fetch_page(cursor, sql, [guid], Member, [("users.username", "name")], after, limit)
+
+
+@reads
 def get_group_name(cursor, guid):
     sql = """
         SELECT name
@@ -606,6 +1848,8 @@ def get_group_name(cursor, guid):
 
     return name
 
+
+@reads
 def is_unique_email(cursor, email):
     sql = """
         SELECT email
@@ -623,6 +1867,7 @@ def is_unique_email(cursor, email):
     return False
 
 
+@reads
 def is_unique_username(cursor, username):
     sql = """
         SELECT username
@@ -640,34 +1885,71 @@ def is_unique_username(cursor, username):
     return False
 
 
+@writes
 def user_logged_in(cursor, username):
     """Update statistics about user logging in"""
 
     sql = """
-    UPDATE users SET last_login=NOW(), login_count=login_count + 1
+    UPDATE users SET last_login=CURRENT_TIMESTAMP, login_count=login_count + 1
     WHERE users.username = %s
     """
 
     username = utf_encode(username)
     cursor.execute(sql, username)
-    cursor.connection.commit()
+    commit(cursor)
 
 
+@writes
+def record_logins(cursor, logins):
+    """
+    Apply merged login statistics for many users with one statement, or one per backend.max_params / 3
+    users for longer lists.  last_login is set to the database's current time.
+
+    :param cursor: Database cursor
+    :param logins: dict of username to number of logins.  Usernames must be distinct ignoring case:
+        MySQL compares them case-insensitively and only applies the first matching WHEN.
+    """
+    if not logins:
+        return
+
+    sql = """
+    UPDATE users SET login_count=login_count + CASE username {0} ELSE 0 END,
+                     last_login=CURRENT_TIMESTAMP
+    WHERE users.username IN ({1})
+    """
+
+    # Each username takes 3 parameters: WHEN, THEN and the IN list
+    for usernames in param_chunks(list(logins), per_value=3):
+        params = []
+        for username in usernames:
+            params.extend((utf_encode(username), logins[username]))
+        params.extend(utf_encode(username) for username in usernames)
+
+        cursor.execute(sql.format(" ".join(["WHEN %s THEN %s"] * len(usernames)), ", ".join(["%s"] * len(usernames))),
+                       params)
+
+    commit(cursor)
+
+
+@writes
 def user_is_verified(cursor, username):
-    """Mark that a user has been verified"""
+    """
+    Mark that a user has been verified.  The login which verified the account is counted by the
+    caller, like any other login.
+    """
 
     sql = """
-    UPDATE users SET verified=1, verification_token=NULL, verified_date=NOW(),
-                     last_login=NOW(), login_count=login_count+1
+    UPDATE users SET verified=1, verification_token=NULL, verified_date=CURRENT_TIMESTAMP
     WHERE users.username = %s
     """
 
     username = utf_encode(username)
 
     cursor.execute(sql, username)
-    cursor.connection.commit()
+    commit(cursor)
 
 
+@writes
 def set_verification_token(cursor, user_guid, token):
     """Record a new verification token for the user"""
 
@@ -677,4 +1959,4 @@ def set_verification_token(cursor, user_guid, token):
     """
 
     cursor.execute(sql, (token, user_guid))
-    cursor.connection.commit()
+    commit(cursor)
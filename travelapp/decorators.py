@@ -1,10 +1,13 @@
 from __future__ import absolute_import
 
 import functools
+import hashlib
+import os
+import time
 
 from . import dbutil
 
-from flask import session, redirect, url_for
+from flask import current_app, g, make_response, request, session, redirect, url_for
 
 
 def logged_in(func):
@@ -25,24 +28,117 @@ def logged_in(func):
     return decoration
 
 
+def request_cursor():
+    """
+    Cursor for the current request.  The first call creates the request's connection manager; the
+    pooled connection itself is checked out on the first query and returned in release_connection.
+
+    :return: lazily connected cursor
+    """
+    request_connection = getattr(g, 'db_connection', None)
+    if request_connection is None:
+        # A session which wrote recently reads its own writes from the primary
+        pinned = bool(dbutil.replicas) and session.get('db_primary_until', 0) > time.time()
+        request_connection = g.db_connection = dbutil.RequestConnection(pinned=pinned)
+
+    return dbutil.LazyCursor(request_connection)
+
+
+def release_connection(exception=None):
+    """
+    Teardown handler returning the request's connection, if one was checked out, to the pool.
+    """
+    request_connection = g.pop('db_connection', None)
+    if request_connection is None:
+        return
+
+    request_connection.release()
+
+
+def db_stats_headers(response):
+    """
+    After request handler reporting the request's query count and pool wait, in milliseconds, as
+    X-DB-Queries and X-DB-Pool-Wait headers.  Only active when the DB_STATS_HEADERS setting is on,
+    as it is for benchmarks/loadtest.py.
+    """
+    request_connection = getattr(g, 'db_connection', None)
+    if current_app.config.get('DB_STATS_HEADERS'):
+        response.headers['X-DB-Queries'] = str(request_connection.queries if request_connection else 0)
+        wait = request_connection.pool_wait if request_connection else 0.0
+        response.headers['X-DB-Pool-Wait'] = "{0:.3f}".format(wait * 1000)
+
+    return response
+
+
+def pin_to_primary(response):
+    """
+    After request handler keeping a session which wrote on the primary for the next
+    dbutil.READ_YOUR_WRITES_WINDOW seconds, so replica lag never hides a user's own changes from them.
+    """
+    request_connection = getattr(g, 'db_connection', None)
+    if request_connection is not None and request_connection.wrote and request_connection.replicas:
+        session['db_primary_until'] = time.time() + dbutil.READ_YOUR_WRITES_WINDOW
+
+    return response
+
+
 def with_cursor(func):
     """
-    Establish a database connection, and pass cursor to wrapped function
+    Pass the request's database cursor to the wrapped function.  Every view and helper in a request
+    shares one connection, which is only acquired when the first query runs.
 
     :param func: function requiring a database cursor
     :return: wrapped function
     """
     @functools.wraps(func)
     def decoration(*args, **kwargs):
-        conn = cursor = None
-        try:
-            conn = dbutil.connect()
-            kwargs['cursor'] = conn.cursor()
-            return func(*args, **kwargs)
-        finally:
-            if cursor:
-                cursor.close()
-            if conn:
-                conn.close()
+        kwargs['cursor'] = request_cursor()
+        return func(*args, **kwargs)
 
     return decoration
+
+
+def template_stamp():
+    """Latest modification time of the templates, so a deploy changing them changes every ETag"""
+    stamp = getattr(current_app, 'template_stamp', None)
+    if stamp is None:
+        folder = os.path.join(current_app.root_path, current_app.template_folder)
+        stamp = max([os.path.getmtime(os.path.join(folder, name)) for name in os.listdir(folder)] or [0])
+        current_app.template_stamp = stamp
+
+    return stamp
+
+
+def versioned(version_func):
+    """
+    Answer conditional GETs from a version stamp.  The ETag is derived from the stamp, the page and
+    the user, so If-None-Match is answered with 304 without running the view.
+
+    :param version_func: called with the view's arguments (including cursor), returns the page's
+        version stamp, or None when the page must always be rendered
+    :return: decorator
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def decoration(*args, **kwargs):
+            version = version_func(*args, **kwargs)
+
+            # Pending flash messages are only shown by rendering the page
+            if version is None or '_flashes' in session:
+                return func(*args, **kwargs)
+
+            key = "{0}|{1}|{2}|{3}".format(request.full_path, version, session.get('username'), template_stamp())
+            etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+            if etag in request.if_none_match:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(func(*args, **kwargs))
+
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+        return decoration
+
+    return decorator
@@ -1,3 +1,4 @@
+import atexit
 import socket
 
 from . import config as cfg
@@ -5,12 +6,15 @@ from . import config as cfg
 hostname = socket.gethostname()
 
 if hostname == cfg.DREAMHOST_HOST:
-    import subprocess
+    from . import outbox
 else:
-    import smtplib
+    from . import mailqueue
 
 from_user = cfg.APPLICATION_EMAIL
 
+GMAIL_HOST = "smtp.gmail.com"
+GMAIL_PORT = 587
+
 
 def create_message(send_to, subject, message):
     return """Subject: {2}
@@ -20,29 +24,29 @@ From: {1}
 {3}""".format(send_to, from_user, subject, message)
 
 
-def __gmail_email(send_to, subject, message):
-    server = smtplib.SMTP("smtp.gmail.com", 587)
-    server.ehlo()
-    server.starttls()
-    server.login(cfg.GMAIL_USER, cfg.GMAIL_PW)
+def gmail_session():
+    return mailqueue.SmtpSession(GMAIL_HOST, GMAIL_PORT, cfg.GMAIL_USER, cfg.GMAIL_PW)
 
+
+def __gmail_email(send_to, subject, message):
     message = create_message(send_to, subject, message)
 
-    server.sendmail(from_user, send_to, message)
+    dispatcher.send(from_user, send_to, message)
 
 
 def __dreamhost_email(send_to, subject, message):
-    sendmail = "/usr/sbin/sendmail"
-
-    proc = subprocess.Popen(sendmail + ' -t ' + send_to,
-                            shell=True, stdin=subprocess.PIPE)
-
     message = create_message(send_to, subject, message)
 
-    proc.communicate(message)
+    # Delivered by the outbox drain process, python -m travelapp.outbox
+    spool.put(from_user, [send_to], message)
 
 
 if hostname == cfg.DREAMHOST_HOST:
+    spool = outbox.Outbox(cfg.OUTBOX_DIR)
+
     send_email = __dreamhost_email
 else:
+    dispatcher = mailqueue.MailDispatcher(gmail_session)
+    atexit.register(dispatcher.close)
+
     send_email = __gmail_email
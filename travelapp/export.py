@@ -0,0 +1,104 @@
+"""
+Streaming export of locations as GeoJSON, CSV or GPX.
+
+Each writer takes an iterable of dbutil.ExportLocation and yields the file a chunk of locations at a
+time, so an export is sent while it is still being read from the database.
+"""
+import csv
+import io
+import itertools
+from xml.sax.saxutils import escape, quoteattr
+
+from . import jsonutil
+
+# Locations written per chunk
+CHUNK_SIZE = 500
+
+
+def _chunks(locations, size=CHUNK_SIZE):
+    locations = iter(locations)
+    while True:
+        chunk = list(itertools.islice(locations, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _date(value):
+    return value.isoformat() if value else ""
+
+
+def write_geojson(locations):
+    yield u'{"type":"FeatureCollection","features":['
+
+    first = True
+    for chunk in _chunks(locations):
+        features = [{
+            "type": "Feature",
+            "geometry": {"type": "Point", "coordinates": [location.longitude, location.latitude]},
+            "properties": {
+                "guid": location.guid,
+                "title": location.title,
+                "arrivalDate": location.arrivalDate,
+                "departureDate": location.departureDate,
+                "url": location.url,
+                "trip_guid": location.trip_guid,
+                "trip_title": location.trip_title,
+            },
+        } for location in chunk]
+
+        # Join the chunk's features on to the previous chunk's, without the array brackets
+        yield (u"" if first else u",") + jsonutil.dumps(features)[1:-1]
+        first = False
+
+    yield u"]}"
+
+
+CSV_HEADER = ["trip_guid", "trip_title", "guid", "title", "latitude", "longitude", "arrivalDate", "departureDate",
+              "url"]
+
+
+def write_csv(locations):
+    output = io.StringIO()
+    writer = csv.writer(output)
+
+    writer.writerow(CSV_HEADER)
+    for chunk in _chunks(locations):
+        for location in chunk:
+            writer.writerow([location.trip_guid, location.trip_title, location.guid, location.title, location.latitude,
+                             location.longitude, _date(location.arrivalDate), _date(location.departureDate),
+                             location.url or ""])
+
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+
+    # Only the header, for an empty export
+    if output.getvalue():
+        yield output.getvalue()
+
+
+def write_gpx(locations):
+    yield (u'<?xml version="1.0" encoding="UTF-8"?>\n'
+           u'<gpx version="1.1" creator="travelapp" xmlns="http://www.topografix.com/GPX/1/1">\n')
+
+    for chunk in _chunks(locations):
+        points = []
+        for location in chunk:
+            point = u'<wpt lat="{0}" lon="{1}"><name>{2}</name>'.format(location.latitude, location.longitude,
+                                                                        escape(location.title))
+            if location.url:
+                point += u'<link href={0}/>'.format(quoteattr(location.url))
+            points.append(point + u'<type>{0}</type></wpt>\n'.format(escape(location.trip_title)))
+
+        yield u"".join(points)
+
+    yield u"</gpx>\n"
+
+
+# Format name: (writer, mimetype, file extension)
+FORMATS = {
+    "geojson": (write_geojson, "application/geo+json", "geojson"),
+    "csv": (write_csv, "text/csv", "csv"),
+    "gpx": (write_gpx, "application/gpx+xml", "gpx"),
+}
@@ -1,33 +1,40 @@
-from flask import Flask, request, render_template, url_for, redirect, session, flash, jsonify, Markup
+from flask import Flask, Response, request, render_template, url_for, redirect, session, flash, jsonify, Markup
 from flask_wtf import FlaskForm
-from wtforms import StringField, DecimalField, DateField, PasswordField, SelectField, HiddenField, validators
+from wtforms import StringField, DecimalField, DateField, PasswordField, SelectField, HiddenField, FileField, validators
 from wtforms.fields.html5 import URLField, EmailField
 from . import config as cfg
 from . import dbutil
-#from . import helpers
-import json
-from datetime import datetime, date
-
-from .decorators import logged_in, with_cursor
+from .permissions import registry as permission_registry
+from .loginstats import login_stats
+from . import export
+from . import helpers
+from . import importer
+from . import jsonutil
+from . import metrics
+from . import routing
+
+from .decorators import logged_in, with_cursor, release_connection, request_cursor, versioned, db_stats_headers, \
+    pin_to_primary
 
 app = Flask(__name__)
 app.secret_key = "Development Key"
+app.teardown_appcontext(release_connection)
+app.after_request(db_stats_headers)
+app.after_request(pin_to_primary)
 #app.config["SERVER_NAME"] = cfg.SERVER_NAME
 
 
+@app.before_first_request
+def load_reference_data():
+    permission_registry.load(request_cursor())
+    helpers.prewarm_email_servers()
+
+
 def has_permissions(cursor, group_guid, permissions):
     username = session['username']
     return dbutil.has_permissions(cursor, username, group_guid, permissions)
 
 
-def jsonDefault(obj):
-    if isinstance(obj, (datetime, date)):
-        serial = obj.isoformat()
-        return serial
-
-    return json.dumps(obj, default=jsonDefault)
-
-
 class LoginForm(FlaskForm):
     username = StringField('Username',
                            [validators.InputRequired('  *Please enter your username'), validators.Length(max=64)])
@@ -55,7 +62,7 @@ def login(cursor):
         elif validation_state:
             # Validated and username/password match
             session['username'] = username
-            dbutil.user_logged_in(cursor, username)
+            login_stats.record(username)
 
             return redirect(url_for('index'))
         else:
@@ -72,72 +79,151 @@ def request_validation(user_guid, cursor):
     return redirect(url_for("login"))
 
 
+def listing_version(cursor):
+    return dbutil.get_listing_version(cursor, session['username'])
+
+
+def page_response(records, next_page):
+    """JSON body of one page of a listing, for infinite scroll"""
+    body = jsonutil.dumps({"items": dbutil.as_dicts(records), "next": next_page})
+    return Response(body, mimetype='application/json')
+
+
+def invalid_page():
+    return jsonify(error="Invalid page cursor"), 400
+
+
 @app.route('/')
 @logged_in
 @with_cursor
+@versioned(listing_version)
 def index(cursor):
     username = session['username']
-    trips = dbutil.get_trips(cursor, username)
-    return render_template('trips.html', trips=trips)
+    try:
+        trips, next_page = dbutil.get_trips_page(cursor, username, request.args.get('after'))
+    except ValueError:
+        return redirect(url_for('index'))
+    return render_template('trips.html', trips=trips, next_page=next_page)
+
+
+@app.route('/listTrips')
+@logged_in
+@with_cursor
+@versioned(listing_version)
+def list_trips(cursor):
+    try:
+        trips, next_page = dbutil.get_trips_page(cursor, session['username'], request.args.get('after'))
+    except ValueError:
+        return invalid_page()
+    return page_response(trips, next_page)
 
 
 @app.route('/groups')
 @logged_in
 @with_cursor
+@versioned(listing_version)
 def groups(cursor):
     username = session['username']
-    user_groups = dbutil.get_groups(cursor, username)
-    return render_template('groups.html', groups=user_groups)
+    try:
+        user_groups, next_page = dbutil.get_groups_page(cursor, username, request.args.get('after'))
+    except ValueError:
+        return redirect(url_for('groups'))
+    return render_template('groups.html', groups=user_groups, next_page=next_page)
+
+
+@app.route('/listGroups')
+@logged_in
+@with_cursor
+@versioned(listing_version)
+def list_groups(cursor):
+    try:
+        user_groups, next_page = dbutil.get_groups_page(cursor, session['username'], request.args.get('after'))
+    except ValueError:
+        return invalid_page()
+    return page_response(user_groups, next_page)
 
 
 @app.route('/group/<guid>')
 @logged_in
 @with_cursor
+@versioned(lambda guid, cursor: dbutil.get_group_version(cursor, guid))
 def group(guid, cursor):
     name = dbutil.get_group_name(cursor, guid)
-    members = dbutil.get_members(cursor, guid)
-    return render_template('group.html', members=members, guid=guid, group_name=name)
-
+    try:
+        members, next_page = dbutil.get_members_page(cursor, guid, request.args.get('after'))
+    except ValueError:
+        return redirect(url_for('group', guid=guid))
+    return render_template('group.html', members=members, guid=guid, group_name=name, next_page=next_page)
 
-def sortLocations(order, locations):
-    new_locations = dict()
 
-    for idx, location_guid in enumerate(order):
-        new_locations[location_guid] = idx
-
-    result = [None] * len(order)
-
-    for location in locations:
-        if location['guid'] in new_locations:
-            result[new_locations[location['guid']]] = location
-        else:
-            result.append(location)
-
-    return [location for location in result if location]
+@app.route('/listMembers/<guid>')
+@logged_in
+@with_cursor
+@versioned(lambda guid, cursor: dbutil.get_group_version(cursor, guid))
+def list_members(guid, cursor):
+    try:
+        members, next_page = dbutil.get_members_page(cursor, guid, request.args.get('after'))
+    except ValueError:
+        return invalid_page()
+    return page_response(members, next_page)
 
 
 @app.route('/trip/<guid>')
 @logged_in
 @with_cursor
+@versioned(lambda guid, cursor: dbutil.get_trip_version(cursor, guid))
 def trip(guid, cursor):
-    location_data = dbutil.get_locations(cursor, guid)
-    user_trip = dbutil.get_trip(cursor, guid)
+    user_trip, location_data = dbutil.load_trip(cursor, guid)
 
     if not user_trip:
         return redirect(url_for('index'))
 
-    if user_trip['order']:
-        location_data = sortLocations(user_trip['order'], location_data)
-
     return render_template(
         'maps.html',
         APIKEY=cfg.GOOGLE_MAPS_API,
         GOOGLE_PLACE_API=cfg.GOOGLE_PLACE_API,
-        location_data=json.dumps(location_data, default=jsonDefault),
+        location_data=jsonutil.script_dumps(location_data),
         locations=location_data,
         trip=user_trip)
 
 
+@app.route('/tripLocations/<guid>')
+@logged_in
+@with_cursor
+@versioned(lambda guid, cursor: dbutil.get_trip_version(cursor, guid))
+def trip_locations(guid, cursor):
+    user_trip, location_data = dbutil.load_trip(cursor, guid)
+
+    if not user_trip:
+        return jsonify(error="No such trip"), 404
+
+    return Response(jsonutil.iterencode(location_data), mimetype='application/json')
+
+
+# Locations from the user's trips near a point (lat, lng, radius in meters) or inside a box (south, west,
+# north, east), nearest first
+@app.route('/nearby')
+@logged_in
+@with_cursor
+def nearby(cursor):
+    args = request.args
+    username = session['username']
+    limit = min(args.get('limit', 100, type=int), 1000)
+
+    box = [args.get(name, type=float) for name in ('south', 'west', 'north', 'east')]
+    if None not in box:
+        found = dbutil.find_locations_in_box(cursor, username, *box, limit=limit)
+    else:
+        latitude = args.get('lat', type=float)
+        longitude = args.get('lng', type=float)
+        radius = args.get('radius', 1000.0, type=float)
+        if latitude is None or longitude is None:
+            return jsonify(error="lat and lng, or south, west, north and east are required"), 400
+        found = dbutil.find_nearby_locations(cursor, username, latitude, longitude, radius, limit)
+
+    return Response(jsonutil.dumps(found), mimetype='application/json')
+
+
 class LocationForm(FlaskForm):
     title = StringField('Location Name',
                         [validators.InputRequired('  *Please input a location'), validators.Length(max=128)])
@@ -173,6 +259,38 @@ def addLocation(guid, cursor):
     return render_template('newLocation.html', form=form, GOOGLE_PLACE_API=cfg.GOOGLE_PLACE_API)
 
 
+class ImportForm(FlaskForm):
+    locations = FileField('Locations file (.csv, .gpx or "name lat, lng" lines)',
+                          [validators.InputRequired('  *Please choose a file')])
+
+
+@app.route('/importLocations/<trip_guid>', methods=['GET', 'POST'])
+@logged_in
+@with_cursor
+def importLocations(trip_guid, cursor):
+    group_guid = dbutil.get_trip_group_guid(cursor, trip_guid)
+    if group_guid is None:
+        return redirect(url_for('index'))
+
+    if not has_permissions(cursor, group_guid, permission_registry.names_with("can_write")):
+        flash("You do not have permission to add locations to this trip")
+        return redirect(url_for('trip', guid=trip_guid))
+
+    form = ImportForm()
+    if form.validate_on_submit():
+        upload = form.locations.data
+        try:
+            file_format = importer.detect_format(upload.filename)
+            count, seconds = importer.import_locations(cursor, trip_guid, upload.stream, file_format)
+        except ValueError as e:
+            flash("Nothing was imported: {0}".format(e))
+        else:
+            flash("Imported {0} locations ({1:.0f} rows/sec)".format(count, count / max(seconds, 1e-6)))
+            return redirect(url_for('trip', guid=trip_guid))
+
+    return render_template('importLocations.html', form=form, trip_guid=trip_guid)
+
+
 @app.route('/deleteLocation/<trip_guid>/<location_guid>', methods=['GET'])
 @logged_in
 @with_cursor
@@ -192,6 +310,35 @@ def reorderLocations(trip_guid, cursor):
     return "", 200
 
 
+# GET describes the trip's legs and a shorter suggested order, POST also saves that order
+@app.route('/optimizeRoute/<trip_guid>', methods=['GET', 'POST'])
+@logged_in
+@with_cursor
+def optimizeRoute(trip_guid, cursor):
+    user_trip, location_data = dbutil.load_trip(cursor, trip_guid)
+
+    if not user_trip:
+        return jsonify(error="No such trip"), 404
+
+    order, legs, length, suggested_length = routing.optimize_order(location_data)
+
+    if request.method == 'POST':
+        dbutil.insert_order(cursor, trip_guid, order)
+
+    return jsonify(legs=legs, length=length, order=order, suggested_length=suggested_length)
+
+
+@app.route('/moveLocation/<trip_guid>', methods=['POST'])
+@logged_in
+@with_cursor
+def moveLocation(trip_guid, cursor):
+    location_guid = request.form.get("location")
+    before_guid = request.form.get("before") or None
+    dbutil.move_location(cursor, trip_guid, location_guid, before_guid)
+
+    return "", 200
+
+
 @app.route('/newShortLocation/<trip_guid>', methods=['GET', 'POST'])
 @logged_in
 @with_cursor
@@ -316,10 +463,11 @@ def addGroup(cursor):
     form = GroupForm()
     if form.validate_on_submit():
         name = form.name.data
-        guid = dbutil.insert_group(cursor, name)
         username = session['username']
 
-        dbutil.insert_group_member(cursor, guid, username, "OWNER")
+        with dbutil.transaction(cursor):
+            guid = dbutil.insert_group(cursor, name)
+            dbutil.insert_group_member(cursor, guid, username, "OWNER")
 
         return redirect(url_for('groups'))
 
@@ -329,13 +477,13 @@ def addGroup(cursor):
 def display_groups(form, cursor):
     username = session['username']
     user_groups = dbutil.get_groups(cursor, username)
-    choices = [(user_group['guid'], user_group['name']) for user_group in user_groups]
+    choices = [(user_group.guid, user_group.name) for user_group in user_groups]
     form.set_groups(choices)
 
 
-def display_permissions(form, cursor):
-    permissions = dbutil.get_permissions(cursor)
-    choices = [(permission['permission_id'], permission['name']) for permission in permissions]
+def display_permissions(form):
+    permissions = permission_registry.permissions()
+    choices = [(permission.permission_id, permission.name) for permission in permissions]
     form.set_permissions(choices)
 
 
@@ -344,6 +492,8 @@ def parseNames(names):
     usernames = []
     namelist = [name.strip() for name in names.split(',')]
     for name in namelist:
+        if not name:
+            continue
         if "@" in name:
             emails.append(name)
         else:
@@ -358,15 +508,17 @@ def parseNames(names):
 def addToGroup(cursor):
     form = AddToGroupForm()
     display_groups(form, cursor)
-    display_permissions(form, cursor)
+    display_permissions(form)
     if form.validate_on_submit():
         user_group = form.group.data
         names = form.names.data
-        permissions = dbutil.get_permissions_list(cursor, "can_modify_group")
+        permissions = permission_registry.names_with("can_modify_group")
         if has_permissions(cursor, user_group, permissions):
             permission = form.permission.data
             names = parseNames(names)
-            dbutil.add_to_group(cursor, user_group, names["emails"], names["usernames"], permission)
+            not_found = dbutil.add_to_group(cursor, user_group, names["emails"], names["usernames"], permission)
+            if not_found:
+                flash("No account was found for: {0}".format(", ".join(not_found)))
 
             return redirect(url_for('index'))
 
@@ -381,14 +533,16 @@ def addToGroup(cursor):
 @with_cursor
 def addToGroup2(guid, cursor):
     form = AddToGroupForm2()
-    display_permissions(form, cursor)
+    display_permissions(form)
     if form.validate_on_submit():
         names = form.names.data
-        permissions = dbutil.get_permissions_list(cursor, "can_modify_group")
+        permissions = permission_registry.names_with("can_modify_group")
         if has_permissions(cursor, guid, permissions):
             permission = form.permission.data
             names = parseNames(names)
-            dbutil.add_to_group(cursor, guid, names["emails"], names["usernames"], permission)
+            not_found = dbutil.add_to_group(cursor, guid, names["emails"], names["usernames"], permission)
+            if not_found:
+                flash("No account was found for: {0}".format(", ".join(not_found)))
 
             return redirect(url_for('group', guid=guid))
 
@@ -451,6 +605,56 @@ def deleteGroup(guid, cursor):
     return redirect(url_for('groups'))
 
 
+def export_response(stream_locations, guid, file_format, filename):
+    """
+    Stream an export straight from a server-side cursor.  The generator runs after the view has
+    returned, on a connection of its own, so the request's connection is already back in the pool.
+    """
+    writer, mimetype, extension = export.FORMATS[file_format]
+
+    def generate():
+        with dbutil.streaming_cursor() as cursor:
+            for chunk in writer(stream_locations(cursor, guid)):
+                yield chunk.encode('utf-8')
+
+    headers = {'Content-Disposition': 'attachment; filename="{0}.{1}"'.format(filename, extension)}
+    return Response(generate(), mimetype=mimetype, headers=headers)
+
+
+def can_read(cursor, group_guid):
+    return has_permissions(cursor, group_guid, permission_registry.names_with("can_read"))
+
+
+@app.route('/exportTrip/<guid>/<file_format>')
+@logged_in
+@with_cursor
+def exportTrip(guid, file_format, cursor):
+    group_guid = dbutil.get_trip_group_guid(cursor, guid)
+    if file_format not in export.FORMATS or group_guid is None or not can_read(cursor, group_guid):
+        return jsonify(error="No such trip or format"), 404
+
+    return export_response(dbutil.stream_trip_locations, guid, file_format, "trip-" + guid)
+
+
+@app.route('/exportGroup/<guid>/<file_format>')
+@logged_in
+@with_cursor
+def exportGroup(guid, file_format, cursor):
+    if file_format not in export.FORMATS or not can_read(cursor, guid):
+        return jsonify(error="No such group or format"), 404
+
+    return export_response(dbutil.stream_group_locations, guid, file_format, "group-" + guid)
+
+
+# Prometheus metrics of the database calls and pools, only served when metrics_enabled is set in _config.py
+@app.route('/metrics')
+def prometheus_metrics():
+    if not metrics.enabled:
+        return "Metrics are disabled", 404
+
+    return Response(metrics.render(dbutil.connection_pools()), content_type=metrics.CONTENT_TYPE)
+
+
 @app.route('/logout')
 def logout():
     session.clear()
@@ -474,6 +678,7 @@ def verification(token, cursor):
             session['username'] = username
             flash("Your account is now verified.  Welcome!")
             dbutil.user_is_verified(cursor, username)
+            login_stats.record(username)
             return redirect(url_for('index'))
         else:
             flash("Either the entered username is unknown, or the password did not match.  Please retry.")
@@ -0,0 +1,159 @@
+"""
+Geohashes and great circle distances.
+
+Every location stores the geohash of its coordinates.  Locations near each other share a geohash
+prefix, so the locations inside a bounding box are found with a few index range scans on the
+geohash column, one per cell covering the box.  Candidates from those scans are then filtered and
+ranked by exact distance with one vectorized haversine pass.
+"""
+import math
+
+import numpy
+
+EARTH_RADIUS = 6371008.8  # meters
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# Stored precision; 9 characters is a cell of about 5 x 5 meters
+GEOHASH_PRECISION = 9
+
+# Most index ranges one query scans.  Larger areas are covered with coarser, bigger cells.
+MAX_CELLS = 16
+
+
+def geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+
+    while len(chars) < precision:
+        if even:
+            interval, coordinate = lng_range, longitude
+        else:
+            interval, coordinate = lat_range, latitude
+
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(BASE32[value])
+            bits = 0
+            value = 0
+
+    return "".join(chars)
+
+
+def cell_size(precision):
+    """(height, width) in degrees of the cells of a geohash precision"""
+    lng_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lng_bits
+
+
+def bounding_box(latitude, longitude, radius):
+    """
+    Box containing every point within radius meters.
+
+    :return: (south, west, north, east) in degrees; west > east when the box crosses the
+        antimeridian
+    """
+    angle = math.degrees(radius / EARTH_RADIUS)
+    south = max(latitude - angle, -90.0)
+    north = min(latitude + angle, 90.0)
+
+    # Near a pole the box takes in every longitude
+    if north >= 90.0 or south <= -90.0 or angle >= 180.0:
+        return south, -180.0, north, 180.0
+
+    lng_angle = math.degrees(math.asin(min(math.sin(math.radians(angle)) / math.cos(math.radians(latitude)), 1.0)))
+    if lng_angle >= 180.0:
+        return south, -180.0, north, 180.0
+
+    west = (longitude - lng_angle + 540.0) % 360.0 - 180.0
+    east = (longitude + lng_angle + 540.0) % 360.0 - 180.0
+    return south, west, north, east
+
+
+def _split_box(south, west, north, east):
+    if west <= east:
+        return [(south, west, north, east)]
+    return [(south, west, north, 180.0), (south, -180.0, north, east)]
+
+
+def _cell_range(low, high, size, offset, count):
+    first = int((low + offset) // size)
+    last = int((high + offset) // size)
+    return range(max(first, 0), min(last, count - 1) + 1)
+
+
+def covering_cells(south, west, north, east, max_cells=MAX_CELLS):
+    """
+    Geohash prefixes whose cells together cover a bounding box, at the finest precision needing
+    no more than max_cells of them.
+
+    :return: list of geohash prefixes
+    """
+    boxes = _split_box(south, west, north, east)
+
+    cells = [""]
+    for precision in range(1, GEOHASH_PRECISION + 1):
+        height, width = cell_size(precision)
+        rows = int(round(180.0 / height))
+        columns = int(round(360.0 / width))
+
+        found = []
+        for box_south, box_west, box_north, box_east in boxes:
+            lat_cells = _cell_range(box_south, box_north, height, 90.0, rows)
+            lng_cells = _cell_range(box_west, box_east, width, 180.0, columns)
+            if len(found) + len(lat_cells) * len(lng_cells) > max_cells:
+                return cells
+
+            for row in lat_cells:
+                for column in lng_cells:
+                    found.append(geohash(-90.0 + (row + 0.5) * height, -180.0 + (column + 0.5) * width, precision))
+
+        cells = sorted(set(found))
+
+    return cells
+
+
+def prefix_range(prefix):
+    """(lowest, highest) stored geohash starting with prefix, for a BETWEEN condition"""
+    padding = GEOHASH_PRECISION - len(prefix)
+    return prefix + BASE32[0] * padding, prefix + BASE32[-1] * padding
+
+
+def distances(latitude, longitude, latitudes, longitudes):
+    """
+    Haversine distances in meters from one point to arrays of points.
+
+    :return: numpy array
+    """
+    lat1 = math.radians(latitude)
+    lat2 = numpy.radians(numpy.asarray(latitudes, dtype=numpy.float64))
+    delta_lat = lat2 - lat1
+    delta_lng = numpy.radians(numpy.asarray(longitudes, dtype=numpy.float64)) - math.radians(longitude)
+
+    a = numpy.sin(delta_lat / 2) ** 2 + math.cos(lat1) * numpy.cos(lat2) * numpy.sin(delta_lng / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0.0, 1.0)))
+
+
+def in_box(latitudes, longitudes, south, west, north, east):
+    """Boolean numpy mask of the points inside a bounding box"""
+    latitudes = numpy.asarray(latitudes, dtype=numpy.float64)
+    longitudes = numpy.asarray(longitudes, dtype=numpy.float64)
+
+    inside = (latitudes >= south) & (latitudes <= north)
+    if west <= east:
+        return inside & (longitudes >= west) & (longitudes <= east)
+    return inside & ((longitudes >= west) | (longitudes <= east))
@@ -1,10 +1,13 @@
 
 from flask import render_template
 import uuid
-import dns.resolver
 
+from . import config as cfg
 from . import dbutil
 from . import email
+from . import mxcache
+
+mx_cache = mxcache.MXCache()
 
 
 def send_user_validation_email(cursor, user_guid):
@@ -14,7 +17,7 @@ def send_user_validation_email(cursor, user_guid):
         print("Requested user does not exist:", user_guid)
         return
 
-    email_address = user.get('email', None)
+    email_address = user.email
     if not email_address:
         print("User does not have an email address: ", user_guid)
         return
@@ -39,9 +42,12 @@ def is_valid_email_server(user_email):
         return False
 
     email_server = email_parts[1]
-
-    try:
-        results = list(dns.resolver.query(email_server, 'MX'))
-        return len(results) > 0
-    except dns.resolver.NXDOMAIN:
+    if not email_server:
         return False
+
+    return mx_cache.has_mx(email_server)
+
+
+def prewarm_email_servers():
+    """Look up the mail servers of commonly used domains in the background"""
+    mx_cache.prewarm(cfg.MX_PREWARM_DOMAINS, background=True)
@@ -0,0 +1,210 @@
+"""
+Bulk import of locations from files.
+
+Supported formats:
+
+- csv: a header row naming the columns; title (or name), latitude (or lat) and longitude (or lng,
+  lon) are required, arrivalDate, departureDate (YYYY-MM-DD) and url are optional
+- gpx: waypoints, route points and track points; points without a name are numbered
+- coordinates: one "name lat, lng" line per location, as in the repository's coordinates file
+
+Files are parsed as they are read and written with dbutil.insert_locations, so a large file is
+never held in memory.
+"""
+import codecs
+import csv
+import datetime
+import os
+import re
+import time
+import xml.etree.ElementTree as ElementTree
+
+from . import dbutil
+
+CSV_COLUMNS = {
+    "title": ("title", "name"),
+    "latitude": ("latitude", "lat"),
+    "longitude": ("longitude", "lng", "lon"),
+    "arrivalDate": ("arrivaldate", "arrival_date", "arrival"),
+    "departureDate": ("departuredate", "departure_date", "departure"),
+    "url": ("url", "website"),
+}
+
+NUMBER = r"[-+]?\d+(?:\.\d*)?"
+COORDINATES_LINE = re.compile(r"^\s*(?P<title>.*?)\s+(?P<latitude>{0}),\s*(?P<longitude>{0})\s*$".format(NUMBER))
+
+# Longest title and url the locations table holds
+MAX_TITLE_LENGTH = 128
+MAX_URL_LENGTH = 256
+
+
+def make_location(line, title, latitude, longitude, arrival_date=None, departure_date=None, url=None):
+    """
+    Validate the fields of one location.
+
+    :param line: Line or point number, for error messages
+    :raises ValueError: for a missing title, an invalid coordinate or date, or a url too long to store
+    """
+    title = (title or "").strip()
+    if not title:
+        raise ValueError("Line {0}: missing title".format(line))
+
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+    except (TypeError, ValueError):
+        raise ValueError("Line {0}: invalid coordinates {1!r}, {2!r}".format(line, latitude, longitude))
+
+    if not -90.0 <= latitude <= 90.0 or not -180.0 <= longitude <= 180.0:
+        raise ValueError("Line {0}: coordinates out of range {1}, {2}".format(line, latitude, longitude))
+
+    # A shortened url would lead somewhere else, so unlike a title it is not truncated
+    url = (url or "").strip() or None
+    if url is not None and len(url) > MAX_URL_LENGTH:
+        raise ValueError("Line {0}: url longer than {1} characters".format(line, MAX_URL_LENGTH))
+
+    return dbutil.NewLocation(title[:MAX_TITLE_LENGTH], latitude, longitude, parse_date(line, arrival_date),
+                              parse_date(line, departure_date), url)
+
+
+def parse_date(line, value):
+    value = (value or "").strip()
+    if not value:
+        return None
+
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise ValueError("Line {0}: invalid date {1!r}, expected YYYY-MM-DD".format(line, value))
+
+
+def parse_csv(stream):
+    try:
+        for location in _parse_csv(stream):
+            yield location
+    except csv.Error as e:
+        raise ValueError("Invalid CSV file: {0}".format(e))
+
+
+def _parse_csv(stream):
+    reader = csv.reader(stream)
+    header = [name.strip().lower() for name in next(reader, [])]
+
+    indexes = {}
+    for field, aliases in CSV_COLUMNS.items():
+        for alias in aliases:
+            if alias in header:
+                indexes[field] = header.index(alias)
+                break
+
+    missing = [field for field in ("title", "latitude", "longitude") if field not in indexes]
+    if missing:
+        raise ValueError("CSV header is missing {0}".format(", ".join(missing)))
+
+    for row in reader:
+        if not any(value.strip() for value in row):
+            continue
+
+        fields = dict((field, row[idx] if idx < len(row) else None) for field, idx in indexes.items())
+        yield make_location(reader.line_num, fields["title"], fields["latitude"], fields["longitude"],
+                            fields.get("arrivalDate"), fields.get("departureDate"), fields.get("url"))
+
+
+def parse_coordinates(stream):
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+
+        match = COORDINATES_LINE.match(line)
+        if match is None:
+            raise ValueError("Line {0}: expected \"name lat, lng\"".format(number))
+
+        yield make_location(number, match.group("title"), match.group("latitude"), match.group("longitude"))
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _gpx_points(stream):
+    try:
+        for _, element in ElementTree.iterparse(stream):
+            if _local_name(element.tag) in ("wpt", "rtept", "trkpt"):
+                yield element
+    except ElementTree.ParseError as e:
+        raise ValueError("Invalid GPX file: {0}".format(e))
+
+
+def parse_gpx(stream):
+    for number, element in enumerate(_gpx_points(stream), 1):
+        title = None
+        url = None
+        for child in element:
+            name = _local_name(child.tag)
+            if name == "name":
+                title = child.text
+            elif name == "link":
+                url = child.get("href")
+
+        yield make_location(number, title or "Point {0}".format(number), element.get("lat"), element.get("lon"),
+                            url=url)
+
+        # Points already read are not needed again
+        element.clear()
+
+
+PARSERS = {
+    "csv": parse_csv,
+    "gpx": parse_gpx,
+    "coordinates": parse_coordinates,
+}
+
+EXTENSIONS = {
+    ".csv": "csv",
+    ".gpx": "gpx",
+    ".txt": "coordinates",
+    "": "coordinates",
+}
+
+
+def detect_format(filename):
+    """
+    :return: format name for a file name, judged by its extension
+    :raises ValueError: for an unknown extension
+    """
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension not in EXTENSIONS:
+        raise ValueError("Unknown file type {0!r}, expected one of {1}".format(
+            extension, ", ".join(sorted(name for name in EXTENSIONS if name))))
+
+    return EXTENSIONS[extension]
+
+
+def parse(stream, file_format):
+    """
+    Parse a binary stream.
+
+    :return: generator of dbutil.NewLocation
+    """
+    if file_format == "gpx":
+        return parse_gpx(stream)
+
+    if file_format not in PARSERS:
+        raise ValueError("Unknown import format {0!r}".format(file_format))
+
+    # utf-8-sig drops the byte order mark spreadsheet programs write
+    text = codecs.getreader("utf-8-sig")(stream)
+    return PARSERS[file_format](text)
+
+
+def import_locations(cursor, trip_guid, stream, file_format, batch_size=dbutil.INSERT_BATCH_SIZE):
+    """
+    Append the locations in a file to a trip, all or none of them.
+
+    :param stream: Binary file object
+    :return: (number of locations imported, seconds taken)
+    :raises ValueError: for a missing trip or invalid file; nothing is imported
+    """
+    start = time.time()
+    count = dbutil.insert_locations(cursor, trip_guid, parse(stream, file_format), batch_size)
+    return count, time.time() - start
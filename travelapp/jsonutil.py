@@ -0,0 +1,111 @@
+"""
+JSON encoding of dbutil records.
+
+Records (namedtuples), at any depth, are written as objects keyed by their field names; dates become ISO strings,
+Decimals numbers and bytes UTF-8 strings.  orjson is used when it is installed, and is what makes
+encoding faster; without it the standard library json module writes the same values in one pass,
+at about the cost of a plain json.dumps.
+
+dumps and iterencode are for JSON responses.  script_dumps is for a payload rendered inside a
+<script> block of a template.
+"""
+import datetime
+import decimal
+import itertools
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Records encoded per chunk by iterencode
+CHUNK_SIZE = 500
+
+
+def default(obj):
+    """Convert the values the JSON backends don't handle themselves"""
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode('utf-8')
+    if isinstance(obj, tuple) and hasattr(obj, '_fields'):
+        return dict(zip(obj._fields, obj))
+
+    raise TypeError("{0!r} is not JSON serializable".format(obj))
+
+
+_CONTAINERS = (tuple, list, dict)
+
+
+def _has_containers(values):
+    return any(map(isinstance, values, itertools.repeat(_CONTAINERS)))
+
+
+def _prepare(value):
+    """
+    Records become dicts, at any depth; the json module would otherwise write a namedtuple as an
+    array.  Only containers are walked, so a list of flat records costs one dict per record.
+    """
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        if _has_containers(value):
+            return dict((field, _prepare(item)) for field, item in zip(value._fields, value))
+        return dict(zip(value._fields, value))
+
+    if isinstance(value, dict):
+        if _has_containers(value.values()):
+            return dict((key, _prepare(item)) for key, item in value.items())
+        return value
+
+    if isinstance(value, (list, tuple)):
+        return [_prepare(item) if isinstance(item, _CONTAINERS) else item for item in value]
+
+    return value
+
+
+def _encode(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=default).decode('utf-8')
+    return json.dumps(value, separators=(',', ':'), default=default)
+
+
+def dumps(value):
+    """
+    Encode a record, a list of records or any plain JSON value.
+
+    :return: str
+    """
+    return _encode(_prepare(value))
+
+
+def script_dumps(value):
+    """
+    Encode a value for a template to place inside a <script> block.  "<" is written as \\u003c, so
+    no string can close the block or open a comment; orjson also leaves the JavaScript line
+    separators unescaped, which older browsers reject in a string literal.
+
+    :return: str
+    """
+    text = dumps(value)
+    if "<" in text:
+        text = text.replace("<", "\\u003c")
+    if orjson is not None:
+        text = text.replace(u"\u2028", "\\u2028").replace(u"\u2029", "\\u2029")
+    return text
+
+
+def iterencode(records, chunk_size=CHUNK_SIZE):
+    """
+    Encode a list of records as a JSON array, a chunk of records at a time, so a large payload is
+    never held as one string.
+
+    :return: generator of str
+    """
+    yield u"["
+    for start in range(0, len(records), chunk_size):
+        chunk = _encode(_prepare(records[start:start + chunk_size]))
+        # Drop the chunk's brackets and join it to the previous one
+        yield (u"," if start else u"") + chunk[1:-1]
+    yield u"]"
@@ -0,0 +1,118 @@
+"""
+Write-behind buffer for login statistics.
+
+Logins are recorded in memory and merged per user.  A background thread writes them to the users
+table in one statement per batch, either every flush_interval seconds or as soon as max_pending
+users are waiting.  Pending counts are written out when the process exits.
+
+Usernames compare case-insensitively in MySQL, so logins are merged by the lowercased name, and
+last_login is set from the database clock when the batch is written, like the other timestamps.
+"""
+import atexit
+import threading
+
+from . import dbutil
+
+
+class LoginStatsBuffer(object):
+
+    def __init__(self, flush_interval=5.0, max_pending=500, connect=dbutil.connect):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.connect = connect
+        self.flushed = 0
+        self.failures = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def record(self, username):
+        """
+        Count a login.  Returns immediately; the database is updated by the next flush.
+
+        :param username: User who logged in
+        """
+        key = username.lower()
+
+        with self._lock:
+            # Pending entries are (username as first logged in, number of logins)
+            first_username, count = self._pending.get(key, (username, 0))
+            self._pending[key] = (first_username, count + 1)
+            pending = len(self._pending)
+
+            if self._thread is None and not self._stopping.is_set():
+                self._thread = threading.Thread(target=self._run, name="login-stats")
+                self._thread.daemon = True
+                self._thread.start()
+
+        if pending >= self.max_pending:
+            self._wake.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Write every pending login to the database.  Failed batches are kept for the next flush."""
+        with self._flush_lock:
+            with self._lock:
+                logins, self._pending = self._pending, {}
+
+            if not logins:
+                return 0
+
+            keys = list(logins)
+            written = 0
+            conn = cursor = None
+            try:
+                conn = self.connect()
+                cursor = conn.cursor()
+
+                for start in range(0, len(keys), self.max_pending):
+                    batch = keys[start:start + self.max_pending]
+                    dbutil.record_logins(cursor, dict(logins[key] for key in batch))
+                    written = start + len(batch)
+            except Exception as e:
+                self.failures += 1
+                print("Unable to save login statistics:", e)
+                self._merge_back(dict((key, logins[key]) for key in keys[written:]))
+                self.flushed += written
+                return written
+            finally:
+                if cursor:
+                    cursor.close()
+                if conn:
+                    conn.close()
+
+            self.flushed += written
+            return written
+
+    def _merge_back(self, logins):
+        with self._lock:
+            for key, (username, count) in logins.items():
+                _, pending_count = self._pending.get(key, (username, 0))
+                self._pending[key] = (username, count + pending_count)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        """Stop the background thread and write out everything still pending"""
+        self._stopping.set()
+        self._wake.set()
+
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+        self.flush()
+
+
+login_stats = LoginStatsBuffer()
+atexit.register(login_stats.close)
@@ -0,0 +1,248 @@
+"""
+Background delivery of outgoing mail.
+
+Requests enqueue messages on a MailDispatcher and return immediately.  Worker threads deliver them
+over SmtpSessions, which keep one authenticated connection open between messages and reconnect when
+the server drops it.  Deliveries which fail temporarily are retried with a growing delay, without
+holding up the rest of the queue; a permanent (5xx) rejection fails the message at once.
+"""
+import heapq
+import itertools
+import queue
+import smtplib
+import threading
+import time
+
+# Errors after which the connection is discarded and re-established.  Every SMTPException is also an
+# OSError, so socket failures are told apart from SMTP replies by is_connection_error.
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError)
+
+
+def is_connection_error(error):
+    """Whether the connection failed, as opposed to the server rejecting the message"""
+    if isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def is_permanent(error):
+    """Whether the server rejected the message in a way retrying cannot fix: a 5xx reply"""
+    if is_connection_error(error):
+        return False
+
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(500 <= code < 600 for code, _ in error.recipients.values())
+
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 500 <= error.smtp_code < 600
+
+    # e.g. SMTPNotSupportedError, a server lacking a required extension
+    return isinstance(error, smtplib.SMTPException)
+
+
+class SmtpSession(object):
+    """
+    A reusable SMTP connection.  Use starttls=False and no credentials for a local stand-in server,
+    e.g. one started with aiosmtpd.
+    """
+
+    def __init__(self, host, port, username=None, password=None, starttls=True, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.connects = 0
+        self._server = None
+
+    @property
+    def connected(self):
+        return self._server is not None
+
+    def connect(self):
+        self.close()
+
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        server.ehlo()
+        if self.starttls:
+            server.starttls()
+            server.ehlo()
+        if self.username:
+            server.login(self.username, self.password)
+
+        self._server = server
+        self.connects += 1
+
+    def send(self, from_addr, to_addrs, message):
+        """
+        Send one message, connecting first if needed.  A connection which turns out to be dead is
+        replaced once before giving up; a reply rejecting the message is raised as it is.
+        """
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+
+        if self._server is None:
+            self.connect()
+
+        try:
+            self._server.sendmail(from_addr, to_addrs, message)
+        except CONNECTION_ERRORS as e:
+            if not is_connection_error(e):
+                raise
+
+            self.connect()
+            self._server.sendmail(from_addr, to_addrs, message)
+
+    def close(self):
+        server, self._server = self._server, None
+        if server is None:
+            return
+
+        try:
+            server.quit()
+        except CONNECTION_ERRORS:
+            server.close()
+
+
+class MailDispatcher(object):
+    """
+    Queue of outgoing messages delivered by worker threads, each with its own SmtpSession.  A
+    failed delivery is not waited for: the message is set aside until its retry is due, and the
+    worker goes on with the rest of the queue.
+
+    :param session_factory: Callable returning a new SmtpSession
+    :param workers: Number of delivery threads
+    :param max_attempts: Deliveries tried per message before it is dropped.  Permanently rejected
+        messages are dropped after the first.
+    :param retry_delay: Seconds before the first retry, doubled for each further one
+    :param idle_timeout: Seconds a worker keeps an unused connection open
+    :param max_queued: Messages waiting for delivery beyond which send() drops new ones
+    """
+
+    def __init__(self, session_factory, workers=1, max_attempts=3, retry_delay=5.0, idle_timeout=60.0,
+                 max_queued=1000):
+        self.session_factory = session_factory
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self._queue = queue.Queue(max_queued)
+        # Heap of (due time, sequence number, message) waiting for a retry
+        self._retries = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def send(self, from_addr, to_addrs, message):
+        """
+        Queue a message for delivery.  Never blocks; with max_queued messages already waiting the
+        message is dropped.
+
+        :return: True if the message was queued
+        """
+        self._start()
+        try:
+            self._queue.put_nowait((from_addr, to_addrs, message, 1))
+        except queue.Full:
+            self.dropped += 1
+            print("Mail queue full, dropped mail to {0}".format(to_addrs))
+            return False
+
+        return True
+
+    def pending(self):
+        return self._queue.qsize() + len(self._retries)
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+
+            for idx in range(self.workers):
+                thread = threading.Thread(target=self._run, name="mail-{0}".format(idx))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _due_retry(self):
+        """:return: (message due for a retry or None, seconds until the next retry is due or None)"""
+        with self._lock:
+            if not self._retries:
+                return None, None
+
+            wait = self._retries[0][0] - time.monotonic()
+            if wait <= 0:
+                return heapq.heappop(self._retries)[2], None
+
+            return None, wait
+
+    def _run(self):
+        session = self.session_factory()
+        last_used = time.monotonic()
+        stopping = False
+        try:
+            while True:
+                item, wait = self._due_retry()
+                if item is not None:
+                    self._deliver(session, *item)
+                    last_used = time.monotonic()
+                    continue
+
+                if stopping:
+                    # Finish the retries still pending before the worker stops
+                    if wait is None:
+                        return
+                    time.sleep(wait)
+                    continue
+
+                try:
+                    item = self._queue.get(timeout=self.idle_timeout if wait is None else min(wait, self.idle_timeout))
+                except queue.Empty:
+                    if time.monotonic() - last_used >= self.idle_timeout:
+                        session.close()
+                    continue
+
+                try:
+                    if item is None:
+                        stopping = True
+                    else:
+                        self._deliver(session, *item)
+                        last_used = time.monotonic()
+                finally:
+                    self._queue.task_done()
+        finally:
+            session.close()
+
+    def _deliver(self, session, from_addr, to_addrs, message, attempt):
+        try:
+            session.send(from_addr, to_addrs, message)
+            self.sent += 1
+            return
+        except Exception as e:
+            print("Mail to {0} failed (attempt {1} of {2}): {3!r}".format(to_addrs, attempt, self.max_attempts, e))
+            permanent = is_permanent(e)
+            if not permanent:
+                session.close()
+
+        if permanent or attempt >= self.max_attempts:
+            self.failed += 1
+            return
+
+        due = time.monotonic() + self.retry_delay * 2 ** (attempt - 1)
+        with self._lock:
+            heapq.heappush(self._retries, (due, next(self._sequence), (from_addr, to_addrs, message, attempt + 1)))
+
+    def close(self):
+        """Deliver everything already queued, including pending retries, then stop the workers"""
+        with self._lock:
+            threads, self._threads = self._threads, []
+
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
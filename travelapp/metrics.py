@@ -0,0 +1,167 @@
+"""
+Process metrics in the Prometheus text format, served by the /metrics route.
+
+dbutil records, per function taking a cursor, the duration of each call, the rows it read or changed
+and whether it raised, and for each connection pool the time spent waiting for a connection.  The
+pools' size, checked out connections and overflow are read when the metrics are rendered.
+
+Nothing is recorded unless the metrics_enabled setting is on; callers check enabled first, so the
+cost when disabled is one attribute lookup per call.
+"""
+import bisect
+import threading
+
+from . import config as cfg
+
+enabled = cfg.METRICS_ENABLED
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds, in seconds, of the latency histogram buckets
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Upper bounds of the row count histogram buckets
+ROW_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names, values, extra=""):
+    pairs = ['{0}="{1}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values=(), amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation), "# TYPE {0} counter".format(self.name)]
+        with self._lock:
+            values = sorted(self._values.items())
+
+        for label_values, value in values:
+            lines.append("{0}{1} {2}".format(self.name, _labels(self.label_names, label_values), _number(value)))
+
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, documentation, label_names=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # Label values: [count per bucket, +Inf bucket count, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        idx = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0]
+            counts[idx] += 1
+            counts[-1] += value
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation), "# TYPE {0} histogram".format(self.name)]
+        with self._lock:
+            values = sorted((label_values, list(counts)) for label_values, counts in self._values.items())
+
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="{0}"'.format(_number(bound))
+                lines.append("{0}_bucket{1} {2}".format(self.name, _labels(self.label_names, label_values, le),
+                                                        cumulative))
+
+            labels = _labels(self.label_names, label_values)
+            lines.append("{0}_sum{1} {2}".format(self.name, labels, _number(counts[-1])))
+            lines.append("{0}_count{1} {2}".format(self.name, labels, cumulative))
+
+        return lines
+
+
+query_seconds = Histogram("travelapp_db_query_seconds", "Duration of dbutil calls.", ("function",))
+query_rows = Histogram("travelapp_db_query_rows", "Rows read or changed by dbutil calls.", ("function",),
+                       ROW_BUCKETS)
+query_errors = Counter("travelapp_db_query_errors_total", "dbutil calls which raised.", ("function", "error"))
+pool_wait_seconds = Histogram("travelapp_db_pool_wait_seconds", "Time waiting for a pooled connection.", ("pool",))
+connections_created = Counter("travelapp_db_connections_created_total", "Database connections opened.",
+                              ("backend",))
+
+METRICS = [query_seconds, query_rows, query_errors, pool_wait_seconds, connections_created]
+
+
+def observe_query(function, seconds, rows, error=None):
+    """
+    Record one dbutil call.
+
+    :param rows: Rows read or changed, None when not known
+    :param error: The exception raised, if any
+    """
+    query_seconds.observe((function,), seconds)
+    if rows is not None:
+        query_rows.observe((function,), rows)
+    if error is not None:
+        query_errors.inc((function, type(error).__name__))
+
+
+def render_pools(pools):
+    """
+    :param pools: dict of pool name to SQLAlchemy QueuePool
+    """
+    gauges = [
+        ("travelapp_db_pool_size", "Connections the pool keeps open.", lambda pool: pool.size()),
+        ("travelapp_db_pool_checked_out", "Connections in use.", lambda pool: pool.checkedout()),
+        # QueuePool counts overflow from -size until the pool is full
+        ("travelapp_db_pool_overflow", "Connections open beyond the pool size.",
+         lambda pool: max(pool.overflow(), 0)),
+    ]
+
+    lines = []
+    for name, documentation, read in gauges:
+        lines.append("# HELP {0} {1}".format(name, documentation))
+        lines.append("# TYPE {0} gauge".format(name))
+        for pool_name, pool in sorted(pools.items()):
+            lines.append("{0}{1} {2}".format(name, _labels(("pool",), (pool_name,)), read(pool)))
+
+    return lines
+
+
+def render(pools=None):
+    """
+    :param pools: dict of pool name to SQLAlchemy QueuePool, whose current state is reported
+    :return: every metric, in the Prometheus text format
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    lines.extend(render_pools(pools or {}))
+
+    return "\n".join(lines) + "\n"
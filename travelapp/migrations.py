@@ -0,0 +1,353 @@
+"""
+Versioned schema migrations.
+
+Each migration is a (version, description, steps) tuple.  A step is either a SQL statement or a
+callable which receives the cursor.  Applied versions are recorded in the schema_migrations table,
+so running the migrations again only applies what is new.
+
+MySQL commits each DDL statement as it runs, so a migration which fails partway cannot be rolled
+back.  Every step is therefore committed together with a schema_migration_steps row, and running
+the migrations again resumes after the last completed step.
+"""
+import itertools
+import json
+
+from . import geo
+
+# Spacing between consecutive location positions, leaving room to move a location between two
+# others by updating only its own row
+POSITION_GAP = 1024
+
+CREATE_MIGRATION_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations(
+            version INT NOT NULL,
+            description VARCHAR(128) NOT NULL,
+            applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY ( version ));
+"""
+
+CREATE_USERS_TABLE = """
+    CREATE TABLE IF NOT EXISTS users(
+        user_id INT NOT NULL AUTO_INCREMENT,
+        guid CHAR(32) NOT NULL,
+        username VARCHAR(64) NOT NULL UNIQUE,
+        firstname VARCHAR(64) NOT NULL,
+        lastname VARCHAR(64) NOT NULL,
+        email VARCHAR(128) NOT NULL UNIQUE,
+        verified BOOLEAN DEFAULT 0,
+        verification_token CHAR(32) DEFAULT NULL,
+        verified_date TIMESTAMP DEFAULT NULL,
+        password_reset_open BOOLEAN DEFAULT 0,
+        password_change_count INT NOT NULL DEFAULT 0,
+        last_password_change TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        registered TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        hashed_password VARCHAR(64) NOT NULL,
+        salt VARCHAR(64) NOT NULL,
+        PRIMARY KEY( user_id ));
+
+"""
+
+CREATE_PERMISSION_TABLE = """
+    CREATE TABLE IF NOT EXISTS permissions(
+            permission_id INT NOT NULL AUTO_INCREMENT,
+            name VARCHAR(32) NOT NULL,
+            can_read BOOLEAN DEFAULT 0,
+            can_write BOOLEAN DEFAULT 0,
+            can_delete BOOLEAN DEFAULT 0,
+            can_modify_group BOOLEAN DEFAULT 0,
+            PRIMARY KEY ( permission_id ));
+
+"""
+
+CREATE_GROUP_TABLE = """
+    CREATE TABLE IF NOT EXISTS groups(
+            group_id INT NOT NULL AUTO_INCREMENT,
+            guid CHAR(32) NOT NULL,
+            name VARCHAR(128) NOT NULL,
+            PRIMARY KEY ( group_id ));
+
+"""
+
+
+CREATE_GROUP_MEMBER_TABLE = """
+    CREATE TABLE IF NOT EXISTS group_members(
+            group_id INT NOT NULL,
+            user_id INT NOT NULL,
+            permission_id INT NOT NULL,
+            PRIMARY KEY ( group_id, user_id ),
+            FOREIGN KEY ( permission_id )
+                REFERENCES permissions( permission_id )
+                ON DELETE RESTRICT,
+            FOREIGN KEY ( group_id )
+                REFERENCES groups( group_id )
+                ON DELETE CASCADE,
+            FOREIGN KEY ( user_id )
+                REFERENCES users( user_id )
+                ON DELETE CASCADE );
+
+"""
+
+CREATE_TRIP_TABLE = """
+    CREATE TABLE IF NOT EXISTS trips(
+            trip_id INT NOT NULL AUTO_INCREMENT,
+            group_id INT NOT NULL,
+            guid CHAR(32) NOT NULL,
+            title VARCHAR(128) NOT NULL,
+            PRIMARY KEY ( trip_id ),
+            FOREIGN KEY ( group_id )
+                REFERENCES groups( group_id )
+                ON DELETE CASCADE );
+
+"""
+
+CREATE_LOCATION_TABLE = """
+    CREATE TABLE IF NOT EXISTS locations(
+            location_id INT NOT NULL AUTO_INCREMENT,
+            trip_id INT NOT NULL,
+            guid CHAR(32) NOT NULL,
+            title VARCHAR(128) NOT NULL,
+            latitude FLOAT NOT NULL,
+            longitude FLOAT NOT NULL,
+            arrivalDate DATE,
+            departureDate DATE,
+            url VARCHAR(256),
+            PRIMARY KEY ( location_id ),
+            FOREIGN KEY ( trip_id )
+                REFERENCES trips( trip_id )
+                ON DELETE CASCADE );
+"""
+
+
+CREATE_TRIP_LOCATION_TABLE = """
+    CREATE TABLE IF NOT EXISTS trip_locations(
+            trip_id INT NOT NULL PRIMARY KEY,
+            location_order TEXT NOT NULL,
+            FOREIGN KEY ( trip_id )
+                REFERENCES trips( trip_id )
+                ON DELETE CASCADE );
+"""
+
+DEFAULT_PERMISSIONS = [
+    # name, can_read, can_write, can_delete, can_modify_group
+    ("OWNER", 1, 1, 1, 1),
+    ("MODERATOR", 1, 1, 0, 1),
+    ("MEMBER", 1, 1, 0, 0),
+    ("READER", 1, 0, 0, 0),
+]
+
+
+def insert_permission(cursor, name, read, write, delete, modify):
+    sql = """
+        INSERT INTO permissions (name, can_read, can_write, can_delete, can_modify_group)
+        VALUES (%s, %s, %s, %s, %s)
+    """
+
+    cursor.execute(sql, (name, read, write, delete, modify))
+
+
+def seed_permissions(cursor):
+    """Insert the default permissions, unless a database created by createdb.py already has them"""
+    cursor.execute("SELECT COUNT(*) FROM permissions")
+    if cursor.fetchone()[0]:
+        return
+
+    for permission in DEFAULT_PERMISSIONS:
+        insert_permission(cursor, *permission)
+
+
+def convert_location_orders(cursor):
+    """
+    Turn the JSON location orders saved in trip_locations into locations.position values.  Locations
+    missing from a saved order follow the ordered ones, oldest first, as the trip page showed them.
+    """
+    cursor.execute("SELECT trip_id, location_order FROM trip_locations")
+    orders = dict((trip_id, json.loads(order)) for trip_id, order in cursor.fetchall())
+
+    cursor.execute("SELECT trip_id, location_id, guid FROM locations ORDER BY trip_id, location_id")
+    locations = cursor.fetchall()
+
+    sql = "UPDATE locations SET position = %s WHERE location_id = %s"
+
+    updates = []
+    for trip_id, trip_locations in itertools.groupby(locations, key=lambda location: location[0]):
+        ranks = dict((guid, idx) for idx, guid in enumerate(orders.get(trip_id, [])))
+        ordered = sorted(trip_locations, key=lambda location: ranks.get(location[2], len(ranks)))
+
+        for idx, location in enumerate(ordered):
+            updates.append(((idx + 1) * POSITION_GAP, location[1]))
+
+        if len(updates) >= 1000:
+            cursor.executemany(sql, updates)
+            updates = []
+
+    cursor.executemany(sql, updates)
+
+
+def column_exists(cursor, table, column):
+    # Reads the column names of an empty result, which every backend reports
+    cursor.execute("SELECT * FROM {0} LIMIT 0".format(table))
+    cursor.fetchall()
+    return column in [description[0] for description in cursor.description]
+
+
+def add_login_columns(cursor):
+    """
+    Add the login statistics columns used by dbutil.  Some installs added them by hand, so only the
+    missing ones are created.
+    """
+    if not column_exists(cursor, "users", "last_login"):
+        cursor.execute("ALTER TABLE users ADD COLUMN last_login TIMESTAMP NULL DEFAULT NULL")
+    if not column_exists(cursor, "users", "login_count"):
+        cursor.execute("ALTER TABLE users ADD COLUMN login_count INT NOT NULL DEFAULT 0")
+
+
+def backfill_geohashes(cursor, batch_size=5000):
+    """Set the geohash of every existing location, a batch of locations at a time"""
+    select = """
+        SELECT location_id, latitude, longitude FROM locations
+        WHERE location_id > %s
+        ORDER BY location_id
+        LIMIT %s
+    """
+    update = "UPDATE locations SET geohash = %s WHERE location_id = %s"
+
+    last_id = 0
+    while True:
+        cursor.execute(select, (last_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        cursor.executemany(update, [(geo.geohash(latitude, longitude), location_id)
+                                    for location_id, latitude, longitude in rows])
+        last_id = rows[-1][0]
+
+
+MIGRATIONS = [
+    (1, "Initial schema", [
+        CREATE_USERS_TABLE,
+        CREATE_PERMISSION_TABLE,
+        CREATE_GROUP_TABLE,
+        CREATE_GROUP_MEMBER_TABLE,
+        CREATE_TRIP_TABLE,
+        CREATE_LOCATION_TABLE,
+        CREATE_TRIP_LOCATION_TABLE,
+        seed_permissions,
+    ]),
+    # users.username and users.email are already UNIQUE (and so indexed) in the initial schema.
+    (2, "Lookup indexes on guid columns and join paths", [
+        "CREATE UNIQUE INDEX idx_users_guid ON users (guid)",
+        "CREATE UNIQUE INDEX idx_groups_guid ON groups (guid)",
+        "CREATE UNIQUE INDEX idx_trips_guid ON trips (guid)",
+        "CREATE UNIQUE INDEX idx_locations_guid ON locations (guid)",
+        # get_trips / get_groups walk users -> group_members -> groups from the user side, while the
+        # primary key only serves lookups starting from the group.
+        "CREATE INDEX idx_group_members_user ON group_members (user_id, group_id, permission_id)",
+        # get_trips joins groups -> trips on group_id and only needs the listing columns.
+        "CREATE INDEX idx_trips_group ON trips (group_id, guid, title)",
+    ]),
+    (3, "Store location order as an indexed position", [
+        "ALTER TABLE locations ADD COLUMN position INT NOT NULL DEFAULT 0",
+        convert_location_orders,
+        "CREATE INDEX idx_locations_position ON locations (trip_id, position)",
+        "DROP TABLE trip_locations",
+    ]),
+    (4, "Login statistics columns", [
+        add_login_columns,
+    ]),
+    # Hashes now carry their algorithm and cost, see passwords.py
+    (5, "Room for self-describing password hashes", [
+        "ALTER TABLE users MODIFY hashed_password VARCHAR(255) NOT NULL",
+    ]),
+    # Bumped by the dbutil writes, used to answer conditional GETs
+    (6, "Version stamps for trips and groups", [
+        "ALTER TABLE trips ADD COLUMN version INT NOT NULL DEFAULT 0",
+        "ALTER TABLE groups ADD COLUMN version INT NOT NULL DEFAULT 0",
+    ]),
+    # get_trips_page reads each of the user's groups in title order from here
+    (7, "Index for trip listings ordered by title", [
+        "CREATE INDEX idx_trips_group_title ON trips (group_id, title, trip_id)",
+    ]),
+    # Nine characters, geo.GEOHASH_PRECISION.  find_locations_in_box scans geohash ranges and joins
+    # on to trips from trip_id.
+    (8, "Geohash index on locations", [
+        "ALTER TABLE locations ADD COLUMN geohash CHAR(9) NOT NULL DEFAULT ''",
+        backfill_geohashes,
+        "CREATE INDEX idx_locations_geohash ON locations (geohash, trip_id)",
+    ]),
+]
+
+CREATE_MIGRATION_STEP_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migration_steps(
+            version INT NOT NULL,
+            step INT NOT NULL,
+            PRIMARY KEY ( version, step ));
+"""
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def applied_versions(cursor):
+    cursor.execute(CREATE_MIGRATION_TABLE)
+
+    cursor.execute("SELECT version FROM schema_migrations")
+
+    return set(row[0] for row in cursor.fetchall())
+
+
+def current_version(cursor):
+    versions = applied_versions(cursor)
+    if not versions:
+        return 0
+
+    return max(versions)
+
+
+def migrate(cursor, target=None, verbose=False):
+    """
+    Apply every pending migration up to and including the target version.  Each migration is
+    committed together with its schema_migrations row.
+
+    :param cursor: Database cursor
+    :param target: Version to migrate to, defaults to the latest version
+    :param verbose: Print each migration as it is applied
+    :return: list of versions which were applied
+    """
+    if target is None:
+        target = LATEST_VERSION
+
+    done = applied_versions(cursor)
+    cursor.execute(CREATE_MIGRATION_STEP_TABLE)
+    applied = []
+
+    for version, description, steps in MIGRATIONS:
+        if version > target or version in done:
+            continue
+
+        cursor.execute("SELECT step FROM schema_migration_steps WHERE version = %s", version)
+        done_steps = set(row[0] for row in cursor.fetchall())
+
+        if verbose:
+            resumed = " (resuming after step {0})".format(max(done_steps)) if done_steps else ""
+            print("Applying migration {0}: {1}{2}".format(version, description, resumed))
+
+        for idx, step in enumerate(steps):
+            if idx in done_steps:
+                continue
+
+            if callable(step):
+                step(cursor)
+            else:
+                cursor.execute(step)
+
+            cursor.execute("INSERT INTO schema_migration_steps (version, step) VALUES (%s, %s)", (version, idx))
+            cursor.connection.commit()
+
+        cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                       (version, description))
+        cursor.execute("DELETE FROM schema_migration_steps WHERE version = %s", version)
+        cursor.connection.commit()
+
+        applied.append(version)
+
+    return applied
@@ -0,0 +1,85 @@
+"""
+Cached MX lookups for validating the mail domain of new users.
+
+Positive answers are cached for the TTL of the MX records, negative answers (NXDOMAIN or no MX
+records) for negative_ttl.  Lookups give up after timeout seconds; a domain which could not be
+checked is accepted, and only cached for error_ttl, so a slow DNS server never blocks sign ups.
+"""
+import threading
+
+import dns.exception
+import dns.resolver
+
+from . import cache
+
+
+class MXCache(object):
+
+    def __init__(self, resolver=None, timeout=2.0, negative_ttl=300, error_ttl=30, min_ttl=0, max_ttl=86400,
+                 max_size=10000):
+        """
+        :param resolver: Object with a dnspython style query(name, rdtype) method, defaults to the
+            system resolver
+        """
+        if resolver is None:
+            resolver = dns.resolver.Resolver()
+            resolver.timeout = timeout
+            resolver.lifetime = timeout
+
+        self.resolver = resolver
+        self.negative_ttl = negative_ttl
+        self.error_ttl = error_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.lookups = 0
+        self.errors = 0
+        self.cache = cache.TTLCache(max_size=max_size, ttl=negative_ttl)
+
+    def has_mx(self, domain):
+        """True if the domain has MX records, or could not be checked in time"""
+        domain = domain.strip().rstrip('.').lower()
+
+        found = self.cache.get(domain)
+        if found is not cache.MISSING:
+            return found
+
+        found, ttl = self._lookup(domain)
+        self.cache.set(domain, found, ttl)
+
+        return found
+
+    def _lookup(self, domain):
+        self.lookups += 1
+        try:
+            answer = self.resolver.query(domain, 'MX')
+        except (dns.exception.Timeout, dns.resolver.NoNameservers) as e:
+            self.errors += 1
+            print("MX lookup for {0} failed: {1}".format(domain, e))
+            return True, self.error_ttl
+        except dns.exception.DNSException:
+            # NXDOMAIN, no MX records or a malformed name
+            return False, self.negative_ttl
+
+        ttl = min(max(answer.rrset.ttl, self.min_ttl), self.max_ttl)
+        return len(answer) > 0, ttl
+
+    def prewarm(self, domains, background=False):
+        """
+        Look up a list of known domains ahead of the first sign up using them.
+
+        :param background: Run the lookups on a separate thread and return at once
+        """
+        if background:
+            thread = threading.Thread(target=self.prewarm, args=(list(domains),), name="mx-prewarm")
+            thread.daemon = True
+            thread.start()
+            return
+
+        for domain in domains:
+            self.has_mx(domain)
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats["lookups"] = self.lookups
+        stats["errors"] = self.errors
+        return stats
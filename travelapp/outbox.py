@@ -0,0 +1,253 @@
+"""
+Durable on-disk outbox for outgoing mail.
+
+Request handlers spool each message with a single file write (maildir style: written to tmp/, then
+renamed into new/), so nothing is lost if a process dies before delivery.  A separate drain process
+sends spooled messages in batches, over one transport session per batch.  A message being sent is
+claimed by renaming it into cur/.  Messages which fail are moved to retry/ with a growing delay, and
+to failed/ after max_attempts.  Permanently rejected (5xx) and unreadable messages go to failed/ at once.
+
+Run the drain process with:
+
+    python -m travelapp.outbox [--once] [--interval SECONDS] [--sendmail]
+"""
+import argparse
+import itertools
+import json
+import os
+import socket
+import subprocess
+import time
+
+from . import config as cfg
+from . import mailqueue
+
+SUBDIRECTORIES = ("tmp", "new", "cur", "retry", "failed")
+
+_counter = itertools.count()
+
+
+def fsync_directory(path):
+    """Make the renames into a directory durable, as fsync of a file does not cover its directory entry"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Outbox(object):
+
+    def __init__(self, directory, max_attempts=5, retry_delay=60):
+        self.directory = directory
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+        for name in SUBDIRECTORIES:
+            path = os.path.join(directory, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def _path(self, subdirectory, name):
+        return os.path.join(self.directory, subdirectory, name)
+
+    def put(self, from_addr, to_addrs, message):
+        """
+        Spool a message for delivery.
+
+        :return: name of the spooled message
+        """
+        name = "{0:.6f}.{1}_{2}.{3}".format(time.time(), os.getpid(), next(_counter),
+                                            socket.gethostname().replace(",", "_"))
+        data = json.dumps({"from": from_addr, "to": to_addrs, "message": message}).encode('utf-8')
+
+        tmp_path = self._path("tmp", name)
+        with open(tmp_path, "wb") as spool_file:
+            spool_file.write(data)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+
+        os.rename(tmp_path, self._path("new", name))
+        fsync_directory(self._path("new", ""))
+
+        return name
+
+    def ready(self, now=None):
+        """
+        Messages due for delivery: everything in new/, then retries whose delay has passed.
+
+        :return: list of (subdirectory, name)
+        """
+        now = now or time.time()
+
+        due = [("new", name) for name in sorted(os.listdir(self._path("new", "")))]
+        for name in sorted(os.listdir(self._path("retry", ""))):
+            _, retry_at, _ = parse_retry_name(name)
+            if retry_at <= now:
+                due.append(("retry", name))
+
+        return due
+
+    def recover(self, stale_after=600):
+        """
+        Reschedule messages left in cur/ by a drain process which died mid-batch.  The interrupted
+        delivery counts as an attempt, so a message which keeps crashing the drain ends up in
+        failed/.  Such a message may already have been sent, so it can be delivered twice.
+        """
+        cutoff = time.time() - stale_after
+        for name in os.listdir(self._path("cur", "")):
+            if os.path.getmtime(self._path("cur", name)) < cutoff:
+                self._reschedule(name)
+
+    def drain(self, transport, batch_size=100):
+        """
+        Deliver every message which is due, batch_size messages per transport session.
+
+        :return: (number sent, number failed)
+        """
+        sent = failed = 0
+
+        due = self.ready()
+        for start in range(0, len(due), batch_size):
+            batch = due[start:start + batch_size]
+
+            try:
+                transport.open()
+            except Exception as e:
+                print("Unable to open mail transport: {0}".format(e))
+                break
+
+            try:
+                for subdirectory, name in batch:
+                    delivered = self._deliver(transport, subdirectory, name)
+                    if delivered:
+                        sent += 1
+                    elif delivered is not None:
+                        failed += 1
+            finally:
+                transport.close()
+
+        return sent, failed
+
+    def _deliver(self, transport, subdirectory, name):
+        """
+        :return: True when sent, False when rescheduled, None when another process claimed it first
+        """
+        path = self._path("cur", name)
+        try:
+            os.rename(self._path(subdirectory, name), path)
+        except OSError:
+            return None
+
+        # Mark when it was claimed, for recover()
+        os.utime(path, None)
+
+        try:
+            with open(path, "rb") as spool_file:
+                envelope = json.loads(spool_file.read().decode('utf-8'))
+            from_addr, to_addrs, message = envelope["from"], envelope["to"], envelope["message"]
+        except (ValueError, KeyError, TypeError) as e:
+            print("Spooled message {0} is unreadable, moved to failed/: {1}".format(name, e))
+            self._fail(name)
+            return False
+
+        try:
+            transport.send(from_addr, to_addrs, message)
+        except Exception as e:
+            print("Delivery of {0} failed: {1}".format(name, e))
+            if mailqueue.is_permanent(e):
+                self._fail(name)
+            else:
+                self._reschedule(name)
+            return False
+
+        os.unlink(path)
+        return True
+
+    def _fail(self, name):
+        original = parse_retry_name(name)[2] if "," in name else name
+        os.rename(self._path("cur", name), self._path("failed", original))
+
+    def _reschedule(self, name):
+        attempts, _, original = parse_retry_name(name) if "," in name else (0, 0, name)
+        attempts += 1
+
+        if attempts >= self.max_attempts:
+            self._fail(name)
+            return
+
+        retry_at = int(time.time() + self.retry_delay * 2 ** (attempts - 1))
+        retry_name = "{0},{1},{2}".format(attempts, retry_at, original)
+        os.rename(self._path("cur", name), self._path("retry", retry_name))
+
+
+def parse_retry_name(name):
+    """Split a retry/ file name into (attempts so far, time of next attempt, original name)"""
+    attempts, retry_at, original = name.split(",", 2)
+    return int(attempts), int(retry_at), original
+
+
+class SmtpTransport(object):
+    """Sends a batch over one SMTP session, e.g. to the host's local mail server"""
+
+    def __init__(self, host="localhost", port=25, username=None, password=None, starttls=False):
+        self.session = mailqueue.SmtpSession(host, port, username, password, starttls=starttls)
+
+    def open(self):
+        self.session.connect()
+
+    def send(self, from_addr, to_addrs, message):
+        self.session.send(from_addr, to_addrs, message)
+
+    def close(self):
+        self.session.close()
+
+
+class SendmailTransport(object):
+    """
+    Hands each message to the sendmail binary.  sendmail takes one message per process, so this
+    is the fallback for hosts without a local SMTP listener.
+    """
+
+    def __init__(self, sendmail="/usr/sbin/sendmail"):
+        self.sendmail = sendmail
+
+    def open(self):
+        pass
+
+    def send(self, from_addr, to_addrs, message):
+        proc = subprocess.Popen([self.sendmail, "-oi", "-f", from_addr] + list(to_addrs), stdin=subprocess.PIPE)
+        proc.communicate(message.encode('utf-8'))
+        if proc.returncode != 0:
+            raise IOError("sendmail exited with status {0}".format(proc.returncode))
+
+    def close(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deliver mail spooled in the outbox")
+    parser.add_argument("--once", action="store_true", help="drain once and exit")
+    parser.add_argument("--interval", type=float, default=10.0, help="seconds between drains")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--sendmail", action="store_true", help="deliver through sendmail instead of SMTP")
+    args = parser.parse_args()
+
+    outbox = Outbox(cfg.OUTBOX_DIR)
+    transport = SendmailTransport() if args.sendmail else SmtpTransport()
+
+    while True:
+        outbox.recover()
+
+        if outbox.ready():
+            sent, failed = outbox.drain(transport, args.batch_size)
+            print("Sent {0}, failed {1}".format(sent, failed))
+
+        if args.once:
+            break
+
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
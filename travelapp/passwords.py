@@ -0,0 +1,189 @@
+"""
+Password hashing.
+
+Stored hashes carry their algorithm and cost: "<algorithm>$<parameters>$<hex digest>".  Hashes
+written before this format existed are a bare SHA-256 hex digest of salt + password.  When a user
+logs in with a hash made by another algorithm or cost than the current default, the caller is told
+to store a fresh hash, so old hashes are upgraded on the next login.
+
+Hashing is CPU heavy by design, so it runs in a bounded pool of worker processes instead of on the
+request thread.
+"""
+import concurrent.futures
+import hashlib
+import hmac
+import os
+import threading
+
+
+class Hasher(object):
+    """Base class of the password hashing algorithms"""
+
+    algorithm = None
+
+    def digest(self, salt, password):
+        raise NotImplementedError
+
+    def parameters(self):
+        """Cost parameters, as stored in the encoded hash"""
+        return []
+
+    def encode(self, salt, password):
+        fields = [self.algorithm] + [str(value) for value in self.parameters()] + [self.digest(salt, password)]
+        return "$".join(fields)
+
+    def verify(self, salt, password, encoded):
+        return hmac.compare_digest(self.encode(salt, password), encoded)
+
+    @classmethod
+    def from_parameters(cls, parameters):
+        return cls(*[int(value) for value in parameters])
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.parameters() == other.parameters()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "{0}({1})".format(type(self).__name__, ", ".join(str(value) for value in self.parameters()))
+
+
+class Sha256Hasher(Hasher):
+    """Original single round SHA-256 of salt + password, stored without a prefix"""
+
+    algorithm = "sha256"
+
+    def digest(self, salt, password):
+        return hashlib.sha256((salt + password).encode('utf-8')).hexdigest()
+
+    def encode(self, salt, password):
+        return self.digest(salt, password)
+
+
+class Pbkdf2Hasher(Hasher):
+
+    algorithm = "pbkdf2_sha256"
+
+    def __init__(self, iterations=260000):
+        self.iterations = iterations
+
+    def parameters(self):
+        return [self.iterations]
+
+    def digest(self, salt, password):
+        return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), self.iterations).hex()
+
+
+class ScryptHasher(Hasher):
+
+    algorithm = "scrypt"
+
+    def __init__(self, n=2 ** 14, r=8, p=1):
+        self.n = n
+        self.r = r
+        self.p = p
+
+    def parameters(self):
+        return [self.n, self.r, self.p]
+
+    def digest(self, salt, password):
+        return hashlib.scrypt(password.encode('utf-8'), salt=salt.encode('utf-8'), n=self.n, r=self.r, p=self.p,
+                              maxmem=256 * self.n * self.r, dklen=32).hex()
+
+
+HASHERS = dict((hasher.algorithm, hasher) for hasher in (Sha256Hasher, Pbkdf2Hasher, ScryptHasher))
+
+DEFAULT_HASHER = Pbkdf2Hasher()
+
+
+def identify(encoded):
+    """
+    Hasher which produced an encoded hash.
+
+    :raises ValueError: for an unknown algorithm
+    """
+    if "$" not in encoded:
+        return Sha256Hasher()
+
+    fields = encoded.split("$")
+    hasher = HASHERS.get(fields[0])
+    if hasher is None:
+        raise ValueError("Unknown password hash algorithm: {0}".format(fields[0]))
+
+    return hasher.from_parameters(fields[1:-1])
+
+
+def hash_password(salt, password, hasher=None):
+    return (hasher or DEFAULT_HASHER).encode(salt, password)
+
+
+def verify_password(salt, password, encoded, hasher=None):
+    """
+    Check a password against its stored hash.
+
+    :param hasher: Hasher new hashes should use, defaults to DEFAULT_HASHER
+    :return: (True if the password matches, replacement hash to store or None)
+    """
+    hasher = hasher or DEFAULT_HASHER
+    stored_with = identify(encoded)
+
+    if not stored_with.verify(salt, password, encoded):
+        return False, None
+
+    if stored_with == hasher:
+        return True, None
+
+    return True, hasher.encode(salt, password)
+
+
+class HashingPool(object):
+    """
+    Runs hashing in worker processes.  At most max_workers hashes run at once and at most
+    max_pending more wait in line; callers beyond that block until there is room.  With
+    max_workers=0 hashing runs on the calling thread.
+    """
+
+    def __init__(self, max_workers=None, max_pending=None, hasher=None):
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        if max_pending is None:
+            max_pending = 4 * max_workers
+
+        self.max_workers = max_workers
+        self.hasher = hasher or DEFAULT_HASHER
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        with self._lock:
+            # A forked server process must not share its parent's workers
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.max_workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _run(self, func, *args):
+        if self.max_workers == 0:
+            return func(*args)
+
+        with self._slots:
+            return self._get_executor().submit(func, *args).result()
+
+    def hash(self, salt, password):
+        return self._run(hash_password, salt, password, self.hasher)
+
+    def verify(self, salt, password, encoded):
+        """See verify_password"""
+        return self._run(verify_password, salt, password, encoded, self.hasher)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown()
+            self._executor = None
+
+
+pool = HashingPool()
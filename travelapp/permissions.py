@@ -0,0 +1,66 @@
+"""
+Registry of the rows of the permissions table.
+
+The permissions table is reference data: it is seeded by the migrations and never changes while the
+application runs.  The registry loads it once at startup and answers permission questions from
+memory.  Call reload() after changing the table.
+"""
+import threading
+
+from . import dbutil
+
+
+class PermissionRegistry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._permissions = None
+        self._names_with = None
+
+    @property
+    def loaded(self):
+        return self._permissions is not None
+
+    def load(self, cursor):
+        """
+        Read the permissions table.
+
+        :param cursor: Database cursor
+        """
+        permissions = dbutil.get_permission_flags(cursor)
+
+        names_with = {}
+        for capability in dbutil.PERMISSION_CAPABILITIES:
+            names_with[capability] = tuple(permission.name for permission in permissions
+                                           if getattr(permission, capability))
+
+        with self._lock:
+            self._permissions = tuple(permissions)
+            self._names_with = names_with
+
+    reload = load
+
+    def _require_loaded(self):
+        if self._permissions is None:
+            raise RuntimeError("Permission registry has not been loaded")
+
+    def permissions(self):
+        """Every permission as (permission_id, name) records, in id order"""
+        self._require_loaded()
+        return [dbutil.Permission(permission.permission_id, permission.name) for permission in self._permissions]
+
+    def names_with(self, capability):
+        """
+        Names of the permissions which grant a capability.
+
+        :param capability: One of dbutil.PERMISSION_CAPABILITIES, e.g. "can_modify_group"
+        :return: tuple of permission names
+        """
+        if capability not in dbutil.PERMISSION_CAPABILITIES:
+            raise ValueError("Unknown permission capability: {0}".format(capability))
+
+        self._require_loaded()
+        return self._names_with[capability]
+
+
+registry = PermissionRegistry()
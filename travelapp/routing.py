@@ -0,0 +1,147 @@
+"""
+Leg distances and suggested visiting orders for trips.
+
+A trip is an open path: it starts at its first location and ends wherever the order ends.  The
+suggested order keeps the first location, builds a path with the nearest neighbour heuristic and
+improves it with 2-opt moves until no move shortens it or the time budget runs out.  Each 2-opt step
+scores every possible move from one position in a single vectorized pass over the distance matrix.
+"""
+import time
+
+import numpy
+
+from . import geo
+
+# Seconds optimize_order may spend improving a path
+TIME_BUDGET = 0.8
+
+
+def distance_matrix(latitudes, longitudes):
+    """
+    Haversine distances in meters between every pair of points, in one vectorized pass.
+
+    :return: n x n numpy array
+    """
+    lat = numpy.radians(numpy.asarray(latitudes, dtype=numpy.float64))
+    lng = numpy.radians(numpy.asarray(longitudes, dtype=numpy.float64))
+
+    delta_lat = lat[:, None] - lat[None, :]
+    delta_lng = lng[:, None] - lng[None, :]
+    cos_lat = numpy.cos(lat)
+
+    a = numpy.sin(delta_lat / 2) ** 2 + cos_lat[:, None] * cos_lat[None, :] * numpy.sin(delta_lng / 2) ** 2
+    return 2 * geo.EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0.0, 1.0)))
+
+
+def consecutive_distances(latitudes, longitudes):
+    """
+    Haversine distances in meters from each point to the next, in one vectorized pass.
+
+    :return: numpy array of n - 1 distances
+    """
+    lat = numpy.radians(numpy.asarray(latitudes, dtype=numpy.float64))
+    lng = numpy.radians(numpy.asarray(longitudes, dtype=numpy.float64))
+
+    cos_lat = numpy.cos(lat)
+    a = numpy.sin(numpy.diff(lat) / 2) ** 2 + cos_lat[:-1] * cos_lat[1:] * numpy.sin(numpy.diff(lng) / 2) ** 2
+    return 2 * geo.EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0.0, 1.0)))
+
+
+def leg_distances(matrix, order):
+    """Distance of each leg of a path visiting the points in order, as a numpy array"""
+    order = numpy.asarray(order)
+    return matrix[order[:-1], order[1:]]
+
+
+def path_length(matrix, order):
+    return float(leg_distances(matrix, order).sum())
+
+
+def trip_legs(locations):
+    """Distance in meters of each leg of a trip, visiting its locations in their current order"""
+    if len(locations) < 2:
+        return []
+
+    return consecutive_distances([location.latitude for location in locations],
+                                 [location.longitude for location in locations]).tolist()
+
+
+def nearest_neighbour(matrix, start=0):
+    """Path from start which always goes on to the closest point not yet visited"""
+    count = len(matrix)
+    visited = numpy.zeros(count, dtype=bool)
+    order = [start]
+    visited[start] = True
+
+    current = start
+    for _ in range(count - 1):
+        distances = numpy.where(visited, numpy.inf, matrix[current])
+        current = int(distances.argmin())
+        visited[current] = True
+        order.append(current)
+
+    return order
+
+
+def two_opt(matrix, order, time_budget=TIME_BUDGET):
+    """
+    Improve an open path with 2-opt moves, keeping its first point.  A move reverses the stretch
+    order[i + 1:j + 1]; reversing up to the last point only changes one edge, as the path has no
+    edge back to its start.
+
+    :return: improved order, as a list
+    """
+    order = numpy.array(order)
+    count = len(order)
+    deadline = time.perf_counter() + time_budget
+
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(count - 2):
+            a = order[i]
+            b = order[i + 1]
+            c = order[i + 2:]
+            d = numpy.append(order[i + 3:], -1)
+
+            # Length change of reversing order[i + 1:j + 1], for every j > i at once
+            next_edges = numpy.where(d >= 0, matrix[c, d], 0.0)
+            new_edges = numpy.where(d >= 0, matrix[b, d], 0.0)
+            gains = matrix[a, b] + next_edges - matrix[a, c] - new_edges
+
+            best = int(gains.argmax())
+            if gains[best] > 1e-9:
+                j = i + 2 + best
+                order[i + 1:j + 1] = order[i + 1:j + 1][::-1].copy()
+                improved = True
+
+            if time.perf_counter() >= deadline:
+                break
+
+    return order.tolist()
+
+
+def optimize_order(locations, time_budget=TIME_BUDGET):
+    """
+    Suggest a shorter order for a trip's locations, starting from its current first location.
+
+    :param locations: Locations in their current order
+    :return: (list of location guids, as insert_order takes them, legs of the current order as trip_legs
+        returns them, current length, suggested length)
+    """
+    if not locations:
+        return [], [], 0.0, 0.0
+
+    matrix = distance_matrix([location.latitude for location in locations],
+                             [location.longitude for location in locations])
+    current = list(range(len(locations)))
+    legs = leg_distances(matrix, current)
+    current_length = float(legs.sum())
+
+    suggested = two_opt(matrix, nearest_neighbour(matrix), time_budget)
+    suggested_length = path_length(matrix, suggested)
+
+    if suggested_length >= current_length:
+        suggested, suggested_length = current, current_length
+
+    return [locations[idx].guid for idx in suggested], legs.tolist(), current_length, suggested_length